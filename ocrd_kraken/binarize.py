@@ -2,8 +2,6 @@ from __future__ import absolute_import
 from os.path import join
 from typing import Optional
 
-import kraken.binarization
-
 from ocrd.processor.base import OcrdPageResult
 from ocrd.processor.ocrd_page_result import OcrdPageResultImage
 
@@ -12,6 +10,9 @@ from ocrd_utils import assert_file_grp_cardinality, getLogger, make_file_id, MIM
 from ocrd_models.ocrd_page import AlternativeImageType, OcrdPage, to_xml
 from ocrd_modelfactory import page_from_file
 
+from .common import preload
+from .metrics import page_metrics, current_metrics, start_metrics, finish_metrics
+
 
 class KrakenBinarize(Processor):
 
@@ -19,6 +20,14 @@ class KrakenBinarize(Processor):
     def executable(self):
         return 'ocrd-kraken-binarize'
 
+    def setup(self):
+        self.metrics_output = start_metrics()
+        preload('kraken.binarization')
+
+    def shutdown(self):
+        finish_metrics(getattr(self, 'metrics_output', None))
+
+    @page_metrics
     def process_page_pcgts(self, *input_pcgts: Optional[OcrdPage], page_id: Optional[str] = None) -> OcrdPageResult:
         """Binarize the pages/regions/lines with Kraken.
 
@@ -38,6 +47,7 @@ class KrakenBinarize(Processor):
 
         Produce a new output file by serialising the resulting hierarchy.
         """
+        import kraken.binarization
         assert self.workspace
         assert self.output_file_grp
         self.logger.debug('Level of operation: "%s"', self.parameter['level-of-operation'])
@@ -48,6 +58,7 @@ class KrakenBinarize(Processor):
         assert page
         page_image, page_xywh, _ = self.workspace.image_from_page(
             page, page_id, feature_filter='binarized')
+        current_metrics().lap('image')
         result = OcrdPageResult(pcgts)
         if self.parameter['level-of-operation'] == 'page':
             self.logger.info("Binarizing page '%s'", page_id)
@@ -71,4 +82,5 @@ class KrakenBinarize(Processor):
                         alternative_image = AlternativeImageType(comments=f'{line_xywh["features"]},binarized')
                         line.add_AlternativeImage(alternative_image)
                         result.images.append(OcrdPageResultImage(kraken.binarization.nlbin(line_image), f'{region.id}_{line.id}.IMG-BIN', alternative_image))
+        current_metrics().lap('binarize')
         return result
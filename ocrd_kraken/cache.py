@@ -0,0 +1,108 @@
+import os
+import json
+import time
+import hashlib
+import sqlite3
+from collections import namedtuple
+
+import numpy as np
+
+from ocrd_utils import config
+
+config.add('OCRD_KRAKEN_LINE_CACHE',
+           description="Path of an SQLite database to cache line recognition results in, keyed by "
+           "line image, geometry, model and parameters (empty means no caching).",
+           default=(True, ''))
+
+config.add('OCRD_KRAKEN_LINE_CACHE_SIZE',
+           description="Maximum size (in MB) of the line cache, beyond which the least recently "
+           "used entries are evicted.",
+           parser=float,
+           default=(True, 1024))
+
+CachedRecord = namedtuple('CachedRecord', ['prediction', 'cuts', 'confidences'])
+CachedRecord.__doc__ = "Line recognition result from the cache (with the attributes of a Kraken ocr_record)."
+
+def line_key(prefix, image, *geometry):
+    """Content hash of a line image crop and its (crop-relative) ``geometry`` arrays,
+    after some ``prefix`` identifying the model and parameters."""
+    key = hashlib.sha256(prefix.encode('utf-8'))
+    key.update(f'{image.mode}{image.size}'.encode('utf-8'))
+    key.update(image.tobytes())
+    for points in geometry:
+        key.update(np.asarray(points, dtype=np.float64).tobytes())
+        key.update(b'|')
+    return key.hexdigest()
+
+class LineCache:
+    """
+    Size-bounded on-disk LRU cache of line recognition results.
+
+    Stores prediction, cuts (relative to the line crop) and confidences
+    per key (see :py:func:`line_key`) in an SQLite database, which can be
+    shared by concurrent processes.
+    """
+    def __init__(self, path, size_mb=1024):
+        self.path = path
+        self.size = int(size_mb * 1024 * 1024)
+        self.connection = None
+        self.pid = None
+
+    @property
+    def db(self):
+        # connections must not be shared with forked page workers
+        if self.pid != os.getpid():
+            self.connection = sqlite3.connect(self.path, timeout=60, isolation_level=None)
+            self.connection.execute("PRAGMA journal_mode=WAL")
+            self.connection.execute("CREATE TABLE IF NOT EXISTS lines ("
+                                    "key TEXT PRIMARY KEY, value TEXT, size INTEGER, used REAL)")
+            self.connection.execute("CREATE INDEX IF NOT EXISTS lines_used ON lines (used)")
+            self.pid = os.getpid()
+        return self.connection
+
+    def get(self, keys):
+        """Look up ``keys``, returning a dict of the records found."""
+        found = {}
+        keys = list(set(keys))
+        for idx in range(0, len(keys), 500):
+            batch = keys[idx:idx + 500]
+            rows = self.db.execute("SELECT key, value FROM lines WHERE key IN (%s)" %
+                                   ','.join('?' * len(batch)), batch).fetchall()
+            for key, value in rows:
+                prediction, cuts, confidences = json.loads(value)
+                found[key] = CachedRecord(prediction, cuts, confidences)
+        if found:
+            now = time.time()
+            self.db.executemany("UPDATE lines SET used = ? WHERE key = ?",
+                                [(now, key) for key in found])
+        return found
+
+    def put(self, records):
+        """Store ``records``, a dict of keys and (prediction, cuts, confidences),
+        then evict the least recently used entries beyond the size bound."""
+        if not records:
+            return
+        now = time.time()
+        rows = []
+        for key, (prediction, cuts, confidences) in records.items():
+            value = json.dumps([prediction, cuts, confidences])
+            rows.append((key, value, len(value), now))
+        db = self.db
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            db.executemany("INSERT OR REPLACE INTO lines VALUES (?, ?, ?, ?)", rows)
+            total, = db.execute("SELECT COALESCE(SUM(size), 0) FROM lines").fetchone()
+            if total > self.size:
+                db.execute("DELETE FROM lines WHERE key IN ("
+                           "SELECT key FROM (SELECT key, SUM(size) OVER (ORDER BY used DESC, key) AS total "
+                           "FROM lines) WHERE total > ?)", (self.size,))
+            db.execute("COMMIT")
+        except BaseException:
+            db.execute("ROLLBACK")
+            raise
+
+    def close(self):
+        if self.connection and self.pid == os.getpid():
+            self.connection.close()
+        self.connection = None
+        self.pid = None
@@ -0,0 +1,18 @@
+import click
+
+from ocrd_utils import initLogging
+from ocrd_kraken.server import KrakenPredictorServer
+
+@click.command()
+@click.option('-s', '--socket', 'socket_path', required=True,
+              help='path of the unix socket to listen on')
+def cli(socket_path):
+    """
+    Run a persistent Kraken predictor server, keeping models loaded across
+    processor runs (which attach to it via OCRD_KRAKEN_PREDICTOR_SERVER=SOCKET).
+    """
+    initLogging()
+    # predictor classes are imported in connection threads, but ocrd
+    # can only install its signal handlers in the main thread
+    import ocrd # noqa: F401 # pylint: disable=unused-import,import-outside-toplevel
+    KrakenPredictorServer(socket_path).serve_forever()
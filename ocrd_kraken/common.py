@@ -1,67 +1,472 @@
+import os
+import hashlib
+import importlib
+from collections.abc import Iterator
 import multiprocessing as mp
+from multiprocessing import shared_memory
+from pathlib import Path
+import time
+
+import numpy as np
+from PIL import Image
 
 from ocrd_utils import config, initLogging
 
-class KrakenPredictor(mp.context.SpawnProcess):
-    def __init__(self, logger, parameter):
+from .metrics import current_metrics
+
+config.add('OCRD_KRAKEN_BATCH_SIZE',
+           description="Maximum number of queued page tasks the Kraken predictor combines into a "
+           "single prediction, if it can share model calls across pages (0 means as many as "
+           "OCRD_MAX_PARALLEL_PAGES).",
+           parser=int,
+           default=(True, 0))
+
+config.add('OCRD_KRAKEN_BATCH_TIMEOUT',
+           description="Time in seconds the Kraken predictor waits for more page tasks "
+           "to arrive before predicting an incomplete batch.",
+           parser=float,
+           default=(True, 0.05))
+
+config.add('OCRD_KRAKEN_SHARED_MEMORY',
+           description="If set to `true`, page images are passed to the Kraken predictor via shared "
+           "memory blocks instead of pickling them through the task queue.",
+           validator=lambda val: isinstance(val, bool) or str.lower(val) in ('true', 'false', '0', '1'),
+           parser=lambda val: bool(val) if isinstance(val, (int, bool)) else str.lower(val) in ('true', '1'),
+           default=(True, False))
+
+config.add('OCRD_KRAKEN_PREDICTOR_SERVER',
+           description="Path of the unix socket of a running `ocrd-kraken-server` to attach to, "
+           "instead of starting (and loading models into) new predictor processes for each run.",
+           default=(True, ''))
+
+config.add('OCRD_KRAKEN_MODEL_CACHE',
+           description="Directory to cache CPU-optimized models in (see parameter `cpu_optimization`).",
+           parser=Path,
+           default=(True, lambda: Path(os.environ.get('XDG_CACHE_HOME', Path.home() / '.cache'), 'ocrd-kraken')))
+
+def make_predictor(cls, logger, parameter, processes=1):
+    """
+    Instantiate predictor class ``cls``, or (if ``OCRD_KRAKEN_PREDICTOR_SERVER``
+    is set) a client to an equivalent predictor in that server.
+    """
+    if config.OCRD_KRAKEN_PREDICTOR_SERVER:
+        from .server import KrakenPredictorClient
+        return KrakenPredictorClient(config.OCRD_KRAKEN_PREDICTOR_SERVER,
+                                     cls, logger, parameter, processes=processes)
+    return cls(logger, parameter, processes=processes)
+
+def preload(*modules):
+    """
+    Import ``modules`` needed for processing pages (in the processor's setup),
+    so forked page workers inherit them instead of each importing them anew.
+
+    (Not at module level, so ``--help`` and ``--dump-json`` stay fast.)
+    """
+    for module in modules:
+        importlib.import_module(module)
+
+def model_checksum(path):
+    """SHA-256 hex digest of the model file at ``path``."""
+    checksum = hashlib.sha256()
+    with open(path, 'rb') as model_file:
+        for chunk in iter(lambda: model_file.read(1 << 20), b''):
+            checksum.update(chunk)
+    return checksum.hexdigest()
+
+SAMPLE_TEXT = "Quantized models must read 1234 lines of text (like this one) just as well."
+
+def text_sample(height, width=None, lines=1):
+    """
+    Render ``lines`` lines of black-on-white sample text into an image of
+    ``height`` pixels (and ``width`` pixels, or as wide as the text), for
+    validating models on realistic input.
+    """
+    from PIL import ImageFont
+    size = height // (2 * lines)
+    try:
+        font = ImageFont.load_default(size=size)
+    except TypeError:
+        # Pillow < 10.1 has no scalable default font:
+        # render with the bitmap font at its own size, then scale up
+        font = ImageFont.load_default()
+        base = font.getbbox(SAMPLE_TEXT)[3]
+        scale = size / base
+        image = draw_sample(font, base, 2 * base * lines,
+                            None if width is None else round(width / scale), lines)
+        if width is None:
+            width = round(image.width * scale)
+        return image.resize((width, height))
+    return draw_sample(font, size, height, width, lines)
+
+def draw_sample(font, size, height, width, lines):
+    """Draw :py:data:`SAMPLE_TEXT` for :py:func:`text_sample` with ``font`` of ``size`` pixels."""
+    from PIL import ImageDraw
+    if width is None:
+        width = int(font.getlength(SAMPLE_TEXT)) + size
+    image = Image.new('L', (width, height), 255)
+    draw = ImageDraw.Draw(image)
+    for line in range(lines):
+        draw.text((size // 2, size // 2 + 2 * size * line), SAMPLE_TEXT, font=font, fill=0)
+    return image
+
+def best_path(outputs, axis=1):
+    """
+    Decode the label sequence of a single line from network ``outputs`` with
+    classes along ``axis`` by best path (collapsing repeats and dropping
+    blanks, i.e. label 0).
+    """
+    best = outputs.argmax(axis).flatten().tolist()
+    return [label for prev, label in zip([0] + best, best)
+            if label != prev and label != 0]
+
+def optimize_model(net, model_path, mode, sample, logger, activation=None, labels=None, tolerance=0.1):
+    """
+    Get a copy of the torch module ``net`` (loaded from ``model_path``)
+    optimized for CPU inference according to ``mode`` (``quantize``:
+    dynamic int8 quantization of recurrent and linear layers).
+
+    Load it from ``OCRD_KRAKEN_MODEL_CACHE`` (keyed by model checksum, mode
+    and torch version) if possible. Otherwise build it and compare it with
+    ``net`` on the ``sample`` input tensor (which should look like real input,
+    e.g. rendered text): if the maximum absolute deviation of their outputs
+    (after ``activation``) exceeds ``tolerance``, or if ``labels`` (a function
+    decoding outputs) gives different results, then return ``net`` itself,
+    else cache and return the optimized copy.
+    """
+    import torch
+    cache_path = Path(config.OCRD_KRAKEN_MODEL_CACHE,
+                      f'{model_checksum(model_path)}-{mode}-torch{torch.__version__}.pt')
+    if cache_path.exists():
+        try:
+            optimized = torch.load(cache_path, weights_only=False)
+            logger.info("loaded %s model from cache '%s'", mode, cache_path)
+            return optimized
+        except Exception as err:
+            logger.warning("cannot load cached model '%s': %s", cache_path, err)
+    net.eval()
+    if mode == 'quantize':
+        optimized = torch.ao.quantization.quantize_dynamic(
+            net, {torch.nn.LSTM, torch.nn.GRU, torch.nn.Linear}, dtype=torch.qint8)
+    else:
+        raise ValueError(f"unknown CPU optimization '{mode}'")
+    with torch.no_grad():
+        expected, _ = net(sample)
+        actual, _ = optimized(sample)
+    if activation:
+        expected, actual = activation(expected), activation(actual)
+    deviation = (expected - actual).abs().max().item()
+    if deviation > tolerance:
+        logger.warning("%s model deviates from original by up to %.4f on sample, using original",
+                       mode, deviation)
+        return net
+    if labels and labels(expected) != labels(actual):
+        logger.warning("%s model decodes sample differently from original, using original", mode)
+        return net
+    logger.info("%s model deviates from original by up to %.4f on sample, caching as '%s'",
+                mode, deviation, cache_path)
+    cache_path.parent.mkdir(parents=True, exist_ok=True)
+    # concurrent runs may build the same model, so replace atomically
+    tmp_path = cache_path.with_suffix(f'.{os.getpid()}.tmp')
+    torch.save(optimized, tmp_path)
+    os.replace(tmp_path, cache_path)
+    return optimized
+
+class ResultChunk(list):
+    """
+    Part of a result streamed by the predictor (as produced),
+    terminated by an empty chunk.
+    """
+
+def stream_results(replies):
+    """Iterate over predictor ``replies`` in chunks (or as one, if not streamed)."""
+    for result in replies:
+        if not isinstance(result, ResultChunk):
+            yield result
+        elif result:
+            yield list(result)
+
+def collect_results(replies):
+    """Get the complete result from predictor ``replies`` (joining streamed chunks)."""
+    results = list(replies)
+    if isinstance(results[-1], ResultChunk):
+        return [item for chunk in results for item in chunk]
+    return results[-1]
+
+class SharedImage:
+    """
+    Descriptor for a PIL image copied into a shared memory block,
+    so only name, shape, dtype and mode get pickled.
+    """
+    modes = ('1', 'L', 'LA', 'I', 'F', 'RGB', 'RGBA')
+    def __init__(self, image):
+        array = np.asarray(image)
+        self.mode = image.mode
+        self.shape = array.shape
+        self.dtype = array.dtype.str
+        self.shm = shared_memory.SharedMemory(create=True, size=max(1, array.nbytes))
+        self.name = self.shm.name
+        np.ndarray(self.shape, dtype=self.dtype, buffer=self.shm.buf)[...] = array
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        state['shm'] = None
+        return state
+    def open(self):
+        """Attach to the shared memory block and wrap it as image (without copying)."""
+        self.shm = shared_memory.SharedMemory(name=self.name)
+        array = np.ndarray(self.shape, dtype=self.dtype, buffer=self.shm.buf)
+        image = Image.fromarray(array)
+        assert image.mode == self.mode, f"cannot restore mode {self.mode} from shared memory"
+        return image
+    def close(self):
+        """Detach from the shared memory block (when no image views remain)."""
+        if self.shm is not None:
+            try:
+                self.shm.close()
+            except BufferError:
+                pass # still referenced, will be closed on garbage collection
+            self.shm = None
+    def unlink(self):
+        """Detach from and free the shared memory block (in the creating process)."""
+        shm = self.shm
+        self.close()
+        if shm is not None:
+            shm.unlink()
+
+class KrakenPredictor:
+    """
+    Runs model predictions in a pool of ``processes`` spawned background
+    processes (each with its own model instance), which all receive their
+    tasks from the same queue (so idle processes pick up the next task).
+
+    If :py:meth:`predict` returns an iterator, then its items are sent back
+    in chunks of ``stream_size`` as they are produced.
+    """
+    stream_size = 32
+    def __init__(self, logger, parameter, processes=1):
         self.logger = logger
         self.parameter = parameter
+        self.processes = max(1, processes)
+        # (must be evaluated here, in the parent process)
+        self.batch_size = config.OCRD_KRAKEN_BATCH_SIZE or max(
+            1, -(-config.OCRD_MAX_PARALLEL_PAGES // self.processes))
+        self.batch_timeout = config.OCRD_KRAKEN_BATCH_TIMEOUT
+        self.shared_memory = config.OCRD_KRAKEN_SHARED_MEMORY
         ctxt = mp.get_context('spawn')
         self.taskq = ctxt.Queue(maxsize=1 + config.OCRD_MAX_PARALLEL_PAGES)
-        self.resultq = ctxt.Queue(maxsize=1 + config.OCRD_MAX_PARALLEL_PAGES)
+        # one reply queue per outstanding request (up to two for each concurrent caller,
+        # i.e. main process and forked page workers, when pipelining),
+        # handed out via the queue of free slots for each request
+        nslots = 2 * (1 + max(1, config.OCRD_MAX_PARALLEL_PAGES))
+        self.replyqs = [ctxt.Queue() for _ in range(nslots)]
+        self.slots = ctxt.SimpleQueue()
+        for slot in range(nslots):
+            self.slots.put(slot)
         self.terminate = ctxt.Event()
-        ctxt = mp.get_context('fork') # base.Processor will fork workers
-        self.results = ctxt.Manager().dict()
-        super().__init__()
-        self.daemon = True
+        self.pool = []
+    def __getstate__(self):
+        # model processes only need queues and parameters
+        state = dict(self.__dict__)
+        state['pool'] = []
+        return state
+    def start(self):
+        ctxt = mp.get_context('spawn')
+        for _ in range(self.processes):
+            process = ctxt.Process(target=self.run, daemon=True)
+            process.start()
+            self.pool.append(process)
     def __call__(self, page_id, *page_input):
-        self.taskq.put((page_id, page_input))
+        return self.receive(self.submit(page_id, *page_input))
+    def submit(self, page_id, *page_input):
+        """
+        Send a task to the model processes without waiting for its result.
+        Returns a handle to pass to :py:meth:`receive` (or :py:meth:`discard`).
+        """
+        if self.shared_memory:
+            page_input = tuple(SharedImage(x)
+                               if isinstance(x, Image.Image) and x.mode in SharedImage.modes
+                               else x for x in page_input)
+        slot = self.slots.get()
+        # tag to discard stale replies from abandoned requests in the same slot
+        key = (os.getpid(), time.monotonic_ns())
+        task = (slot, key, page_id, page_input)
+        try:
+            self.taskq.put(((slot, key), page_id, page_input, time.time()))
+        except Exception:
+            self.discard(task)
+            raise
         self.logger.debug("sent task for '%s'", page_id)
-        #return self.get(page_id)
-        result = self.get(page_id)
-        self.logger.debug("received result for '%s'", page_id)
-        return result
-    def get(self, page_id):
+        return task
+    def replies(self, task):
+        """Iterate over the replies (i.e. streamed chunks or the result) of a task."""
+        slot, key, page_id, _ = task
+        try:
+            yield from self.get(slot, key, page_id)
+            self.logger.debug("received result for '%s'", page_id)
+        finally:
+            self.discard(task)
+    def receive(self, task):
+        """Wait for the (complete) result of a task sent via :py:meth:`submit`."""
+        return collect_results(self.replies(task))
+    def stream(self, task):
+        """Iterate over the result of a task sent via :py:meth:`submit` in chunks, as they arrive."""
+        return stream_results(self.replies(task))
+    def discard(self, task):
+        """Release the slot and shared memory of a task (without waiting for its result)."""
+        slot, _, _, page_input = task
+        self.slots.put(slot)
+        for x in page_input:
+            if isinstance(x, SharedImage):
+                x.unlink()
+    def get(self, slot, key, page_id):
+        replyq = self.replyqs[slot]
         while not self.terminate.is_set():
-            if page_id in self.results:
-                result = self.results.pop(page_id)
-                if isinstance(result, Exception):
-                    raise Exception(f"predictor failed for {page_id}") from result
-                return result
             try:
-                page_id, result = self.resultq.get(timeout=0.7)
+                # wakes up as soon as the reply arrives
+                # (timeout only to check for termination)
+                reply_key, result, timings = replyq.get(timeout=1.0)
             except mp.queues.Empty:
                 continue
-            self.logger.debug("storing results for '%s'", page_id)
-            self.results[page_id] = result
+            if reply_key != key:
+                self.logger.debug("discarding stale result in slot %d", slot)
+                continue
+            if timings is None:
+                # streamed chunk, more to come
+                yield result
+                continue
+            metrics = current_metrics()
+            metrics.add('predictor_reply', time.time() - timings.pop('sent'))
+            metrics.add('predictor_queue', timings.pop('queue'))
+            metrics.add('predictor_model', timings.pop('model'))
+            for name, value in timings.items():
+                metrics.gauge(name, value)
+            if isinstance(result, Exception):
+                raise Exception(f"predictor failed for {page_id}") from result
+            yield result
+            return
         raise Exception(f"predictor terminated while waiting on results for {page_id}")
     def run(self):
         initLogging()
+        if self.processes > 1:
+            # share the cores among the model processes
+            import torch
+            torch.set_num_threads(max(1, (os.cpu_count() or 1) // self.processes))
         try:
             self.setup()
         except Exception as e:
             self.logger.exception("setup failed")
             self.terminate.set()
+        # only wait for more tasks if they can share model calls
+        batch_size = self.batch_size if self.batchable() else 1
         while not self.terminate.is_set():
             try:
-                page_id, page_input = self.taskq.get(timeout=1.1)
+                tasks = [self.taskq.get(timeout=1.1)]
             except mp.queues.Empty:
                 continue
-            self.logger.debug("predicting '%s'", page_id)
             try:
-                page_output = self.predict(*page_input)
-            except Exception as e:
-                self.logger.error("prediction failed: %s", e.__class__.__name__)
-                page_output = e
-            self.resultq.put((page_id, page_output))
-            self.logger.debug("sent result for '%s'", page_id)
-        self.resultq.close()
-        self.resultq.cancel_join_thread()
+                depth = self.taskq.qsize() + 1
+            except NotImplementedError: # macOS
+                depth = 0
+            # gather more pending tasks (from other page workers) within a short window
+            deadline = time.monotonic() + self.batch_timeout
+            while len(tasks) < batch_size:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    tasks.append(self.taskq.get(timeout=timeout))
+                except mp.queues.Empty:
+                    break
+            replies, page_ids, page_inputs, sent = zip(*tasks)
+            shared = [x for page_input in page_inputs for x in page_input
+                      if isinstance(x, SharedImage)]
+            self.logger.debug("predicting %s", ", ".join(f"'{page_id}'" for page_id in page_ids))
+            start = time.time()
+            # attach each task's shared memory separately, so only the tasks
+            # whose blocks are gone (e.g. discarded) fail
+            errors = {}
+            opened = []
+            for idx, page_input in enumerate(page_inputs):
+                try:
+                    opened.append(tuple(x.open() if isinstance(x, SharedImage) else x
+                                        for x in page_input))
+                except Exception as e:
+                    self.logger.error("cannot open input for '%s': %s", page_ids[idx], e.__class__.__name__)
+                    errors[idx] = e
+            page_inputs = opened
+            page_outputs = []
+            if page_inputs:
+                try:
+                    page_outputs = self.predict_batch(page_inputs)
+                except Exception as e:
+                    self.logger.error("prediction failed: %s", e.__class__.__name__)
+                    page_outputs = [e] * len(page_inputs)
+            page_outputs = iter(page_outputs)
+            page_outputs = [errors[idx] if idx in errors else next(page_outputs)
+                            for idx in range(len(tasks))]
+            timings = {'predictor_batch_size': len(tasks),
+                       'predictor_queue_depth': depth}
+            for (slot, key), page_id, page_output, sent_ in zip(replies, page_ids, page_outputs, sent):
+                if isinstance(page_output, Iterator):
+                    page_output = self.send_chunks(self.replyqs[slot], key, page_output)
+                self.replyqs[slot].put((key, page_output,
+                                        dict(timings, model=time.time() - start,
+                                             queue=start - sent_, sent=time.time())))
+                self.logger.debug("sent result for '%s'", page_id)
+            # release views (also held by iterators) before detaching
+            del page_inputs, page_outputs, page_output, opened
+            for x in shared:
+                x.close()
+        for replyq in self.replyqs:
+            replyq.close()
+            replyq.cancel_join_thread()
         self.logger.debug("predictor terminated")
+    def send_chunks(self, replyq, key, page_output):
+        """
+        Exhaust the iterator ``page_output``, sending its items in chunks.
+        Return the final (empty) chunk or the exception raised while iterating.
+        """
+        chunk = ResultChunk()
+        try:
+            for item in page_output:
+                chunk.append(item)
+                if len(chunk) >= self.stream_size:
+                    replyq.put((key, chunk, None))
+                    chunk = ResultChunk()
+        except Exception as e:
+            self.logger.error("prediction failed: %s", e.__class__.__name__)
+            return e
+        if chunk:
+            replyq.put((key, chunk, None))
+        return ResultChunk()
     def setup(self):
         raise NotImplementedError()
     def predict(self, *inputs):
         raise NotImplementedError()
+    def batchable(self):
+        """
+        Whether :py:meth:`predict_batch` shares model calls across pages.
+
+        Otherwise, tasks are predicted one at a time as they arrive (so
+        idle processes of the pool can pick up the next one).
+        """
+        return type(self).predict_batch is not KrakenPredictor.predict_batch
+    def predict_batch(self, batch):
+        """
+        Predict a list of page inputs at once, returning a list of outputs
+        (or exceptions) in the same order.
+
+        (Override this to share model calls across pages: :py:meth:`batchable`
+        detects that automatically, and only needs overriding to opt out, e.g.
+        depending on parameters.)
+        """
+        outputs = []
+        for inputs in batch:
+            try:
+                outputs.append(self.predict(*inputs))
+            except Exception as e:
+                self.logger.error("prediction failed: %s", e.__class__.__name__)
+                outputs.append(e)
+        return outputs
     def shutdown(self):
         # do not terminate from forked processor instances
         if mp.parent_process() is None:
@@ -0,0 +1,135 @@
+import time
+from typing import Union
+
+import numpy as np
+import shapely
+from shapely.geometry import Polygon
+
+from ocrd_utils import getLogger
+
+from .metrics import current_metrics
+
+def repair_polygon(polygon):
+    """Make ``polygon`` valid with a bounded number of attempts.
+
+    Try the following strategies in turn, returning the first valid
+    polygon along with the name of the strategy:
+
+    - ``valid``: already valid, use as is
+    - ``make_valid``: split into valid parts along the self-intersections,
+      use the largest part if it keeps at least 90% of the area
+    - ``closing``: merge those parts (e.g. two halves of a pinched line)
+      by dilation and erosion with radius 1, 2 or 4 pixels
+    - ``simplify``: simplify with tolerances doubling from 1 pixel up to
+      the polygon's extent (i.e. logarithmically many attempts)
+    - ``convex_hull``: use the convex hull
+    - ``none``: degenerate (zero area), return unchanged
+    """
+    if polygon.is_valid:
+        return polygon, 'valid'
+    parts = [part for part in shapely.get_parts(shapely.make_valid(polygon))
+             if part.geom_type == 'Polygon' and not part.is_empty]
+    if parts:
+        largest = max(parts, key=lambda part: part.area)
+        if largest.area >= 0.9 * sum(part.area for part in parts):
+            return Polygon(largest.exterior), 'make_valid'
+        parts = shapely.MultiPolygon(parts)
+        for radius in (1, 2, 4):
+            closed = parts.buffer(radius, quad_segs=1).buffer(-radius, quad_segs=1).simplify(radius / 2)
+            if closed.geom_type == 'Polygon' and closed.is_valid:
+                return Polygon(closed.exterior), 'closing'
+    minx, miny, maxx, maxy = polygon.bounds
+    extent = max(maxx - minx, maxy - miny)
+    tolerance = 1
+    while tolerance < extent:
+        simplified = polygon.simplify(tolerance)
+        if simplified.geom_type == 'Polygon' and simplified.is_valid and not simplified.is_empty:
+            return simplified, 'simplify'
+        tolerance *= 2
+    hull = polygon.convex_hull
+    if hull.geom_type == 'Polygon':
+        return hull, 'convex_hull'
+    return polygon, 'none'
+
+def make_valid(polygon):
+    """Repair ``polygon`` (see :py:func:`repair_polygon`), reporting the strategy and its duration."""
+    start = time.perf_counter()
+    polygon, strategy = repair_polygon(polygon)
+    if strategy != 'valid':
+        duration = time.perf_counter() - start
+        getLogger('ocrd.kraken.geometry').debug("repaired polygon via %s in %.1f ms",
+                                               strategy, 1000 * duration)
+        metrics = current_metrics()
+        metrics.add('repair', duration)
+        metrics.count(f'repair_{strategy}')
+    return polygon
+
+def make_valid_all(polygons):
+    """Repair a list of polygons (checking the validity of all at once)."""
+    polygons = list(polygons)
+    if not polygons:
+        return polygons
+    geometries = np.empty(len(polygons), dtype=object)
+    geometries[:] = polygons
+    for idx in np.flatnonzero(~shapely.is_valid(geometries)):
+        polygons[idx] = make_valid(polygons[idx])
+    return polygons
+
+def polygon_distances(polygons, dense_max=16):
+    """Distance graph of ``polygons`` sufficient for a minimum spanning tree.
+
+    For few polygons, return the full (dense) distance matrix. Otherwise,
+    query an STRtree for all pairs within some radius, doubling it until
+    the graph is connected (so its spanning tree is the same as the full
+    graph's), and return a sparse matrix. Touching pairs get a tiny positive
+    distance, so they still count as edges.
+    """
+    from scipy.sparse import csr_matrix
+    from scipy.sparse.csgraph import connected_components
+    npoly = len(polygons)
+    if npoly <= dense_max:
+        dists = shapely.distance(polygons[:, np.newaxis], polygons[np.newaxis, :])
+        dists = np.maximum(dists, 1e-5)
+        np.fill_diagonal(dists, 0)
+        return dists
+    tree = shapely.STRtree(polygons)
+    _, radius = tree.query_nearest(polygons, exclusive=True, return_distance=True)
+    radius = max(radius.max(), 1.0)
+    while True:
+        prevs, nexts = tree.query(polygons, predicate='dwithin', distance=radius)
+        pairs = prevs < nexts
+        prevs, nexts = prevs[pairs], nexts[pairs]
+        dists = csr_matrix((np.maximum(shapely.distance(polygons[prevs], polygons[nexts]), 1e-5),
+                            (prevs, nexts)), shape=(npoly, npoly))
+        if connected_components(dists, directed=False, return_labels=False) == 1:
+            return dists
+        radius *= 2
+
+def join_polygons(polygons, loc='', scale : Union[float, np.floating] = 20):
+    """construct concave hull (alpha shape) from input polygons"""
+    # compoundp = unary_union(polygons)
+    # jointp = compoundp.convex_hull
+    polygons = shapely.get_parts(np.array(polygons, dtype=object))
+    npoly = len(polygons)
+    if npoly == 1:
+        return polygons[0]
+    if npoly == 2:
+        # the only spanning tree
+        prevps, nextps = polygons[:1], polygons[1:]
+    else:
+        from scipy.sparse.csgraph import minimum_spanning_tree
+        # find min-dist path through all polygons (travelling salesman)
+        dists = polygon_distances(polygons)
+        dists = minimum_spanning_tree(dists, overwrite=True)
+        prevps, nextps = dists.nonzero()
+        prevps, nextps = polygons[prevps], polygons[nextps]
+    # add bridge polygons (where necessary)
+    bridgeps = shapely.buffer(shapely.shortest_line(prevps, nextps), max(1, scale/5), quad_segs=1)
+    jointp = shapely.union_all(np.concatenate([polygons, bridgeps]))
+    assert jointp.geom_type == 'Polygon', jointp.wkt
+    if jointp.minimum_clearance < 1.0:
+        # follow-up calculations will necessarily be integer;
+        # so anticipate rounding here and then ensure validity
+        jointp = Polygon(np.round(jointp.exterior.coords))
+        jointp = make_valid(jointp)
+    return jointp
@@ -0,0 +1,155 @@
+import os
+import json
+import time
+import tempfile
+import threading
+from functools import wraps
+from collections import defaultdict
+
+from ocrd_utils import config
+
+config.add('OCRD_KRAKEN_METRICS',
+           description="Path of a file to write per-page stage durations, predictor queue depths "
+           "and line/region counts to (as Prometheus text format at shutdown if the path ends "
+           "with `.prom`, otherwise as JSON lines while processing).",
+           default=(True, ''))
+
+_local = threading.local()
+
+class PageMetrics:
+    """
+    Per-page record of durations (in seconds) for each processing stage,
+    counts (summed) and gauges (maximum).
+    """
+    def __init__(self, processor=None, page_id=None):
+        self.processor = processor
+        self.page_id = page_id
+        self.stages = defaultdict(float)
+        self.counts = defaultdict(int)
+        self.gauges = {}
+        self.start = self.last = time.perf_counter()
+    def lap(self, stage):
+        """Attribute the time since the last lap (or the start) to ``stage``."""
+        now = time.perf_counter()
+        self.stages[stage] += now - self.last
+        self.last = now
+    def add(self, stage, duration):
+        self.stages[stage] += duration
+    def count(self, name, value=1):
+        self.counts[name] += value
+    def gauge(self, name, value):
+        self.gauges[name] = max(value, self.gauges.get(name, value))
+    def merge(self, record):
+        """Add the stages, counts and gauges of another ``record`` (as from :py:meth:`to_dict`)."""
+        for stage, duration in record['stages'].items():
+            self.add(stage, duration)
+        for name, value in record['counts'].items():
+            self.count(name, value)
+        for name, value in record['gauges'].items():
+            self.gauge(name, value)
+    def to_dict(self):
+        return {'processor': self.processor,
+                'page_id': self.page_id,
+                'pid': os.getpid(),
+                'total': time.perf_counter() - self.start,
+                'stages': dict(self.stages),
+                'counts': dict(self.counts),
+                'gauges': self.gauges}
+
+def current_metrics():
+    """Get the metrics of the page currently processed (or a throwaway record)."""
+    metrics = getattr(_local, 'metrics', None)
+    if metrics is None:
+        return PageMetrics()
+    return metrics
+
+def set_current_metrics(metrics):
+    """Make ``metrics`` the record of the page currently processed in this thread (or none)."""
+    _local.metrics = metrics
+
+def page_metrics(process_page_pcgts):
+    """Decorate ``process_page_pcgts`` to record metrics for each page (if enabled)."""
+    @wraps(process_page_pcgts)
+    def wrapper(self, *input_pcgts, page_id=None):
+        _local.metrics = PageMetrics(self.executable, page_id)
+        try:
+            return process_page_pcgts(self, *input_pcgts, page_id=page_id)
+        finally:
+            metrics, _local.metrics = _local.metrics, None
+            # (the processor's own output, even if another instance was set up since)
+            output = getattr(self, 'metrics_output', None)
+            if output:
+                with open(output['records'], 'a', encoding='utf-8') as records:
+                    # one write per record, so concurrent appends do not interleave
+                    records.write(json.dumps(metrics.to_dict()) + '\n')
+    return wrapper
+
+def start_metrics():
+    """
+    Prepare writing metrics to ``OCRD_KRAKEN_METRICS`` (if set).
+
+    Return the output settings, to be kept as the processor's ``metrics_output``
+    (where :py:func:`page_metrics` writes to) and passed to :py:func:`finish_metrics`.
+    """
+    path = config.OCRD_KRAKEN_METRICS
+    output = {}
+    if not path:
+        return output
+    output['path'] = path
+    if path.endswith('.prom'):
+        fd, output['records'] = tempfile.mkstemp(suffix='.jsonl', prefix='ocrd-kraken-metrics')
+        os.close(fd)
+    else:
+        output['records'] = path
+    return output
+
+def finish_metrics(output):
+    """Aggregate metrics recorded with ``output`` into the Prometheus file (if requested)."""
+    if not output:
+        return
+    path, records = output['path'], output['records']
+    # (so shutting down again does nothing)
+    output.clear()
+    if path == records:
+        return
+    with open(records, encoding='utf-8') as lines:
+        records_ = [json.loads(line) for line in lines]
+    os.unlink(records)
+    with open(path, 'w', encoding='utf-8') as prom:
+        prom.write(metrics_to_prometheus(records_))
+
+def metrics_to_prometheus(records):
+    """Aggregate a list of page metrics records into Prometheus text format."""
+    pages = defaultdict(int)
+    stages = defaultdict(lambda: [0.0, 0])
+    counts = defaultdict(int)
+    gauges = defaultdict(float)
+    for record in records:
+        processor = record['processor']
+        pages[processor] += 1
+        for stage, duration in list(record['stages'].items()) + [('total', record['total'])]:
+            stages[processor, stage][0] += duration
+            stages[processor, stage][1] += 1
+        for name, value in record['counts'].items():
+            counts[processor, name] += value
+        for name, value in record['gauges'].items():
+            gauges[processor, name] = max(gauges[processor, name], value)
+    lines = ['# HELP ocrd_kraken_pages_total Number of pages processed',
+             '# TYPE ocrd_kraken_pages_total counter']
+    lines += [f'ocrd_kraken_pages_total{{processor="{processor}"}} {value}'
+              for processor, value in pages.items()]
+    lines += ['# HELP ocrd_kraken_stage_seconds Time spent per page in each processing stage',
+              '# TYPE ocrd_kraken_stage_seconds summary']
+    for (processor, stage), (total, number) in stages.items():
+        labels = f'processor="{processor}",stage="{stage}"'
+        lines += [f'ocrd_kraken_stage_seconds_sum{{{labels}}} {total:.6f}',
+                  f'ocrd_kraken_stage_seconds_count{{{labels}}} {number}']
+    lines += ['# HELP ocrd_kraken_items_total Number of items (like regions or lines) processed',
+              '# TYPE ocrd_kraken_items_total counter']
+    lines += [f'ocrd_kraken_items_total{{processor="{processor}",item="{name}"}} {value}'
+              for (processor, name), value in counts.items()]
+    lines += ['# HELP ocrd_kraken_max Maximum observed value (like predictor queue depth)',
+              '# TYPE ocrd_kraken_max gauge']
+    lines += [f'ocrd_kraken_max{{processor="{processor}",name="{name}"}} {value}'
+              for (processor, name), value in gauges.items()]
+    return '\n'.join(lines) + '\n'
@@ -1,15 +1,16 @@
 from typing import Optional, Union
 from ocrd.processor.base import OcrdPageResult
-import regex
+import json
+import time
 import itertools
+from functools import partial
 from collections import defaultdict
 import numpy as np
-from scipy.sparse.csgraph import minimum_spanning_tree
 from shapely.geometry import Polygon, LineString, box as Rectangle
-from shapely.ops import unary_union, nearest_points
 
 from ocrd import Processor
 from ocrd_utils import (
+    config,
     coordinates_of_segment,
     coordinates_for_segment,
     bbox_from_polygon,
@@ -18,6 +19,7 @@ from ocrd_utils import (
     polygon_from_points,
     xywh_from_points,
     transform_coordinates,
+    shift_coordinates,
 )
 from ocrd_models.ocrd_page import (
     OcrdPage,
@@ -38,7 +40,27 @@ from ocrd_models.ocrd_page_generateds import (
     TextLineOrderSimpleType
 )
 
-from .common import KrakenPredictor
+from .common import (
+    KrakenPredictor, make_predictor, optimize_model, model_checksum, preload,
+    text_sample, best_path)
+from .cache import LineCache, CachedRecord, line_key
+from .rpred import batch_rpred, ensemble_rpred
+from .geometry import make_valid, make_valid_all, join_polygons
+from .metrics import page_metrics, current_metrics, start_metrics, finish_metrics
+
+config.add('OCRD_KRAKEN_PIPELINE_LINES',
+           description="Number of lines per chunk for pipelined recognition: while one chunk "
+           "is in the model, the next chunk is prepared and the results of the previous one "
+           "are annotated (0 means recognizing each page in one chunk).",
+           parser=int,
+           default=(True, 0))
+
+config.add('OCRD_KRAKEN_LINE_BATCH_SIZE',
+           description="Number of lines (of similar width) to pass through the recognition model "
+           "at once, also pooling the lines of pages predicted together (0 means one line at a "
+           "time, via Kraken's mm_rpred).",
+           parser=int,
+           default=(True, 0))
 
 class KrakenRecognizePredictor(KrakenPredictor):
     # workaround for Kraken's unpicklable defaultdict choice
@@ -48,28 +70,153 @@ class KrakenRecognizePredictor(KrakenPredictor):
             super().__init__()
         def default_factory(self):
             return self.default
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.line_batch_size = config.OCRD_KRAKEN_LINE_BATCH_SIZE
     def setup(self):
         import torch
-        from kraken.lib.models import load_any
-        model = self.parameter['model']
-        self.logger.info("loading model '%s'", model)
         device = self.parameter['device']
         if device != 'cpu' and not torch.cuda.is_available():
             device = 'cpu'
         if device == 'cpu':
             self.logger.warning("no CUDA device available. Running without GPU will be slow")
-        self.model = load_any(model, device=device)
+        self.device = device
+        # paths of the models actually replaced by a CPU-optimized copy
+        self.optimized = set()
+        self.model = self.load_model(self.parameter['model'], device)
+        self.fallback = None
+        if self.parameter['fallback_model']:
+            self.fallback = self.load_model(self.parameter['fallback_model'], device)
+        self.extra_models = [self.load_model(model, device) for model in self.parameter['extra_models']]
+        for model in filter(None, [self.fallback] + self.extra_models):
+            if self.is_binary(model) != self.is_binary(self.model):
+                self.logger.warning("%s model expects %s input, but will get the primary model's",
+                                    "fallback" if model is self.fallback else "extra",
+                                    "binarized" if self.is_binary(model) else "grayscale")
+    def load_model(self, model, device):
+        import torch
+        from kraken.lib.models import load_any
+        self.logger.info("loading model '%s'", model)
+        net = load_any(model, device=device)
+        if device == 'cpu' and self.parameter['cpu_optimization'] != 'none':
+            from kraken.lib.dataset import ImageInputTransforms
+            batch, channels, height, width = net.nn.input
+            image = text_sample(height or 48)
+            if self.is_binary(net):
+                image = image.convert('1')
+            transforms = ImageInputTransforms(batch, height, width, channels, (16, 0), False)
+            sample = transforms(image).unsqueeze(0)
+            if hasattr(net, 'temperature'):
+                # Kraken v6+ networks output logits (softmax applied by the recognizer)
+                activation = partial(torch.softmax, dim=1)
+            else:
+                activation = None
+            optimized = optimize_model(net.nn.nn, model,
+                                       self.parameter['cpu_optimization'],
+                                       sample, self.logger, activation=activation,
+                                       labels=best_path)
+            if optimized is not net.nn.nn:
+                self.optimized.add(model)
+            net.nn.nn = optimized
+        return net
+    @staticmethod
+    def is_binary(model):
+        return model.nn.input[1] == 1 and model.one_channel_mode == '1'
     def predict(self, *inputs):
-        from kraken.rpred import mm_rpred
         if not len(inputs):
-            return self.model.nn.input[1] == 1 and self.model.one_channel_mode == '1'
+            # (device and optimized models as actually used, for the line cache)
+            return self.is_binary(self.model), self.device, sorted(self.optimized)
         image, segmentation = inputs
-        nets = __class__.DefaultDict(self.model)
-        result = mm_rpred(nets, image, segmentation,
-                          self.parameter['pad'],
-                          self.parameter['bidi_reordering'])
-        # we must exhaust the generator before enqueuing
-        return list(result)
+        if self.extra_models:
+            return self.ensemble(image, segmentation)
+        # records get streamed back while the iterator is exhausted
+        records = self.recognize(self.model, image, segmentation)
+        if self.fallback:
+            records = (record for record, _ in self.cascade(image, segmentation, records))
+        return records
+    def ensemble(self, image, segmentation):
+        """
+        Recognize the lines of ``segmentation`` with the primary and all extra models,
+        sharing line extraction among them.
+
+        Return an iterator over tuples of the primary record, whether the fallback
+        model produced it (instead of the primary model), and the records of the
+        extra models.
+        """
+        results = ensemble_rpred([self.model] + self.extra_models, image, segmentation,
+                                 self.parameter['pad'],
+                                 self.parameter['bidi_reordering'],
+                                 max(1, self.line_batch_size))
+        records = ((result[0], False) for result in results)
+        if self.fallback:
+            records = self.cascade(image, segmentation, (result[0] for result in results))
+        return ((record, fallback, result[1:]) for (record, fallback), result in zip(records, results))
+    def batchable(self):
+        # only batched line recognition pools the lines of several pages
+        return bool(self.line_batch_size) and not self.parameter.get('extra_models')
+    def predict_batch(self, batch):
+        if not self.line_batch_size or self.extra_models or len(batch) < 2 or not all(batch):
+            return super().predict_batch(batch)
+        # pool the lines of all pages
+        try:
+            results = batch_rpred(self.model, batch,
+                                  self.parameter['pad'],
+                                  self.parameter['bidi_reordering'],
+                                  self.line_batch_size)
+        except Exception as e:
+            self.logger.warning("batched prediction failed (%s), retrying page by page",
+                                e.__class__.__name__)
+            return super().predict_batch(batch)
+        outputs = []
+        for (image, segmentation), records in zip(batch, results):
+            records = iter(records)
+            if self.fallback:
+                records = (record for record, _ in self.cascade(image, segmentation, records))
+            outputs.append(records)
+        return outputs
+    def recognize(self, model, image, segmentation):
+        from kraken.rpred import mm_rpred
+        if self.line_batch_size:
+            return iter(batch_rpred(model, [(image, segmentation)],
+                                    self.parameter['pad'],
+                                    self.parameter['bidi_reordering'],
+                                    self.line_batch_size)[0])
+        nets = __class__.DefaultDict(model)
+        return iter(mm_rpred(nets, image, segmentation,
+                             self.parameter['pad'],
+                             self.parameter['bidi_reordering']))
+    def cascade(self, image, segmentation, records):
+        """
+        Re-recognize the lines of ``segmentation`` whose ``records`` have a
+        mean confidence below ``fallback_threshold`` with the fallback model.
+
+        Collect up to ``stream_size`` records at a time (so results are still
+        streamed back in order), and pass their uncertain lines to the fallback
+        model all at once.
+
+        Return an iterator over the records, each paired with whether
+        the fallback model produced it.
+        """
+        from dataclasses import replace
+        threshold = self.parameter['fallback_threshold']
+        lines = iter(segmentation.lines)
+        while True:
+            batch = list(itertools.islice(zip(lines, records), self.stream_size))
+            if not batch:
+                return
+            uncertain = [idx for idx, (_, record) in enumerate(batch)
+                         if not len(record.confidences) or
+                         sum(record.confidences) / len(record.confidences) < threshold]
+            fallbacks = [False] * len(batch)
+            if uncertain:
+                self.logger.debug("re-recognizing %d of %d lines with fallback model",
+                                  len(uncertain), len(batch))
+                fallback = self.recognize(self.fallback, image, replace(
+                    segmentation, lines=[batch[idx][0] for idx in uncertain]))
+                for idx, record in zip(uncertain, fallback):
+                    batch[idx] = batch[idx][0], record
+                    fallbacks[idx] = True
+            yield from ((record, replaced) for (_, record), replaced in zip(batch, fallbacks))
 
 class KrakenRecognize(Processor):
 
@@ -81,18 +228,57 @@ class KrakenRecognize(Processor):
         """
         Load model, set predict function
         """
+        self.metrics_output = start_metrics()
+        # lines are converted to (and records unpickled from) Kraken containers,
+        # split into words with regex and joined (for word polygons) with scipy
+        preload('kraken.containers', 'regex', 'scipy.sparse.csgraph')
         parameter = dict(self.parameter)
         parameter['model'] = self.resolve_resource(parameter['model'])
-        self.predictor = KrakenRecognizePredictor(self.logger, parameter)
+        if parameter['fallback_model']:
+            parameter['fallback_model'] = self.resolve_resource(parameter['fallback_model'])
+        # (as given, for recording in the TextEquivs)
+        self.model_names = [self.parameter['model']] + list(self.parameter['extra_models'])
+        parameter['extra_models'] = [self.resolve_resource(model) for model in parameter['extra_models']]
+        # (only relevant for selecting lines, not for the predictor)
+        self.incremental = parameter.pop('incremental')
+        self.incremental_threshold = parameter.pop('incremental_threshold')
+        if self.incremental and parameter['overwrite_text']:
+            self.logger.warning("ignoring incremental mode, because overwrite_text is set")
+            self.incremental = False
+        self.predictor = make_predictor(KrakenRecognizePredictor, self.logger, parameter,
+                                        processes=parameter.pop('predictor_processes'))
         self.predictor.start()
-        self.binary = self.predictor("") # blocks until model is loaded
+        self.cache = None
+        if config.OCRD_KRAKEN_LINE_CACHE and parameter['extra_models']:
+            self.logger.warning("not using the line cache, because extra_models are set")
+        elif config.OCRD_KRAKEN_LINE_CACHE:
+            self.cache = LineCache(config.OCRD_KRAKEN_LINE_CACHE, config.OCRD_KRAKEN_LINE_CACHE_SIZE)
+        # blocks until model is loaded
+        self.binary, device, optimized = self.predictor("")
+        if self.cache is not None:
+            # everything besides the line itself that determines the result
+            # (including device and CPU optimization, which change the model's numerics
+            # - as actually used by the predictor, e.g. after falling back to the CPU)
+            def optimization(model):
+                return parameter['cpu_optimization'] if model in optimized else 'none'
+            self.cache_prefix = json.dumps([model_checksum(parameter['model']),
+                                            parameter['pad'], parameter['bidi_reordering'],
+                                            device, optimization(parameter['model'])] +
+                                           ([model_checksum(parameter['fallback_model']),
+                                             parameter['fallback_threshold'],
+                                             optimization(parameter['fallback_model'])]
+                                            if parameter['fallback_model'] else []))
         self.logger.info("loaded %s model %s", "binary" if self.binary else "grayscale", self.parameter["model"])
 
     def shutdown(self):
         if getattr(self, 'predictor', None):
             self.predictor.shutdown()
             del self.predictor
+        if getattr(self, 'cache', None):
+            self.cache.close()
+        finish_metrics(getattr(self, 'metrics_output', None))
 
+    @page_metrics
     def process_page_pcgts(self, *input_pcgts: Optional[OcrdPage], page_id: Optional[str] = None) -> OcrdPageResult:
         """Recognize text on lines with Kraken.
 
@@ -111,23 +297,53 @@ class KrakenRecognize(Processor):
         into additional TextEquiv at each level, and make the higher levels
         consistent with that (by concatenation joined by whitespace).
 
+        If ``fallback_model`` is set, then recognize lines whose mean confidence
+        is below ``fallback_threshold`` again with that model (in a second pass
+        in the predictor), and use its result instead.
+
+        If ``extra_models`` are set, then also recognize each line with these
+        models (sharing line extraction), and add their results as further
+        TextEquivs on the line level, numbered by ``index`` and naming the
+        model in ``comments`` (like the primary model's result).
+
+        If ``incremental`` (and not ``overwrite_text``), then only recognize
+        lines without text (or whose TextEquivs all have a confidence below
+        ``incremental_threshold``), replacing their TextEquivs and Words, and
+        leaving all other lines unchanged. (If there
+        are no such lines, then do not even load the page image.)
+
+        If ``OCRD_KRAKEN_PIPELINE_LINES`` is set, then recognize the lines
+        in chunks of that size, overlapping the preparation of each chunk
+        and the annotation of its predecessor with model inference.
+
+        If ``OCRD_KRAKEN_LINE_CACHE`` is set, then only recognize lines
+        whose image, geometry, model and parameters are not in the cache
+        yet, and store their results there.
+
         Return the resulting hierarchy.
         """
         assert self.workspace
-        from kraken.containers import Segmentation, BaselineLine, BBoxLine
-
+        metrics = current_metrics()
         pcgts = input_pcgts[0]
         assert pcgts
         page = pcgts.get_Page()
         assert page
+        all_lines = page.get_AllTextLines()
+        todo_lines = all_lines
+        if self.incremental:
+            todo_lines = [line for line in all_lines
+                          if line_needs_text(line, self.incremental_threshold)]
+            self.logger.info("Recognizing %d of %d lines (incremental)", len(todo_lines), len(all_lines))
+            metrics.count('lines_skipped', len(all_lines) - len(todo_lines))
+            if not todo_lines:
+                return OcrdPageResult(pcgts)
         page_image, page_coords, _ = self.workspace.image_from_page(
             page, page_id,
             feature_selector="binarized"
             if self.binary else '')
-        page_rect = Rectangle(0, 0, page_image.width - 1, page_image.height - 1)
+        metrics.lap('image')
         # TODO: find out whether kraken.lib.xml.XMLPage(...).to_container() is adequate
 
-        all_lines = page.get_AllTextLines()
         # assumes that missing baselines are rare, if any
         if any(line.Baseline for line in all_lines):
             self.logger.info("Converting PAGE to Kraken Segmentation (baselines)")
@@ -137,13 +353,56 @@ class KrakenRecognize(Processor):
             segtype = 'bbox'
         scale = 0.5 * np.median([xywh_from_points(line.Coords.points)['h'] for line in all_lines])
         self.logger.info("Estimated scale: %.1f", scale)
-        seglines = []
-        for line in all_lines:
+        chunk_size = config.OCRD_KRAKEN_PIPELINE_LINES or len(todo_lines) or 1
+        chunks = [todo_lines[idx:idx + chunk_size] for idx in range(0, len(todo_lines), chunk_size)]
+        # pipelining: while one chunk of lines is in the model, convert the next chunk
+        # to a Kraken segmentation, and build the PAGE elements of the previous chunk
+        queued = []
+        recognized = 0
+        try:
+            for lines in chunks + [None]:
+                if lines:
+                    queued.append(self.submit_lines(page_id, page_image, page_coords, lines, segtype, scale,
+                                                    crop=len(chunks) > 1 or len(todo_lines) < len(all_lines)))
+                    metrics.lap('segmentation')
+                    metrics.count('lines', len(lines))
+                if len(queued) > 1 or queued and not lines:
+                    recognized += self.add_results(*queued.pop(0))
+        finally:
+            for _, _, task, _ in queued:
+                if task is not None:
+                    self.predictor.discard(task)
+        if recognized:
+            page_update_higher_textequiv_levels('line', pcgts)
+            metrics.lap('textequiv')
+
+        self.logger.info("Finished recognition, serializing")
+        return OcrdPageResult(pcgts)
+
+    def submit_lines(self, page_id, page_image, page_coords, lines, segtype, scale, crop=False):
+        """Convert ``lines`` to a Kraken segmentation and send it to the predictor.
+
+        Repair line polygons and baselines (writing them back to the PAGE
+        elements). If ``crop``, then only send the part of the page image
+        covered by ``lines``. If caching, then only send lines not found
+        in the cache.
+
+        Return the lines, the coordinate transform of the image sent,
+        the predictor task (without waiting for its result, or None if
+        all lines were cached), and for each line its cached record, or
+        the cache key and cut offset to store its result under, or None.
+        """
+        from kraken.containers import Segmentation, BaselineLine, BBoxLine
+
+        page_rect = Rectangle(0, 0, page_image.width - 1, page_image.height - 1)
+        geometries = []
+        polys = make_valid_all(Polygon(coordinates_of_segment(line, None, page_coords))
+                               for line in lines)
+        for line, poly in zip(lines, polys):
             # FIXME: see whether model prefers baselines or bbox crops (seg_type)
             # FIXME: even if we do not have baselines, emulating baseline+boundary might be useful to prevent automatic center normalization
-            poly = coordinates_of_segment(line, None, page_coords)
-            poly = make_valid(Polygon(poly))
             poly = poly.intersection(page_rect)
+            base = None
             if segtype == 'baselines':
                 if line.Baseline is None:
                     base = dummy_baseline_of_segment(line, page_coords)
@@ -160,87 +419,264 @@ class KrakenRecognize(Processor):
                 elif not base.within(poly):
                     poly = join_polygons([poly, polygon_from_baseline(base, scale=scale)],
                                          loc=line.id, scale=scale)
-                seglines.append(BaselineLine(baseline=list(map(tuple, base.coords)),
-                                             boundary=list(map(tuple, poly.exterior.coords)),
+                # write back
+                line.set_Baseline(BaselineType(points=points_from_polygon(
+                    coordinates_for_segment(base.coords, None, page_coords))))
+                line.set_Coords(CoordsType(points=points_from_polygon(
+                    coordinates_for_segment(poly.exterior.coords[:-1], None, page_coords))))
+            geometries.append((line, base, poly))
+
+        image, coords = page_image, page_coords
+        offset = np.zeros(2)
+        if crop:
+            bounds = np.array([poly.bounds for _, _, poly in geometries if not poly.is_empty])
+            if len(bounds):
+                xmin, ymin = np.maximum(0, np.floor(bounds[:, :2].min(axis=0) - scale)).astype(int)
+                # (PIL would pad crops beyond the image with black)
+                xmax, ymax = np.minimum(page_image.size,
+                                        np.ceil(bounds[:, 2:].max(axis=0) + scale)).astype(int)
+                image = page_image.crop((xmin, ymin, xmax, ymax))
+                offset = np.array([xmin, ymin])
+                coords = dict(page_coords, transform=shift_coordinates(page_coords['transform'], -offset))
+        cached = self.lookup_lines(page_image, geometries, segtype, offset)
+        seglines = []
+        for (line, base, poly), entry in zip(geometries, cached):
+            if isinstance(entry, CachedRecord):
+                continue
+            if segtype == 'baselines':
+                base, poly = base.coords, poly.exterior.coords
+                if offset.any():
+                    base, poly = np.array(base) - offset, np.array(poly) - offset
+                seglines.append(BaselineLine(baseline=list(map(tuple, base)),
+                                             boundary=list(map(tuple, poly)),
                                              id=line.id,
                                              tags={'type': 'default'}))
-                # write back
-                base = coordinates_for_segment(base.coords, None, page_coords)
-                line.set_Baseline(BaselineType(points=points_from_polygon(base)))
-                poly = coordinates_for_segment(poly.exterior.coords[:-1], None, page_coords)
-                line.set_Coords(CoordsType(points=points_from_polygon(poly)))
             else:
-                seglines.append(BBoxLine(bbox=poly.envelope.bounds,
+                bbox = poly.envelope.bounds
+                if offset.any():
+                    bbox = tuple(np.array(bbox) - np.tile(offset, 2))
+                seglines.append(BBoxLine(bbox=bbox,
                                          id=line.id))
-
+        if not seglines:
+            return lines, coords, None, cached
         segmentation = Segmentation(lines=seglines,
                                     script_detection=False,
                                     text_direction='horizontal-lr',
                                     type=segtype,
                                     imagename=page_id)
-        for idx_line, ocr_record in enumerate(self.predictor(page_id, page_image, segmentation)):
-            line = all_lines[idx_line]
-            id_line = line.id
-            if not ocr_record.prediction and not ocr_record.cuts:
-                self.logger.warning('No results for line "%s"', line.id)
+        return lines, coords, self.predictor.submit(page_id, image, segmentation), cached
+
+    def lookup_lines(self, page_image, geometries, segtype, offset):
+        """Look up the results for ``geometries`` in the line cache (if any).
+
+        Key each line by the page image cropped to its bounding box and the
+        baseline and boundary (or box) relative to that. Return a list of
+        the cached record (with cuts relative to the image sent, i.e. shifted
+        by ``offset``) for hits, and cache key and shift for misses.
+        """
+        if not self.cache:
+            return [None] * len(geometries)
+        start = time.perf_counter()
+        keys = []
+        for _, base, poly in geometries:
+            if poly.is_empty:
+                keys.append(None)
                 continue
-            text_line = ocr_record.prediction
-            if len(ocr_record.confidences) > 0:
-                conf_line = sum(ocr_record.confidences) / len(ocr_record.confidences)
+            xmin, ymin = np.maximum(0, np.floor(poly.bounds[:2])).astype(int)
+            xmax, ymax = np.minimum(page_image.size, np.ceil(poly.bounds[2:])).astype(int)
+            origin = np.array([xmin, ymin])
+            if segtype == 'baselines':
+                geometry = (np.array(base.coords) - origin, np.array(poly.exterior.coords) - origin)
             else:
-                conf_line = None
-            if self.parameter['overwrite_text']:
-                line.TextEquiv = []
-            line.add_TextEquiv(TextEquivType(Unicode=text_line, conf=conf_line))
-            idx_word = 0
-            line_offset = 0
-            for text_word in regex.splititer(r'(\s+)', text_line):
-                next_offset = line_offset + len(text_word)
-                cuts_word = list(map(list, ocr_record.cuts[line_offset:next_offset]))
-                # fixme: kraken#98 says the Pytorch CTC output is too impoverished to yield good glyph stops
-                # as a workaround, here we just steal from the next glyph start, respectively:
-                if len(ocr_record.cuts) > next_offset + 1:
-                    cuts_word.extend(list(map(list, ocr_record.cuts[next_offset:next_offset+1])))
-                else:
-                    cuts_word.append(list(ocr_record.cuts[-1]))
-                confidences_word = ocr_record.confidences[line_offset:next_offset]
-                line_offset = next_offset
-                if len(text_word.strip()) == 0:
+                geometry = (np.array(poly.envelope.bounds) - np.tile(origin, 2),)
+            keys.append((line_key(self.cache_prefix + segtype,
+                                  page_image.crop((xmin, ymin, xmax, ymax)), *geometry),
+                         origin - offset))
+        found = self.cache.get(key for key, _ in filter(None, keys))
+        cached = []
+        for entry in keys:
+            if entry and entry[0] in found:
+                record = found[entry[0]]
+                cached.append(record._replace(cuts=[(np.array(cut) + entry[1]).tolist()
+                                                    for cut in record.cuts]))
+            else:
+                cached.append(entry)
+        nhits = sum(isinstance(entry, CachedRecord) for entry in cached)
+        metrics = current_metrics()
+        metrics.count('cache_hits', nhits)
+        metrics.count('cache_misses', len(cached) - nhits)
+        metrics.add('cache', time.perf_counter() - start)
+        return cached
+
+    def merge_cached(self, chunks, cached):
+        """Interleave the streamed ``chunks`` of predicted records with the
+        cached records (in line order), storing the former in the cache."""
+        idx = 0
+        def hits():
+            nonlocal idx
+            records = []
+            while idx < len(cached) and isinstance(cached[idx], CachedRecord):
+                records.append(cached[idx])
+                idx += 1
+            return records
+        for ocr_records in chunks:
+            records = []
+            store = {}
+            for ocr_record in ocr_records:
+                records.extend(hits())
+                entry = cached[idx]
+                idx += 1
+                if entry:
+                    # (Kraken computes cut polygons anew on each access)
+                    key, shift = entry
+                    ocr_record = CachedRecord(ocr_record.prediction,
+                                              [np.array(cut).tolist() for cut in ocr_record.cuts],
+                                              ocr_record.confidences)
+                    store[key] = (ocr_record.prediction,
+                                  [(np.array(cut) - shift).tolist() for cut in ocr_record.cuts],
+                                  [float(conf) for conf in ocr_record.confidences])
+                records.append(ocr_record)
+            self.cache.put(store)
+            yield records
+        records = hits()
+        if records:
+            yield records
+
+    def add_results(self, lines, coords, task, cached):
+        """Wait for the predictor ``task`` and annotate its results on ``lines``
+        (along with the ``cached`` ones).
+
+        Return the number of lines with results.
+        """
+        import regex
+
+        metrics = current_metrics()
+        recognized = 0
+        lines = iter(lines)
+        chunks = self.predictor.stream(task) if task is not None else []
+        if self.cache is not None:
+            chunks = self.merge_cached(chunks, cached)
+        # annotate records while the next ones are still being predicted
+        for ocr_records in chunks:
+            metrics.lap('predict')
+            if self.model_names[1:]:
+                ocr_records, fallbacks, alternatives = zip(*ocr_records)
+            else:
+                fallbacks = [False] * len(ocr_records)
+                alternatives = [()] * len(ocr_records)
+            # (Kraken computes cut polygons anew on each access)
+            cuts = [ocr_record.cuts for ocr_record in ocr_records]
+            # transform all cuts at once, then split by line again
+            bboxes = np.split(bboxes_for_polygons([cut for cuts_line in cuts for cut in cuts_line], coords),
+                              np.cumsum([len(cuts_line) for cuts_line in cuts])[:-1])
+            # (records first, so zip does not consume an extra line)
+            for ocr_record, fallback, alternatives_line, cuts_line, bboxes_line, line in zip(
+                    ocr_records, fallbacks, alternatives, cuts, bboxes, lines):
+                id_line = line.id
+                if not ocr_record.prediction and not cuts_line:
+                    self.logger.warning('No results for line "%s"', line.id)
                     continue
-                id_word = '%s_word_%s' % (id_line, idx_word + 1)
-                idx_word += 1
-                poly_word = [point for cut in cuts_word for point in cut]
-                bbox_word = bbox_from_polygon(coordinates_for_segment(poly_word, None, page_coords))
-                # avoid zero-size coords on ties
-                bbox_word = np.array(bbox_word, dtype=int)
-                if np.prod(bbox_word[2:4] - bbox_word[0:2]) == 0:
-                    bbox_word[2:4] += 1
-                if len(confidences_word) > 0:
-                    conf_word = sum(confidences_word) / len(confidences_word)
+                text_line = ocr_record.prediction
+                if len(ocr_record.confidences) > 0:
+                    conf_line = sum(ocr_record.confidences) / len(ocr_record.confidences)
                 else:
-                    conf_word = None
-                word = WordType(id=id_word,
-                                Coords=CoordsType(points=points_from_bbox(*bbox_word)))
-                word.add_TextEquiv(TextEquivType(Unicode=text_word, conf=conf_word))
-                for idx_glyph, text_glyph in enumerate(text_word):
-                    id_glyph = '%s_glyph_%s' % (id_word, idx_glyph + 1)
-                    poly_glyph = cuts_word[idx_glyph] + cuts_word[idx_glyph + 1]
-                    bbox_glyph = bbox_from_polygon(coordinates_for_segment(poly_glyph, None, page_coords))
-                    # avoid zero-size coords on ties
-                    bbox_glyph = np.array(bbox_glyph, dtype=int)
-                    if np.prod(bbox_glyph[2:4] - bbox_glyph[0:2]) == 0:
-                        bbox_glyph[2:4] += 1
-                    conf_glyph = confidences_word[idx_glyph]
-                    glyph = GlyphType(id=id_glyph,
-                                      Coords=CoordsType(points=points_from_bbox(*bbox_glyph)))
-                    glyph.add_TextEquiv(TextEquivType(Unicode=text_glyph, conf=conf_glyph))
-                    word.add_Glyph(glyph)
-                line.add_Word(word)
-            self.logger.info('Recognized line "%s"', line.id)
-            page_update_higher_textequiv_levels('line', pcgts)
-
-        self.logger.info("Finished recognition, serializing")
-        return OcrdPageResult(pcgts)
+                    conf_line = None
+                if self.parameter['overwrite_text']:
+                    line.TextEquiv = []
+                if self.incremental:
+                    # (in incremental mode, only lines without confident text get here,
+                    # which the new result replaces - including Words and Glyphs,
+                    # since the new ones get the same IDs)
+                    line.TextEquiv = []
+                    line.Word = []
+                if alternatives_line:
+                    # (name the model which actually produced the primary result)
+                    names = [self.parameter['fallback_model'] if fallback else self.model_names[0]]
+                    for name, record in zip(names + self.model_names[1:],
+                                            (ocr_record,) + tuple(alternatives_line)):
+                        if len(record.confidences) > 0:
+                            conf = sum(record.confidences) / len(record.confidences)
+                        else:
+                            conf = None
+                        line.add_TextEquiv(TextEquivType(Unicode=record.prediction, conf=conf,
+                                                         index=len(line.TextEquiv) + 1,
+                                                         comments=f'model: {name}'))
+                else:
+                    line.add_TextEquiv(TextEquivType(Unicode=text_line, conf=conf_line))
+                # fixme: kraken#98 says the Pytorch CTC output is too impoverished to yield good glyph stops
+                # as a workaround, here we just steal from the next glyph start, respectively
+                # (so each word spans its glyphs' cuts and the start of the next glyph):
+                succ = np.minimum(np.arange(1, len(cuts_line) + 1), len(cuts_line) - 1)
+                bboxes_glyph = np.concatenate([np.minimum(bboxes_line[:, :2], bboxes_line[succ, :2]),
+                                               np.maximum(bboxes_line[:, 2:], bboxes_line[succ, 2:])], axis=1)
+                idx_word = 0
+                line_offset = 0
+                for text_word in regex.splititer(r'(\s+)', text_line):
+                    next_offset = line_offset + len(text_word)
+                    confidences_word = ocr_record.confidences[line_offset:next_offset]
+                    bboxes_word = bboxes_glyph[line_offset:next_offset]
+                    line_offset = next_offset
+                    if len(text_word.strip()) == 0:
+                        continue
+                    id_word = '%s_word_%s' % (id_line, idx_word + 1)
+                    idx_word += 1
+                    bbox_word = np.concatenate([bboxes_word[:, :2].min(axis=0),
+                                                bboxes_word[:, 2:].max(axis=0)])
+                    if len(confidences_word) > 0:
+                        conf_word = sum(confidences_word) / len(confidences_word)
+                    else:
+                        conf_word = None
+                    word = WordType(id=id_word,
+                                    Coords=CoordsType(points=points_from_bbox(*avoid_empty_bboxes(bbox_word))))
+                    word.add_TextEquiv(TextEquivType(Unicode=text_word, conf=conf_word))
+                    for idx_glyph, (text_glyph, bbox_glyph) in enumerate(
+                            zip(text_word, avoid_empty_bboxes(bboxes_word))):
+                        id_glyph = '%s_glyph_%s' % (id_word, idx_glyph + 1)
+                        conf_glyph = confidences_word[idx_glyph]
+                        glyph = GlyphType(id=id_glyph,
+                                          Coords=CoordsType(points=points_from_bbox(*bbox_glyph)))
+                        glyph.add_TextEquiv(TextEquivType(Unicode=text_glyph, conf=conf_glyph))
+                        word.add_Glyph(glyph)
+                    line.add_Word(word)
+                    metrics.count('words')
+                    metrics.count('glyphs', len(text_word))
+                self.logger.info('Recognized line "%s"', line.id)
+                recognized += 1
+            metrics.lap('page')
+        return recognized
+
+def line_needs_text(line, threshold=0):
+    """Whether ``line`` has no TextEquiv with text and a confidence of
+    at least ``threshold`` (or no confidence at all, as in GT)."""
+    for textequiv in line.get_TextEquiv():
+        if textequiv.Unicode and (textequiv.conf is None or textequiv.conf >= threshold):
+            return False
+    return True
+
+def bboxes_for_polygons(polygons, coords):
+    """Convert relative polygons to absolute bounding boxes.
+
+    Given a list of ``polygons`` (each a list of points) relative to the
+    image with the affine transformation ``coords``, calculate their
+    (integer) bounding boxes within the page, all in one transformation.
+
+    Return an array of rows ``minx, miny, maxx, maxy``.
+    """
+    if not polygons:
+        return np.zeros((0, 4), dtype=np.int32)
+    points = np.fromiter(itertools.chain.from_iterable(itertools.chain.from_iterable(polygons)),
+                         dtype=np.float32).reshape(-1, 2)
+    points = coordinates_for_segment(points, None, coords)
+    starts = np.cumsum([0] + [len(polygon) for polygon in polygons[:-1]])
+    return np.concatenate([np.minimum.reduceat(points, starts),
+                           np.maximum.reduceat(points, starts)], axis=1)
+
+def avoid_empty_bboxes(bboxes):
+    """Enlarge bounding boxes (rows or single) of zero size (on ties) by one pixel."""
+    bboxes = np.array(bboxes)
+    empty = np.prod(bboxes[..., 2:4] - bboxes[..., 0:2], axis=-1) == 0
+    bboxes[..., 2:4] += empty[..., np.newaxis]
+    return bboxes
 
 # zzz should go into core ocrd_utils
 def baseline_of_segment(segment, coords):
@@ -265,58 +701,6 @@ def polygon_from_baseline(baseline, scale : Union[float, np.floating] = 20):
                                        scale=scale))
     return polygon
 
-def join_polygons(polygons, loc='', scale : Union[float, np.floating] = 20):
-    """construct concave hull (alpha shape) from input polygons"""
-    # compoundp = unary_union(polygons)
-    # jointp = compoundp.convex_hull
-    polygons = list(itertools.chain.from_iterable([
-        poly.geoms if poly.geom_type in ['MultiPolygon', 'GeometryCollection']
-        else [poly]
-        for poly in polygons]))
-    npoly = len(polygons)
-    if npoly == 1:
-        return polygons[0]
-    # find min-dist path through all polygons (travelling salesman)
-    pairs = itertools.combinations(range(npoly), 2)
-    dists = np.eye(npoly, dtype=float)
-    for i, j in pairs:
-        dist = polygons[i].distance(polygons[j])
-        if dist < 1e-5:
-            dist = 1e-5 # if pair merely touches, we still need to get an edge
-        dists[i, j] = dist
-        dists[j, i] = dist
-    dists = minimum_spanning_tree(dists, overwrite=True)
-    # add bridge polygons (where necessary)
-    for prevp, nextp in zip(*dists.nonzero()):
-        prevp = polygons[prevp]
-        nextp = polygons[nextp]
-        nearest = nearest_points(prevp, nextp)
-        bridgep = LineString(nearest).buffer(max(1, scale/5), resolution=1)
-        polygons.append(bridgep)
-    jointp = unary_union(polygons)
-    assert jointp.geom_type == 'Polygon', jointp.wkt
-    if jointp.minimum_clearance < 1.0:
-        # follow-up calculations will necessarily be integer;
-        # so anticipate rounding here and then ensure validity
-        jointp = Polygon(np.round(jointp.exterior.coords))
-        jointp = make_valid(jointp)
-    return jointp
-
-def make_valid(polygon):
-    points = list(polygon.exterior.coords)
-    for split in range(1, len(points)):
-        if polygon.is_valid or polygon.simplify(polygon.area).is_valid:
-            break
-        # simplification may not be possible (at all) due to ordering
-        # in that case, try another starting point
-        polygon = Polygon(points[-split:]+points[:-split])
-    for tolerance in range(int(polygon.area)):
-        if polygon.is_valid:
-            break
-        # simplification may require a larger tolerance
-        polygon = polygon.simplify(tolerance + 1)
-    return polygon
-
 # from ocrd_tesserocr...
 
 def page_element_unicode0(element):
@@ -360,11 +744,11 @@ def page_update_higher_textequiv_levels(level, pcgts, overwrite=True):
         relations = relations.get_Relation() # get list of RelationType
     else:
         relations = []
-    joins = list()
+    joins = set()
     for relation in relations:
         if relation.get_type() == 'join': # ignore 'link' type here
-            joins.append((relation.get_SourceRegionRef().get_regionRef(),
-                          relation.get_TargetRegionRef().get_regionRef()))
+            joins.add((relation.get_SourceRegionRef().get_regionRef(),
+                       relation.get_TargetRegionRef().get_regionRef()))
     reading_order = dict()
     ro = page.get_ReadingOrder()
     if ro:
@@ -0,0 +1,238 @@
+"""
+Batched line recognition, producing the same records as Kraken's ``mm_rpred``.
+
+Instead of running the network on one line at a time, extract and normalize
+all lines first (of one or more pages), then run them through the network in
+padded batches of similar width, and decode each line separately.
+
+The padding of each line is zeroed after every layer, so each layer sees the
+same (zero-padded) input as when running the line alone.
+"""
+import dataclasses
+import logging
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+# maximum ratio of widest to narrowest line in a batch (limiting padding)
+MAX_WIDTH_RATIO = 1.5
+
+@dataclasses.dataclass
+class PreparedLine:
+    """Line of a segmentation along with its extracted image size and input tensor."""
+    line: object
+    size: tuple
+    tensor: object
+
+def extract_lines(image, segmentation, legacy=False):
+    """
+    Extract the line images of ``segmentation`` from ``image``
+    (with the new or ``legacy`` polygon extractor).
+
+    Return a list of images, or None for lines which cannot be extracted.
+    """
+    from kraken.lib.exceptions import KrakenInputException
+    from kraken.lib.segmentation import extract_polygons
+    boxes = []
+    for line in segmentation.lines:
+        if segmentation.type != 'baselines':
+            line.text_direction = segmentation.text_direction
+        try:
+            box, _ = next(extract_polygons(image, dataclasses.replace(segmentation, lines=[line]),
+                                           legacy=legacy))
+        except (KrakenInputException, ValueError) as e:
+            logger.warning(f'Extracting line failed: {e}')
+            box = None
+        boxes.append(box)
+    return boxes
+
+def prepare_lines(net, image, segmentation, pad=16, boxes=None):
+    """
+    Extract the lines of ``segmentation`` from ``image`` (unless already
+    given as ``boxes``) and convert them to input tensors for ``net``
+    (like ``mm_rpred`` does for each line).
+
+    Return a list of :py:class:`PreparedLine`, or (for lines which cannot
+    be extracted or are empty) the empty record ``mm_rpred`` would emit.
+    """
+    from kraken.containers import BaselineOCRRecord, BBoxOCRRecord
+    from kraken.lib.dataset import ImageInputTransforms
+    baselines = segmentation.type == 'baselines'
+    batch, channels, height, width = net.nn.input
+    transforms = ImageInputTransforms(batch, height, width, channels, (pad, 0), not baselines)
+    if boxes is None:
+        boxes = extract_lines(image, segmentation, net.nn.use_legacy_polygons)
+    prepared = []
+    for line, box in zip(segmentation.lines, boxes):
+        if baselines:
+            empty = BaselineOCRRecord('', [], [], line)
+        else:
+            empty = BBoxOCRRecord('', (), (), line)
+        if box is None:
+            prepared.append(empty)
+            continue
+        if 0 in box.size:
+            logger.warning(f'{line} with zero dimension. Emitting empty record.')
+            prepared.append(empty)
+            continue
+        try:
+            tensor = transforms(box)
+        except Exception as e:
+            logger.warning(f'Tensor conversion failed with {e}. Emitting empty record.')
+            prepared.append(empty)
+            continue
+        if tensor.max() == tensor.min():
+            logger.warning('Empty line after tensor conversion. Emitting empty record.')
+            prepared.append(empty)
+            continue
+        prepared.append(PreparedLine(line, box.size, tensor))
+    return prepared
+
+def width_buckets(tensors, batch_size):
+    """
+    Group the indices of ``tensors`` (C, H, W) into batches of at most ``batch_size``
+    with equal height and widths differing by at most ``MAX_WIDTH_RATIO``.
+    """
+    order = sorted(range(len(tensors)), key=lambda idx: tensors[idx].shape[1:])
+    buckets = []
+    for idx in order:
+        if (buckets and len(buckets[-1]) < batch_size and
+            tensors[buckets[-1][0]].shape[1] == tensors[idx].shape[1] and
+            tensors[idx].shape[2] <= MAX_WIDTH_RATIO * tensors[buckets[-1][0]].shape[2]):
+            buckets[-1].append(idx)
+        else:
+            buckets.append([idx])
+    return buckets
+
+@contextmanager
+def masked_padding(nn):
+    """
+    Zero the padded part of each line in the output of every layer of the
+    VGSL network ``nn`` (according to the sequence lengths passed along),
+    while in this context.
+
+    (Otherwise, layers like convolutions turn the padding into non-zero
+    activations, which the next layers, e.g. bidirectional LSTMs, spread
+    into the line.)
+    """
+    import torch
+    def mask(module, inputs, output):
+        if not isinstance(output, tuple):
+            return output
+        output, seq_len = output
+        if seq_len is not None and output.dim() == 4:
+            width = torch.arange(output.shape[3], device=output.device)
+            valid = width[None, :] < seq_len.to(output.device)[:, None]
+            output = output * valid[:, None, None, :].to(output.dtype)
+        return output, seq_len
+    handles = [layer.register_forward_hook(mask) for layer in nn.children()]
+    try:
+        yield
+    finally:
+        for handle in handles:
+            handle.remove()
+
+def predict_lines(net, tensors, batch_size=16):
+    """
+    Run ``tensors`` through ``net`` in padded batches (see :py:func:`width_buckets`
+    and :py:func:`masked_padding`).
+
+    Return the decoded predictions (label, start, end, confidence) of each
+    line, along with the width of its network output.
+    """
+    import torch
+    results = [None] * len(tensors)
+    for bucket in width_buckets(tensors, batch_size):
+        channels, height, _ = tensors[bucket[0]].shape
+        lens = torch.tensor([tensors[idx].shape[2] for idx in bucket])
+        batch = torch.zeros(len(bucket), channels, height, int(lens.max()))
+        for pos, idx in enumerate(bucket):
+            batch[pos, :, :, :lens[pos]] = tensors[idx]
+        with torch.no_grad(), masked_padding(net.nn.nn):
+            outputs, olens = net.forward(batch, lens)
+        for pos, idx in enumerate(bucket):
+            olen = int(olens[pos])
+            locs = net.decoder(outputs[pos, :, :olen])
+            if locs and isinstance(locs[0], list):
+                # batch decoders (Kraken>=6) return one sequence per line
+                locs = locs[0]
+            results[idx] = net.codec.decode(locs), olen
+    return results
+
+def make_record(prepared, preds, olen, segmentation, pad=16, bidi_reordering=True):
+    """Convert the predictions for a line into an ocr_record (like ``mm_rpred``)."""
+    from kraken.containers import BaselineOCRRecord, BBoxOCRRecord
+    line, size, tensor = prepared.line, prepared.size, prepared.tensor
+    # scale between network output and network input
+    net_scale = tensor.shape[2] / olen
+    # scale between network input and original line
+    in_scale = size[0] / (tensor.shape[2] - 2 * pad)
+    def scale_val(val, min_val, max_val):
+        return int(round(min(max(((val * net_scale) - pad) * in_scale, min_val), max_val - 1)))
+    prediction = ''.join(x[0] for x in preds)
+    confidences = [c for _, _, _, c in preds]
+    if segmentation.type == 'bbox':
+        xmin, ymin, xmax, ymax = line.bbox
+        cuts = []
+        for _, start, end, _ in preds:
+            if segmentation.text_direction.startswith('horizontal'):
+                start, end = xmin + scale_val(start, 0, size[0]), xmin + scale_val(end, 0, size[0])
+                cuts.append([[start, ymin], [start, ymax], [end, ymax], [end, ymin]])
+            else:
+                start, end = ymin + scale_val(start, 0, size[1]), ymin + scale_val(end, 0, size[1])
+                cuts.append([[xmin, start], [xmax, start], [xmax, end], [xmin, end]])
+        record = BBoxOCRRecord(prediction, cuts, confidences, line)
+    else:
+        cuts = [[scale_val(start, 0, size[0]), scale_val(end, 0, size[0])]
+                for _, start, end, _ in preds]
+        record = BaselineOCRRecord(prediction, cuts, confidences, line)
+    if bidi_reordering:
+        return record.logical_order(base_dir=bidi_reordering if bidi_reordering in ('L', 'R') else None)
+    return record.display_order(None)
+
+def make_records(net, prepared, segmentation, pad=16, bidi_reordering=True, batch_size=16):
+    """Predict the ``prepared`` lines of ``segmentation`` with ``net`` and return their records."""
+    todo = [item for item in prepared if isinstance(item, PreparedLine)]
+    predictions = iter(predict_lines(net, [item.tensor for item in todo], batch_size))
+    return [make_record(item, *next(predictions), segmentation, pad, bidi_reordering)
+            if isinstance(item, PreparedLine) else item
+            for item in prepared]
+
+def ensemble_rpred(nets, image, segmentation, pad=16, bidi_reordering=True, batch_size=16):
+    """
+    Recognize the lines of ``segmentation`` with each of ``nets``.
+
+    Extract line images only once (for each polygon extraction method),
+    and convert them to input tensors only once (for each input shape).
+
+    Return a list of the records of all nets (in order) for each line.
+    """
+    boxes = {}
+    prepared = {}
+    results = []
+    for net in nets:
+        legacy = net.nn.use_legacy_polygons
+        if legacy not in boxes:
+            boxes[legacy] = extract_lines(image, segmentation, legacy)
+        spec = (legacy, tuple(net.nn.input))
+        if spec not in prepared:
+            prepared[spec] = prepare_lines(net, image, segmentation, pad, boxes[legacy])
+        results.append(make_records(net, prepared[spec], segmentation, pad, bidi_reordering, batch_size))
+    return list(zip(*results))
+
+def batch_rpred(net, pages, pad=16, bidi_reordering=True, batch_size=16):
+    """
+    Recognize the lines of several pages at once with ``net``.
+
+    Given a list of ``pages`` (each a tuple of image and segmentation),
+    return a list of the ocr_records for each page (in line order).
+    """
+    prepared = [prepare_lines(net, image, segmentation, pad) for image, segmentation in pages]
+    todo = [item for items in prepared for item in items if isinstance(item, PreparedLine)]
+    predictions = iter(predict_lines(net, [item.tensor for item in todo], batch_size))
+    results = []
+    for items, (_, segmentation) in zip(prepared, pages):
+        results.append([make_record(item, *next(predictions), segmentation, pad, bidi_reordering)
+                        if isinstance(item, PreparedLine) else item
+                        for item in items])
+    return results
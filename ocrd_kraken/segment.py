@@ -1,9 +1,9 @@
 from typing import Optional
-from PIL import ImageOps
+from PIL import Image, ImageDraw
 
+import numpy as np
+import shapely
 import shapely.geometry as geom
-from shapely.prepared import prep as geom_prep
-import torch
 
 from ocrd import Processor
 from ocrd.processor.ocrd_page_result import OcrdPageResult
@@ -11,9 +11,10 @@ from ocrd_utils import (
     getLogger,
     polygon_from_x0y0x1y1,
     points_from_polygon,
-    polygon_mask,
     coordinates_for_segment,
     coordinates_of_segment,
+    scale_coordinates,
+    shift_coordinates,
 )
 import ocrd_models.ocrd_page
 from ocrd_models.ocrd_page import (
@@ -26,11 +27,17 @@ from ocrd_models.ocrd_page import (
     BaselineType,
 )
 
-from .common import KrakenPredictor
+from .common import KrakenPredictor, make_predictor, optimize_model, preload, text_sample
+from .server import KrakenPredictorClient
+from .geometry import make_valid, make_valid_all
+from .tiling import tile_boxes, stitch_tiles
+from .metrics import page_metrics, current_metrics, start_metrics, finish_metrics
 
 class KrakenSegmentPredictor(KrakenPredictor):
     def setup(self):
+        import torch
         self.use_legacy = self.parameter.pop('use_legacy')
+        cpu_optimization = self.parameter.pop('cpu_optimization')
         if self.use_legacy:
             self.logger.info("Using legacy segmenter")
             # adapt to Kraken v5 changes:
@@ -40,12 +47,22 @@ class KrakenSegmentPredictor(KrakenPredictor):
             from kraken.lib.vgsl import TorchVGSLModel
             self.logger.info("Using blla segmenter")
             self.logger.info("loading model '%s'", self.parameter['model'])
-            self.parameter['model'] = TorchVGSLModel.load_model(self.parameter['model'])
+            model_path = self.parameter['model']
+            self.parameter['model'] = model = TorchVGSLModel.load_model(model_path)
             device = self.parameter['device']
             if device != 'cpu' and not torch.cuda.is_available():
                 device = 'cpu'
             if device == 'cpu':
                 self.logger.warning("no CUDA device available. Running without GPU will be slow")
+            if device == 'cpu' and cpu_optimization != 'none':
+                from kraken.lib.dataset import ImageInputTransforms
+                batch, channels, _, _ = model.input
+                # a page-like crop (blla scales whole pages to the model's height)
+                transforms = ImageInputTransforms(batch, 256, 0, channels, 0, valid_norm=False)
+                sample = transforms(text_sample(256, 256, lines=4)).unsqueeze(0)
+                # blla applies the sigmoid to the network's output
+                model.nn = optimize_model(model.nn, model_path, cpu_optimization,
+                                          sample, self.logger, activation=torch.sigmoid)
             self.parameter['device'] = device
             # adapt to Kraken v5 changes:
             self.parameter.pop('scale')
@@ -53,6 +70,9 @@ class KrakenSegmentPredictor(KrakenPredictor):
             self.parameter.pop('maxcolseps')
             self.parameter.pop('black_colseps')
     def predict(self, *inputs):
+        if not inputs:
+            # the height blla scales its input to
+            return 0 if self.use_legacy else self.parameter['model'].input[2]
         if self.use_legacy:
             from kraken.pageseg import segment
         else:
@@ -70,23 +90,46 @@ class KrakenSegment(Processor):
         """
         Load models
         """
+        self.metrics_output = start_metrics()
+        # results are unpickled into Kraken containers, tiles stitched with
+        # Kraken's reading order and (polygon joining in) scipy
+        preload('kraken.containers', 'kraken.lib.segmentation', 'scipy.sparse.csgraph')
         parameter = dict(self.parameter)
         model = parameter.pop('blla_model')
         del parameter['blla_classes']
         del parameter['overwrite_segments']
         del parameter['level-of-operation']
+        del parameter['target_dpi']
         self.use_legacy = parameter['use_legacy']
+        self.tile_size = parameter.pop('tile_size')
+        self.tile_overlap = parameter.pop('tile_overlap')
+        if self.tile_size and self.tile_overlap >= self.tile_size // 2:
+            self.logger.warning("tile_overlap %d too large for tile_size %d, reducing to %d",
+                                self.tile_overlap, self.tile_size, self.tile_size // 4)
+            self.tile_overlap = self.tile_size // 4
+        if self.tile_size and self.use_legacy:
+            self.logger.warning("tiled segmentation is not supported with use_legacy")
+            self.tile_size = 0
         if not self.use_legacy:
             parameter['model'] = self.resolve_resource(model)
-        self.predictor = KrakenSegmentPredictor(self.logger, parameter)
+        self.predictor = make_predictor(KrakenSegmentPredictor, self.logger, parameter,
+                                        processes=parameter.pop('predictor_processes'))
         self.predictor.start()
+        if self.tile_size:
+            height = self.predictor("") # blocks until model is loaded
+            if self.tile_size < height:
+                # (would only get upscaled again)
+                raise ValueError(f"tile_size {self.tile_size} is smaller than the model's "
+                                 f"input height {height}, which each tile gets scaled to")
 
     def shutdown(self):
         import multiprocessing as mp
         if getattr(self, 'predictor', None):
             self.predictor.shutdown()
             del self.predictor
+        finish_metrics(getattr(self, 'metrics_output', None))
 
+    @page_metrics
     def process_page_pcgts(self, *input_pcgts: Optional[OcrdPage], page_id: Optional[str] = None) -> OcrdPageResult:
         """Segment into (regions and) lines with Kraken.
 
@@ -101,6 +144,8 @@ class KrakenSegment(Processor):
         Get the page image from the alternative image or by cropping according to the
         layout annotation. If alternative images are present, prefer binarized form
         (if ``use_legacy``) or use the last available alternative image (otherwise).
+        If ``target_dpi`` is set and the image has a higher pixel density, downsample it
+        (so polygons found on the smaller image get mapped back via the coordinate transform).
         Unless at the top level (i.e. a page without border), calculate a mask image for
         the current segment.
 
@@ -120,14 +165,26 @@ class KrakenSegment(Processor):
         page_image, page_coords, page_info = self.workspace.image_from_page(
             page, page_id,
             feature_selector="binarized" if self.use_legacy else "")
+        current_metrics().lap('image')
         if page_info.resolution != 1:
             dpi = page_info.resolution
             if page_info.resolutionUnit == 'cm':
                 dpi = round(dpi * 2.54)
             zoom = 300.0 / dpi
         else:
+            dpi = 0
             zoom = 1.0
         # TODO: be DPI-relative
+        # zoom of the (possibly downsampled) image relative to the page coordinates
+        scale = 1.0
+        target_dpi = self.parameter['target_dpi']
+        if target_dpi and not dpi:
+            self.logger.warning("Unknown pixel density for page '%s', not downsampling", page_id)
+        elif target_dpi and dpi > target_dpi:
+            scale = target_dpi / dpi
+            self.logger.info("Downsampling page '%s' from %d to %d DPI", page_id, dpi, target_dpi)
+            page_image, page_coords = downscale_image(page_image, page_coords, scale)
+            current_metrics().lap('downscale')
 
         if self.parameter['level-of-operation'] == 'page':
             self.logger.info('Segmenting page with %s segmenter', 'legacy' if self.use_legacy else 'blla')
@@ -157,10 +214,63 @@ class KrakenSegment(Processor):
                     region.TextLine = []
                 elif len(region.TextLine or []):
                     self.logger.warning('Keeping %d lines in region "%s"', len(region.TextLine or []), region.id)
-                self._process_region(page_image, page_coords, region, page_id, zoom)
+            if regions:
+                # the region mask is buffered in image pixels
+                self._process_regions(page_image, page_coords, regions, page_id, zoom / scale)
 
         return OcrdPageResult(pcgts)
 
+    def segment(self, page_id, inputs):
+        """
+        Segment a list of ``inputs`` (each an image and optional mask) via the predictor,
+        returning the list of results.
+
+        Inputs larger than ``tile_size`` get segmented in overlapping tiles instead,
+        stitching their results.
+        """
+        tilings = [tile_boxes(image.width, image.height, self.tile_size, self.tile_overlap)
+                   if self.tile_size and max(image.size) > self.tile_size else None
+                   for image, _ in inputs]
+        def tasks():
+            # crop tiles only when submitting them
+            for (image, mask), tiles in zip(inputs, tilings):
+                if tiles is None:
+                    yield image, mask
+                    continue
+                self.logger.info("Segmenting %s in %d tiles", page_id, len(tiles))
+                current_metrics().count('tiles', len(tiles))
+                for tile in tiles:
+                    yield image.crop(tile), mask.crop(tile) if mask is not None else None
+        results = iter(self.predict_all(page_id, tasks()))
+        return [next(results) if tiles is None else
+                stitch_tiles([next(results) for _ in tiles], tiles, self.parameter['text_direction'])
+                for tiles in tilings]
+
+    def predict_all(self, page_id, inputs):
+        """
+        Send each of ``inputs`` (image and mask) to the predictor, and return their results.
+
+        Keep up to two tasks in flight, so several predictor processes can work
+        on the same page (and the predictor can batch them). Over a predictor
+        server connection, only send the next task after receiving the result
+        of the previous one (the server predicts them one after another anyway,
+        and large segmentations would only pile up in the socket buffers).
+        """
+        in_flight = 1 if isinstance(self.predictor, KrakenPredictorClient) else 2
+        tasks = []
+        results = []
+        try:
+            for image, mask in inputs:
+                tasks.append(self.predictor.submit(page_id, image, mask))
+                if len(tasks) >= in_flight:
+                    results.append(self.predictor.receive(tasks.pop(0)))
+            while tasks:
+                results.append(self.predictor.receive(tasks.pop(0)))
+        finally:
+            for task in tasks:
+                self.predictor.discard(task)
+        return results
+
     def _process_page(self, page_image, page_coords, page, page_id, zoom=1.0):
         def getmask():
             # use mask if existing regions (any type for page, text cells for table)
@@ -192,14 +302,19 @@ class KrakenSegment(Processor):
                 # table region
                 poly = coordinates_of_segment(page, page_image, page_coords)
             # poly = geom.Polygon(poly).buffer(20/zoom).exterior.coords[:-1]
-            mask = ImageOps.invert(polygon_mask(page_image, poly))
+            holes = []
             for region in regions:
                 self.logger.info("Masking existing region %s", region.id)
-                poly = coordinates_of_segment(region, page_image, page_coords)
-                # poly = geom.Polygon(poly).buffer(20/zoom).exterior.coords[:-1]
-                mask.paste(255, mask=polygon_mask(page_image, poly))
-            return mask
-        res = self.predictor(page_id, page_image, getmask())
+                hole = coordinates_of_segment(region, page_image, page_coords)
+                # hole = geom.Polygon(hole).buffer(20/zoom).exterior.coords[:-1]
+                holes.append(hole)
+            return segment_mask(page_image.size, [poly], holes)
+        metrics = current_metrics()
+        mask = getmask()
+        metrics.lap('mask')
+        res, = self.segment(page_id, [(page_image, mask)])
+        metrics.lap('predict')
+        metrics.count('lines', len(res.lines))
         self.logger.debug("Finished segmentation, serializing")
         #self.logger.debug(res)
         if self.use_legacy:
@@ -215,13 +330,20 @@ class KrakenSegment(Processor):
                     id=f'region_line_{idx_line + 1}_line',
                     Coords=CoordsType(points=line_points)))
                 page.add_TextRegion(region_elem)
+            metrics.count('regions', len(res.lines))
             self.logger.debug("Found %d lines on page %s", idx_line + 1, page.id)
         else:
             handled_lines = {}
             regions = [(type_, region)
                        for type_ in res.regions
                        for region in res.regions[type_]]
-            idx_region = idx_line = 0
+            # convert and repair all lines at once (instead of for each region again)
+            line_polys = make_valid_all(geom.Polygon(coordinates_for_segment(line.boundary, None, page_coords))
+                                        for line in res.lines)
+            line_baselines = [coordinates_for_segment(line.baseline, None, page_coords)
+                              for line in res.lines]
+            region_elems = []
+            text_region_polys = []
             for idx_region, (type_, region) in enumerate(regions):
                 region_poly = coordinates_for_segment(region.boundary, None, page_coords)
                 region_poly = make_valid(geom.Polygon(region_poly))
@@ -233,33 +355,31 @@ class KrakenSegment(Processor):
                 getattr(page, 'add_' + region_type)(region_elem)
                 if not region_type == 'TextRegion':
                     continue
+                region_elems.append((idx_region, region_elem))
                 # enlarge to avoid loosing slightly extruding text lines
-                region_poly = geom_prep(region_poly.buffer(20/zoom))
-                for idx_line, line in enumerate(res.lines):
-                    line_poly = coordinates_for_segment(line.boundary, None, page_coords)
-                    line_baseline = coordinates_for_segment(line.baseline, None, page_coords)
+                text_region_polys.append(region_poly.buffer(20/zoom))
+            for (idx_region, region_elem), idx_lines in zip(
+                    region_elems, lines_in_regions(text_region_polys, line_polys)):
+                for idx_line in idx_lines:
                     line_id = f'region_{idx_region + 1}_line_{idx_line + 1}'
-                    line_type = line.tags.get('type', '')
+                    line_type = res.lines[idx_line].tags.get('type', '')
                     self.logger.info("Line %s is of type %s", line_id, line_type)
-                    line_poly = make_valid(geom.Polygon(line_poly))
-                    if region_poly.contains(line_poly):
-                        if idx_line in handled_lines:
-                            self.logger.error("Line %s was already added to region %s" % (idx_line, handled_lines[idx_line]))
-                            continue
-                        region_elem.add_TextLine(TextLineType(
-                            id=line_id,
-                            Baseline=BaselineType(points=points_from_polygon(line_baseline)),
-                            Coords=CoordsType(points=points_from_polygon(line_poly.exterior.coords[:-1]))))
-                        handled_lines[idx_line] = idx_region
+                    if idx_line in handled_lines:
+                        self.logger.error("Line %s was already added to region %s" % (idx_line, handled_lines[idx_line]))
+                        continue
+                    region_elem.add_TextLine(TextLineType(
+                        id=line_id,
+                        Baseline=BaselineType(points=points_from_polygon(line_baselines[idx_line])),
+                        Coords=CoordsType(points=points_from_polygon(line_polys[idx_line].exterior.coords[:-1]))))
+                    handled_lines[idx_line] = idx_region
             for idx_line, line in enumerate(res.lines):
                 if idx_line not in handled_lines:
                     self.logger.error("Line %s could not be assigned a region, creating a dummy region", idx_line)
-                    line_poly = coordinates_for_segment(line.boundary, None, page_coords)
-                    line_baseline = coordinates_for_segment(line.baseline, None, page_coords)
+                    line_baseline = line_baselines[idx_line]
                     line_id = f'region_line_{idx_line + 1}_line'
                     line_type = line.tags.get('type', '')
                     self.logger.info("Line %s is of type %s", line_id, line_type)
-                    line_poly = make_valid(geom.Polygon(line_poly)).exterior.coords[:-1]
+                    line_poly = line_polys[idx_line].exterior.coords[:-1]
                     region_elem = TextRegionType(
                         id='region_line_%s' % (idx_line + 1),
                         Coords=CoordsType(points=points_from_polygon(line_poly)))
@@ -268,56 +388,203 @@ class KrakenSegment(Processor):
                         Baseline=BaselineType(points=points_from_polygon(line_baseline)),
                         Coords=CoordsType(points=points_from_polygon(line_poly))))
                     page.add_TextRegion(region_elem)
-            self.logger.debug("Found %d lines and %d regions on page %s", idx_line + 1, idx_region + 1, page.id)
+            metrics.count('regions', len(regions))
+            self.logger.debug("Found %d lines and %d regions on page %s", len(res.lines), len(regions), page.id)
+        metrics.lap('page')
 
-    def _process_region(self, page_image, page_coords, region, page_id, zoom=1.0):
-        def getmask():
-            poly = coordinates_of_segment(region, page_image, page_coords)
-            poly = geom.Polygon(poly).buffer(20/zoom).exterior.coords[:-1]
-            mask = ImageOps.invert(polygon_mask(page_image, poly))
-            for line in region.TextLine:
-                self.logger.info("Masking existing line %s", line.id)
-                poly = coordinates_of_segment(line, page_image, page_coords)
-                # poly = geom.Polygon(poly).buffer(20/zoom).exterior.coords[:-1]
-                mask.paste(255, mask=polygon_mask(page_image, poly))
-            return mask
-        res = self.predictor(page_id, page_image, getmask())
+    def _process_regions(self, page_image, page_coords, regions, page_id, zoom=1.0):
+        """
+        Segment text ``regions`` into lines.
+
+        Instead of segmenting the full page once for each region, segment
+        groups of regions far enough apart to not interfere with each other
+        (see :py:func:`region_groups`) together, each within a crop of
+        the page image. (For blla, only crop to the columns of the group:
+        it scales its input to the model height anyway, so smaller crops
+        would get upscaled - its cost per group does not shrink with the
+        regions' area, it only gains from segmenting several regions at once.)
+        Then assign the resulting lines to the regions (see :py:func:`assign_lines`),
+        clipping them to their region (so lines running across the gap between
+        regions of the same group stay within one of them, as if segmented alone).
+        """
+        metrics = current_metrics()
+        # enlarge to avoid loosing slightly extruding text lines
+        region_polys = [make_valid(geom.Polygon(coordinates_of_segment(region, page_image, page_coords))).buffer(20/zoom)
+                        for region in regions]
+        groups = region_groups(region_polys, 20/zoom)
+        metrics.count('region_groups', len(groups))
+        inputs = []
+        crop_coords = []
+        for group in groups:
+            minx, miny, maxx, maxy = shapely.total_bounds([region_polys[idx] for idx in group])
+            x0, y0 = max(0, int(minx - 20/zoom)), max(0, int(miny - 20/zoom))
+            x1, y1 = min(page_image.width, int(maxx + 20/zoom) + 1), min(page_image.height, int(maxy + 20/zoom) + 1)
+            if not self.use_legacy:
+                y0, y1 = 0, page_image.height
+            image = page_image.crop((x0, y0, x1, y1))
+            coords = dict(page_coords)
+            coords['transform'] = shift_coordinates(page_coords['transform'], np.array([-x0, -y0]))
+            holes = []
+            for idx in group:
+                for line in regions[idx].TextLine:
+                    self.logger.info("Masking existing line %s", line.id)
+                    hole = coordinates_of_segment(line, image, coords)
+                    # hole = geom.Polygon(hole).buffer(20/zoom).exterior.coords[:-1]
+                    holes.append(hole)
+            polys = [np.array(region_polys[idx].exterior.coords[:-1]) - (x0, y0) for idx in group]
+            inputs.append((image, segment_mask(image.size, polys, holes)))
+            crop_coords.append(coords)
+        metrics.lap('mask')
+        results = self.segment(page_id, inputs)
+        metrics.lap('predict')
+        metrics.count('lines', sum(len(res.lines) for res in results))
         self.logger.debug("Finished segmentation, serializing")
-        idx_line = 0
-        if self.use_legacy:
-            for idx_line, line in enumerate(res.lines):
-                line_poly = polygon_from_x0y0x1y1(line.bbox)
-                line_poly = coordinates_for_segment(line_poly, None, page_coords)
-                line_points = points_from_polygon(line_poly)
-                region.add_TextLine(TextLineType(
-                    id=f'{region.id}_line_{idx_line + 1}',
-                    Coords=CoordsType(points=line_points)))
+        for group, coords, res in zip(groups, crop_coords, results):
+            if self.use_legacy:
+                line_polys = [geom.Polygon(coordinates_for_segment(polygon_from_x0y0x1y1(line.bbox), None, coords))
+                              for line in res.lines]
+            else:
+                line_polys = make_valid_all(geom.Polygon(coordinates_for_segment(line.boundary, None, coords))
+                                            for line in res.lines)
+            # assign in page coordinates
+            group_polys = [geom.Polygon(coordinates_for_segment(region_polys[idx].exterior.coords, None, page_coords))
+                           for idx in group]
+            for idx, region_poly, idx_lines in zip(group, group_polys, assign_lines(group_polys, line_polys)):
+                region = regions[idx]
+                for idx_line, line_idx in enumerate(idx_lines):
+                    line = res.lines[line_idx]
+                    line_poly = clip_to_region(line_polys[line_idx], region_poly)
+                    line_id = f'{region.id}_line_{idx_line + 1}'
+                    if self.use_legacy:
+                        region.add_TextLine(TextLineType(
+                            id=line_id,
+                            Coords=CoordsType(points=points_from_polygon(line_poly.exterior.coords[:-1]))))
+                        continue
+                    line_baseline = coordinates_for_segment(line.baseline, None, coords)
+                    line_baseline = clip_to_region(geom.LineString(line_baseline), region_poly).coords
+                    line_type = line.tags.get('type', '')
+                    self.logger.info("Line %s is of type %s", line_id, line_type)
+                    line_poly = line_poly.exterior.coords[:-1]
+                    region.add_TextLine(TextLineType(
+                        id=line_id,
+                        Baseline=BaselineType(points=points_from_polygon(line_baseline)),
+                        Coords=CoordsType(points=points_from_polygon(line_poly))))
+                self.logger.debug("Found %d lines in region %s", len(idx_lines), region.id)
+        metrics.lap('page')
+
+def clip_to_region(geometry, region_poly):
+    """
+    Clip a line's polygon or baseline ``geometry`` to ``region_poly``.
+
+    If the intersection falls apart, keep its largest (or longest) part of the
+    same type. If there is none (e.g. the baseline lies outside the region),
+    return ``geometry`` unchanged.
+    """
+    parts = [part for part in shapely.get_parts(geometry.intersection(region_poly))
+             if part.geom_type == geometry.geom_type and not part.is_empty]
+    if not parts:
+        return geometry
+    part = max(parts, key=lambda part: (part.area, part.length))
+    if part.geom_type == 'Polygon':
+        # (without holes, since only the exterior gets annotated)
+        part = geom.Polygon(part.exterior)
+    return part
+
+def segment_mask(size, polygons, holes):
+    """
+    Rasterize the mask for segmenting within ``polygons`` (except ``holes``)
+    in a single bitonal image of ``size``: 0 inside ``polygons``, and 1
+    outside of them and inside each of ``holes`` (outlines included, like
+    :py:func:`ocrd_utils.polygon_mask`).
+
+    (Draws all polygons into the same buffer, instead of allocating a
+    full-size mask for each of them.)
+    """
+    mask = Image.new('1', size, 1)
+    draw = ImageDraw.Draw(mask)
+    for polygon in polygons:
+        draw.polygon(list(map(tuple, polygon)), fill=0, outline=0)
+    for hole in holes:
+        draw.polygon(list(map(tuple, hole)), fill=1, outline=1)
+    return mask
+
+def downscale_image(image, coords, factor):
+    """
+    Resize ``image`` by ``factor`` (less than 1) and compose its coordinate
+    transform ``coords`` with the scaling.
+
+    Return the new image and coordinate dict.
+    """
+    size = (max(1, round(image.width * factor)), max(1, round(image.height * factor)))
+    if image.mode == '1':
+        # average (instead of picking every n-th pixel), then binarize again
+        scaled = image.convert('L').resize(size, Image.Resampling.BOX)
+        scaled = scaled.point(lambda val: 255 if val >= 128 else 0).convert('1')
+    else:
+        scaled = image.resize(size, Image.Resampling.LANCZOS, reducing_gap=2.0)
+    coords = dict(coords)
+    coords['transform'] = scale_coordinates(coords['transform'], (size[0] / image.width,
+                                                                  size[1] / image.height))
+    return scaled, coords
+
+def lines_in_regions(region_polys, line_polys):
+    """
+    Find the lines contained in each region.
+
+    Query a spatial index of ``line_polys`` with all ``region_polys`` at once.
+    Return a list of the (sorted) indices of the lines for each region.
+    """
+    if not region_polys or not line_polys:
+        return [[] for _ in region_polys]
+    tree = shapely.STRtree(line_polys)
+    idx_regions, idx_lines = tree.query(np.array(region_polys, dtype=object), predicate='contains')
+    # group by region, keeping line order
+    order = np.lexsort((idx_lines, idx_regions))
+    idx_regions, idx_lines = idx_regions[order], idx_lines[order]
+    splits = np.searchsorted(idx_regions, np.arange(1, len(region_polys)))
+    return [idx.tolist() for idx in np.split(idx_lines, splits)]
+
+def region_groups(region_polys, distance):
+    """
+    Partition regions into groups which can be segmented together.
+
+    Greedily assign each of ``region_polys`` to the first group without
+    any member closer than ``distance`` (so lines cannot run across
+    regions of the same group). Return a list of lists of region indices.
+    """
+    groups = []
+    if not region_polys:
+        return groups
+    tree = shapely.STRtree(region_polys)
+    group_of = {}
+    for idx, poly in enumerate(region_polys):
+        conflicts = {group_of[other] for other in tree.query(poly, predicate='dwithin', distance=distance).tolist()
+                     if other in group_of}
+        group = next((group for group in range(len(groups)) if group not in conflicts), len(groups))
+        if group == len(groups):
+            groups.append([])
+        groups[group].append(idx)
+        group_of[idx] = group
+    return groups
+
+def assign_lines(region_polys, line_polys):
+    """
+    Assign each of ``line_polys`` to the region it overlaps most
+    (or the nearest one, if it overlaps none).
+
+    Return a list of the (sorted) indices of the lines for each region.
+    """
+    assigned = [[] for _ in region_polys]
+    if not region_polys:
+        return assigned
+    tree = shapely.STRtree(region_polys)
+    for idx_line, line_poly in enumerate(line_polys):
+        candidates = tree.query(line_poly, predicate='intersects').tolist()
+        if len(candidates) > 1:
+            idx_region = max(candidates, key=lambda idx: region_polys[idx].intersection(line_poly).area)
+        elif candidates:
+            idx_region = candidates[0]
         else:
-            for idx_line, line in enumerate(res.lines):
-                line_poly = coordinates_for_segment(line.boundary, None, page_coords)
-                line_baseline = coordinates_for_segment(line.baseline, None, page_coords)
-                line_id = f'{region.id}_line_{idx_line + 1}'
-                line_type = line.tags.get('type', '')
-                self.logger.info("Line %s is of type %s", line_id, line_type)
-                line_poly = geom.Polygon(line_poly)
-                #line_poly = line_poly.intersection(region_poly)
-                line_poly = make_valid(line_poly).exterior.coords[:-1]
-                region.add_TextLine(TextLineType(
-                    id=line_id,
-                    Baseline=BaselineType(points=points_from_polygon(line_baseline)),
-                    Coords=CoordsType(points=points_from_polygon(line_poly))))
-        self.logger.debug("Found %d lines in region %s", idx_line + 1, region.id)
-
-def make_valid(polygon):
-    for split in range(1, len(polygon.exterior.coords)-1):
-        if polygon.is_valid or polygon.simplify(polygon.area).is_valid:
-            break
-        # simplification may not be possible (at all) due to ordering
-        # in that case, try another starting point
-        polygon = geom.Polygon(polygon.exterior.coords[-split:]+polygon.exterior.coords[:-split])
-    for tolerance in range(1, int(polygon.area)):
-        if polygon.is_valid:
-            break
-        # simplification may require a larger tolerance
-        polygon = polygon.simplify(tolerance)
-    return polygon
+            idx_region = int(tree.query_nearest(line_poly)[0])
+        assigned[idx_region].append(idx_line)
+    return assigned
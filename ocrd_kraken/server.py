@@ -0,0 +1,253 @@
+import os
+import json
+import queue
+import threading
+import importlib
+from collections import OrderedDict
+from multiprocessing import AuthenticationError
+from multiprocessing.connection import Listener, Client
+
+from ocrd_utils import config, getLogger
+
+from .common import ResultChunk, stream_results, collect_results
+from .metrics import PageMetrics, current_metrics, set_current_metrics
+
+def key_path(socket_path):
+    """Path of the file holding the authentication key of the server at ``socket_path``."""
+    return socket_path + '.key'
+
+class KrakenPredictorServer:
+    """
+    Long-lived local daemon keeping Kraken predictors (i.e. loaded models)
+    alive across processor runs. Listens on a unix socket and serves each
+    client connection in its own thread (plus one receiving its tasks, so
+    clients may keep several tasks in flight).
+
+    Clients first attach to a predictor (identified by its class and
+    parameters, so equal models are shared), then send page tasks, each
+    with a sequence number which tags all replies to it. The last reply
+    to a task also carries the predictor metrics recorded for it.
+    Keeps at most ``OCRD_MAX_PROCESSOR_CACHE`` predictors, evicting the
+    least recently used idle one. Predictors which terminated (e.g. because
+    their setup failed) are started anew for the next client.
+
+    Since tasks are unpickled, only the current user may connect: the socket
+    and a random authentication key (next to it, see :py:func:`key_path`)
+    are created accessible to the user only, and clients must know the key.
+    """
+    def __init__(self, socket_path):
+        self.socket_path = socket_path
+        self.logger = getLogger('ocrd.kraken.server')
+        self.predictors = OrderedDict()
+        self.users = {}
+        self.lock = threading.Lock()
+    def serve_forever(self):
+        for path in (self.socket_path, key_path(self.socket_path)):
+            if os.path.lexists(path):
+                os.unlink(path)
+        authkey = os.urandom(32)
+        # create socket and key file without any access for others
+        # (instead of restricting them afterwards, when others could connect already)
+        umask = os.umask(0o077)
+        try:
+            fd = os.open(key_path(self.socket_path), os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+            with os.fdopen(fd, 'wb') as key_file:
+                key_file.write(authkey)
+            listener = Listener(self.socket_path, family='AF_UNIX', authkey=authkey)
+        finally:
+            os.umask(umask)
+        self.logger.info("listening on '%s'", self.socket_path)
+        try:
+            while True:
+                try:
+                    conn = listener.accept()
+                except (AuthenticationError, EOFError, OSError) as e:
+                    self.logger.warning("rejected connection: %s", e)
+                    continue
+                threading.Thread(target=self.serve, args=(conn,), daemon=True).start()
+        except KeyboardInterrupt:
+            self.logger.info("interrupted")
+        finally:
+            listener.close()
+            for predictor in self.predictors.values():
+                predictor.shutdown()
+            for path in (self.socket_path, key_path(self.socket_path)):
+                if os.path.lexists(path):
+                    os.unlink(path)
+    def attach(self, class_path, logger_name, parameter, processes):
+        key = (class_path, json.dumps(parameter, sort_keys=True), processes)
+        with self.lock:
+            if key in self.predictors and self.predictors[key].terminate.is_set():
+                self.logger.warning("restarting terminated %s with %s", *key[:2])
+                self.predictors.pop(key).shutdown()
+            if key in self.predictors:
+                self.predictors.move_to_end(key)
+            else:
+                module_name, class_name = class_path.rsplit('.', 1)
+                cls = getattr(importlib.import_module(module_name), class_name)
+                self.logger.info("starting %s with %s", class_name, key[1])
+                predictor = cls(getLogger(logger_name), parameter, processes=processes)
+                predictor.start()
+                self.predictors[key] = predictor
+                # (clients of a terminated predictor may still be attached)
+                self.users.setdefault(key, 0)
+                for old_key in list(self.predictors):
+                    if len(self.predictors) <= config.OCRD_MAX_PROCESSOR_CACHE:
+                        break
+                    if self.users[old_key] == 0 and old_key != key:
+                        self.logger.info("evicting %s with %s", *old_key[:2])
+                        self.predictors.pop(old_key).shutdown()
+                        del self.users[old_key]
+            self.users[key] += 1
+            return key, self.predictors[key]
+    def detach(self, key):
+        with self.lock:
+            if key in self.users:
+                self.users[key] -= 1
+    def serve(self, conn):
+        key = None
+        try:
+            _, class_path, logger_name, parameter, processes = conn.recv()
+            try:
+                key, predictor = self.attach(class_path, logger_name, parameter, processes)
+            except Exception as e:
+                self.logger.exception("cannot attach to %s", class_path)
+                conn.send(e)
+                return
+            conn.send(None)
+            # receive tasks in another thread, so clients can send their next
+            # task while (large) results of the previous one are still being sent
+            tasks = queue.Queue()
+            threading.Thread(target=self.receive_tasks, args=(conn, predictor, tasks),
+                             daemon=True).start()
+            try:
+                while True:
+                    item = tasks.get()
+                    if item is None:
+                        break
+                    seq, task = item
+                    if isinstance(task, Exception):
+                        conn.send((seq, task, None))
+                        continue
+                    metrics = PageMetrics()
+                    set_current_metrics(metrics)
+                    try:
+                        # forward streamed chunks as they arrive
+                        for result in predictor.replies(task):
+                            last = not isinstance(result, ResultChunk) or not result
+                            conn.send((seq, result, metrics.to_dict() if last else None))
+                    except (EOFError, OSError):
+                        raise
+                    except Exception as e:
+                        conn.send((seq, e, metrics.to_dict()))
+                    finally:
+                        set_current_metrics(None)
+            finally:
+                # release the tasks still pending (until the client disconnects)
+                while item is not None:
+                    item = tasks.get()
+                    if item is not None and not isinstance(item[1], Exception):
+                        predictor.discard(item[1])
+        except (EOFError, OSError):
+            pass # client disconnected
+        finally:
+            conn.close()
+            if key:
+                self.detach(key)
+    @staticmethod
+    def receive_tasks(conn, predictor, tasks):
+        """
+        Submit the tasks received on ``conn`` to ``predictor``, queueing their
+        sequence numbers and handles (or submission errors) on ``tasks`` until
+        the client disconnects.
+        """
+        try:
+            while True:
+                seq, page_id, page_input = conn.recv()
+                try:
+                    tasks.put((seq, predictor.submit(page_id, *page_input)))
+                except Exception as e:
+                    tasks.put((seq, e))
+        except (EOFError, OSError):
+            pass # client disconnected (or connection closed)
+        finally:
+            tasks.put(None)
+
+class KrakenPredictorClient:
+    """
+    Stand-in for a :py:class:`~ocrd_kraken.common.KrakenPredictor`
+    (with the same interface) which delegates to a predictor server.
+
+    Each (forked) process uses its own connection. Tasks are numbered per
+    connection, so replies to tasks whose results were not read completely
+    (e.g. a stream abandoned after an error) can be skipped.
+    """
+    def __init__(self, socket_path, cls, logger, parameter, processes=1):
+        self.socket_path = socket_path
+        self.logger = logger
+        self.attach_msg = ('attach', f'{cls.__module__}.{cls.__qualname__}',
+                           logger.name, parameter, processes)
+        self.conns = {}
+        self.sent = {}
+    def connect(self):
+        pid = os.getpid()
+        if pid not in self.conns:
+            with open(key_path(self.socket_path), 'rb') as key_file:
+                authkey = key_file.read()
+            conn = Client(self.socket_path, family='AF_UNIX', authkey=authkey)
+            conn.send(self.attach_msg)
+            error = conn.recv()
+            if error is not None:
+                conn.close()
+                raise Exception(f"predictor server at '{self.socket_path}' failed to attach") from error
+            self.conns[pid] = conn
+            self.sent[pid] = 0
+        return self.conns[pid]
+    def start(self):
+        self.logger.info("attaching to predictor server at '%s'", self.socket_path)
+        self.connect()
+    def __call__(self, page_id, *page_input):
+        return self.receive(self.submit(page_id, *page_input))
+    def submit(self, page_id, *page_input):
+        conn = self.connect()
+        pid = os.getpid()
+        self.sent[pid] += 1
+        seq = self.sent[pid]
+        conn.send((seq, page_id, page_input))
+        self.logger.debug("sent task %d for '%s'", seq, page_id)
+        return seq, page_id
+    def replies(self, task):
+        # the server replies in order of submission
+        seq, page_id = task
+        conn = self.connect()
+        while True:
+            result_seq, result, record = conn.recv()
+            if result_seq < seq:
+                # left over from an earlier task not read to its end
+                continue
+            if record:
+                # predictor timings measured in the server
+                current_metrics().merge(record)
+            if isinstance(result, Exception):
+                raise Exception(f"predictor failed for {page_id}") from result
+            yield result
+            if not isinstance(result, ResultChunk) or not result:
+                break
+        self.logger.debug("received result for '%s'", page_id)
+    def receive(self, task):
+        return collect_results(self.replies(task))
+    def stream(self, task):
+        return stream_results(self.replies(task))
+    def discard(self, task):
+        # keep the connection in sync
+        try:
+            for _ in self.replies(task):
+                pass
+        except Exception:
+            pass
+    def shutdown(self):
+        # only disconnect, keep the server's predictor alive
+        conn = self.conns.pop(os.getpid(), None)
+        self.sent.pop(os.getpid(), None)
+        if conn:
+            conn.close()
@@ -0,0 +1,187 @@
+"""
+Tiled segmentation of large page images.
+
+Split a page into a grid of overlapping tiles, segment them independently,
+then stitch the results: translate tile coordinates to the page, merge the
+parts of lines and regions which were detected in more than one tile
+(i.e. overlapping within the common area of both tiles), and re-establish
+the reading order on the page.
+"""
+import dataclasses
+from itertools import product
+
+import numpy as np
+import shapely
+from shapely.geometry import Polygon, box
+
+from .geometry import make_valid, make_valid_all, join_polygons
+
+def tile_ranges(length, size, overlap):
+    """Split ``length`` into (start, end) ranges of ``size`` overlapping by at least ``overlap``."""
+    if length <= size:
+        return [(0, length)]
+    count = -(-(length - overlap) // (size - overlap))
+    starts = np.linspace(0, length - size, count).round().astype(int).tolist()
+    return [(start, start + size) for start in starts]
+
+def tile_boxes(width, height, size, overlap):
+    """
+    Grid of tiles of at most ``size`` x ``size`` pixels covering an image,
+    with neighbours overlapping by at least ``overlap`` pixels.
+
+    Return a list of (x0, y0, x1, y1) boxes in row-major order.
+    """
+    return [(x0, y0, x1, y1)
+            for (y0, y1), (x0, x1) in product(tile_ranges(height, size, overlap),
+                                              tile_ranges(width, size, overlap))]
+
+def shift_points(points, dx, dy):
+    return [[x + dx, y + dy] for x, y in points]
+
+def polygon_points(polygon):
+    """Integer exterior points of a (repaired) polygon."""
+    return np.round(polygon.exterior.coords[:-1]).astype(int).tolist()
+
+def duplicate_pairs(polygons, tiles, indexes, threshold=0.5):
+    """
+    Find pairs of ``polygons`` from different tiles which are the same object.
+
+    Given the ``tiles`` boxes and the tile index of each polygon, compare the parts
+    of both polygons within the common area of their tiles: if their intersection
+    covers at least ``threshold`` of the smaller part, they are considered the same.
+    """
+    if len(polygons) < 2:
+        return []
+    polygons = np.array(polygons, dtype=object)
+    prevs, nexts = shapely.STRtree(polygons).query(polygons, predicate='intersects')
+    pairs = []
+    for prev, next_ in zip(prevs.tolist(), nexts.tolist()):
+        if prev >= next_ or indexes[prev] == indexes[next_]:
+            continue
+        common = box(*tiles[indexes[prev]]).intersection(box(*tiles[indexes[next_]]))
+        prev_part = polygons[prev].intersection(common)
+        next_part = polygons[next_].intersection(common)
+        smaller = min(prev_part.area, next_part.area)
+        if smaller > 0 and prev_part.intersection(next_part).area >= threshold * smaller:
+            pairs.append((prev, next_))
+    return pairs
+
+def clusters(count, pairs):
+    """Connected components of ``count`` items linked by ``pairs``, in order of their first item."""
+    parent = list(range(count))
+    def root(idx):
+        while parent[idx] != idx:
+            parent[idx] = parent[parent[idx]]
+            idx = parent[idx]
+        return idx
+    for prev, next_ in pairs:
+        prev, next_ = root(prev), root(next_)
+        parent[max(prev, next_)] = min(prev, next_)
+    groups = {}
+    for idx in range(count):
+        groups.setdefault(root(idx), []).append(idx)
+    return list(groups.values())
+
+def merge_polygons(polygons):
+    """Union of the parts of an object (bridging gaps if they do not overlap)."""
+    if len(polygons) == 1:
+        return polygons[0]
+    merged = shapely.union_all(polygons)
+    if merged.geom_type != 'Polygon':
+        merged = join_polygons(polygons)
+    return make_valid(Polygon(merged.exterior))
+
+def merge_baselines(baselines, vertical=False):
+    """
+    Concatenate the parts of a baseline along the text direction.
+
+    Start with the longest part, then extend it by each part reaching further
+    to either side, switching over at the middle of their overlap (so
+    overlapping parts do not double back, and parts cut at a tile's
+    border only contribute their inner half).
+    """
+    axis = 1 if vertical else 0
+    def extent(points):
+        return min(point[axis] for point in points), max(point[axis] for point in points)
+    baselines = sorted(baselines, key=lambda points: extent(points)[1] - extent(points)[0], reverse=True)
+    merged = list(baselines[0])
+    start, end = extent(merged)
+    for points in baselines[1:]:
+        pstart, pend = extent(points)
+        if pstart < start:
+            seam = (start + min(max(pend, start), end)) / 2
+            merged = [point for point in merged if point[axis] >= seam] + \
+                [point for point in points if point[axis] < seam]
+            start = pstart
+        elif pend > end:
+            seam = (end + max(min(pstart, end), start)) / 2
+            merged = [point for point in merged if point[axis] <= seam] + \
+                [point for point in points if point[axis] > seam]
+            end = pend
+    # keep the direction of the longest part
+    reverse = baselines[0][-1][axis] < baselines[0][0][axis]
+    return sorted(merged, key=lambda point: point[axis], reverse=reverse)
+
+def reading_order(lines, regions, text_direction):
+    """Indices of ``lines`` in Kraken's (polygonal) reading order."""
+    from kraken.lib.segmentation import polygonal_reading_order
+    try:
+        return polygonal_reading_order(lines=lines, regions=regions,
+                                       text_direction=text_direction[-2:])
+    except TypeError:
+        # Kraken<6 expects line dicts and region polygons
+        return polygonal_reading_order(lines=[dataclasses.asdict(line) for line in lines],
+                                       regions=[Polygon(region.boundary) for region in regions],
+                                       text_direction=text_direction[-2:])
+
+def stitch_tiles(results, tiles, text_direction='horizontal-lr'):
+    """
+    Combine the segmentation ``results`` of tiles into one for the page.
+
+    Given the list of ``tiles`` (see :py:func:`tile_boxes`) for the list of
+    results (blla ``Segmentation`` relative to the tiles), merge lines and
+    regions across tiles and return a ``Segmentation`` of the page.
+    """
+    # regions (by type)
+    regions = {}
+    region_ids = {}
+    region_types = list(dict.fromkeys(type_ for res in results for type_ in res.regions))
+    for type_ in region_types:
+        parts = [(idx, dataclasses.replace(region, boundary=shift_points(region.boundary, *tiles[idx][:2])))
+                 for idx, res in enumerate(results) for region in res.regions.get(type_, [])]
+        polygons = make_valid_all(Polygon(part.boundary) for _, part in parts)
+        indexes = [idx for idx, _ in parts]
+        regions[type_] = []
+        for group in clusters(len(parts), duplicate_pairs(polygons, tiles, indexes)):
+            region = parts[group[0]][1]
+            if len(group) > 1:
+                region = dataclasses.replace(region, boundary=polygon_points(
+                    merge_polygons([polygons[idx] for idx in group])))
+            for idx in group:
+                region_ids[parts[idx][1].id] = region.id
+            regions[type_].append(region)
+    # lines
+    parts = [(idx, dataclasses.replace(line,
+                                       baseline=shift_points(line.baseline, *tiles[idx][:2]),
+                                       boundary=shift_points(line.boundary, *tiles[idx][:2])))
+             for idx, res in enumerate(results) for line in res.lines]
+    polygons = make_valid_all(Polygon(part.boundary) for _, part in parts)
+    indexes = [idx for idx, _ in parts]
+    lines = []
+    for group in clusters(len(parts), duplicate_pairs(polygons, tiles, indexes)):
+        # keep the attributes of the largest part
+        largest = max(group, key=lambda idx: polygons[idx].area)
+        line = parts[largest][1]
+        if len(group) > 1:
+            line = dataclasses.replace(
+                line,
+                baseline=merge_baselines([parts[idx][1].baseline for idx in group],
+                                         vertical=text_direction.startswith('vertical')),
+                boundary=polygon_points(merge_polygons([polygons[idx] for idx in group])))
+        line_regions = [region_ids.get(region_id, region_id)
+                        for idx in group for region_id in parts[idx][1].regions or []]
+        lines.append(dataclasses.replace(line, regions=list(dict.fromkeys(line_regions))))
+    if lines:
+        all_regions = [region for type_ in regions for region in regions[type_]]
+        lines = [lines[idx] for idx in reading_order(lines, all_regions, text_direction)]
+    return dataclasses.replace(results[0], lines=lines, regions=regions, line_orders=[])
@@ -0,0 +1,85 @@
+import os
+import sys
+import json
+import platform
+import subprocess
+
+import pytest
+
+BASELINES = os.path.join(os.path.dirname(__file__), 'baselines.json')
+# maximum relative regression (unless stored with the baselines or given via --benchmark-threshold)
+THRESHOLD = 0.25
+
+def run_isolated(function, *args):
+    """
+    Call ``function`` (module-level, returning JSON) with ``args`` (JSON)
+    in a fresh interpreter, so its memory gets measured on its own
+    (instead of the peak of the whole session so far).
+
+    Return its result and its peak resident set size in MB (including
+    the model processes it waited for).
+    """
+    script = (f"import sys, json; from {function.__module__} import {function.__name__}; "
+              f"print(json.dumps({function.__name__}(*json.loads(sys.argv[1]))))")
+    # (from the directory containing the tests package)
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(
+        filter(None, [os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))),
+                      os.environ.get('PYTHONPATH')])))
+    with subprocess.Popen([sys.executable, '-c', script, json.dumps(args)],
+                          stdout=subprocess.PIPE, text=True, env=env) as child:
+        output = child.stdout.read()
+        # wait via wait4 for the child's resource usage
+        _, status, usage = os.wait4(child.pid, 0)
+        child.returncode = os.waitstatus_to_exitcode(status)
+    assert child.returncode == 0, f"{function.__name__} failed in subprocess"
+    # (ru_maxrss is in KiB on Linux)
+    return json.loads(output.strip().splitlines()[-1]), usage.ru_maxrss / 1024
+
+@pytest.fixture(scope='session')
+def baselines(request):
+    """
+    Stored baselines: the ``results`` of each benchmark, along with the
+    ``threshold`` they were stored for and the ``machine`` they were measured on.
+    """
+    try:
+        with open(BASELINES, encoding='utf-8') as baselines_file:
+            baselines = json.load(baselines_file)
+    except FileNotFoundError:
+        baselines = {}
+    baselines.setdefault('results', {})
+    baselines.setdefault('threshold', THRESHOLD)
+    yield baselines
+    if request.config.getoption('benchmark_save'):
+        threshold = request.config.getoption('benchmark_threshold')
+        if threshold is not None:
+            baselines['threshold'] = threshold
+        baselines['machine'] = f"{platform.machine()}, {os.cpu_count()} CPUs, Python {platform.python_version()}"
+        with open(BASELINES, 'w', encoding='utf-8') as baselines_file:
+            json.dump(baselines, baselines_file, indent=2, sort_keys=True)
+
+@pytest.fixture
+def benchmark_compare(request, baselines):
+    """
+    Report measurements of the current benchmark and compare those which
+    are lower-is-better (``results``) against the stored baselines.
+    """
+    def compare(results, report=None):
+        name = request.node.name
+        print(f"\n{name}:")
+        for key, value in sorted(dict(results, **(report or {})).items()):
+            print(f"    {key:30s} {value:12.4f}")
+        if request.config.getoption('benchmark_save'):
+            baselines['results'][name] = results
+            return
+        baseline = baselines['results'].get(name)
+        if baseline is None:
+            pytest.skip(f"no baseline for {name} (store one with --benchmark-save)")
+        threshold = request.config.getoption('benchmark_threshold')
+        if threshold is None:
+            threshold = baselines['threshold']
+        regressions = [f"{key}: {value:.4f} > {baseline[key]:.4f}"
+                       for key, value in results.items()
+                       if key in baseline
+                       and value > baseline[key] * (1 + threshold)]
+        assert not regressions, f"{name} regressed by more than {threshold:.0%}: " + ", ".join(regressions)
+    return compare
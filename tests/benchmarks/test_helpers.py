@@ -0,0 +1,106 @@
+# pylint: disable=import-error
+
+import timeit
+
+import pytest
+import numpy as np
+from shapely.geometry import Polygon, box
+
+from ocrd_utils import points_from_bbox
+from ocrd_models.ocrd_page import (
+    PcGtsType,
+    PageType,
+    TextRegionType,
+    TextLineType,
+    WordType,
+    GlyphType,
+    TextEquivType,
+    CoordsType,
+)
+
+from ocrd_kraken.segment import lines_in_regions, segment_mask
+from ocrd_kraken.recognize import (
+    join_polygons,
+    make_valid,
+    page_update_higher_textequiv_levels,
+    bboxes_for_polygons,
+)
+
+pytestmark = pytest.mark.benchmark
+
+def best_of(func, number, repeat=5):
+    """Minimum seconds per call of ``func``."""
+    return min(timeit.repeat(func, number=number, repeat=repeat)) / number
+
+def self_intersecting_boundary(npoints=400):
+    """Line boundary like kraken's with a twist (self-intersection) in the middle."""
+    xs = np.linspace(0, 2000, npoints // 2)
+    top = np.stack([xs, 10 * np.sin(xs / 50)], axis=1)
+    bottom = np.stack([xs[::-1], 40 + 10 * np.cos(xs[::-1] / 30)], axis=1)
+    bottom[npoints // 4 - 2: npoints // 4 + 2, 1] = -20
+    return Polygon(np.concatenate([top, bottom]))
+
+def fragments(number):
+    return [box(i * 60, 5 * (i % 3), i * 60 + 50, 40 + 5 * (i % 3)) for i in range(number)]
+
+def synthetic_page(nregions=10, nlines=20, nwords=8):
+    page = PageType(imageWidth=2000, imageHeight=3000, imageFilename='dummy.png')
+    for idx_region in range(nregions):
+        region = TextRegionType(id=f'r{idx_region}', Coords=CoordsType(points_from_bbox(0, 0, 10, 10)))
+        for idx_line in range(nlines):
+            line = TextLineType(id=f'r{idx_region}l{idx_line}', Coords=CoordsType(points_from_bbox(0, 0, 10, 10)))
+            line.add_TextEquiv(TextEquivType(Unicode=' '.join(['lorem'] * nwords), conf=0.9))
+            for idx_word in range(nwords):
+                word = WordType(id=f'{line.id}w{idx_word}', Coords=CoordsType(points_from_bbox(0, 0, 10, 10)))
+                word.add_TextEquiv(TextEquivType(Unicode='lorem', conf=0.9))
+                for idx_glyph, char in enumerate('lorem'):
+                    glyph = GlyphType(id=f'{word.id}g{idx_glyph}', Coords=CoordsType(points_from_bbox(0, 0, 10, 10)))
+                    glyph.add_TextEquiv(TextEquivType(Unicode=char, conf=0.9))
+                    word.add_Glyph(glyph)
+                line.add_Word(word)
+            region.add_TextLine(line)
+        page.add_TextRegion(region)
+    return PcGtsType(pcGtsId='dummy', Page=page)
+
+def test_make_valid(benchmark_compare):
+    polygon = self_intersecting_boundary()
+    assert not polygon.is_valid
+    assert make_valid(polygon).is_valid
+    benchmark_compare({'seconds_per_call': best_of(lambda: make_valid(polygon), 1, repeat=3)})
+
+@pytest.mark.parametrize('number', [2, 10, 50, 200])
+def test_join_polygons(number, benchmark_compare):
+    polygons = fragments(number)
+    assert join_polygons(polygons).geom_type == 'Polygon'
+    benchmark_compare({'seconds_per_call': best_of(lambda: join_polygons(polygons), 10)})
+
+def test_bboxes_for_polygons(benchmark_compare):
+    # glyph cuts of a dense page, rotated by 1°
+    polygons = [[(x, y), (x + 12, y), (x + 12, y + 30), (x, y + 30)]
+                for y in range(0, 3000, 40) for x in range(0, 2000, 12)]
+    angle = np.deg2rad(1)
+    coords = {'transform': np.array([[np.cos(angle), -np.sin(angle), 0],
+                                     [np.sin(angle), np.cos(angle), 0],
+                                     [0, 0, 1]])}
+    assert bboxes_for_polygons(polygons, coords).shape == (len(polygons), 4)
+    benchmark_compare({'seconds_per_call': best_of(lambda: bboxes_for_polygons(polygons, coords), 3)})
+
+def test_page_update_higher_textequiv_levels(benchmark_compare):
+    pcgts = synthetic_page()
+    benchmark_compare({'seconds_per_call': best_of(
+        lambda: page_update_higher_textequiv_levels('glyph', pcgts), 3)})
+
+def test_lines_in_regions(benchmark_compare):
+    # two columns of 40 regions with 15 lines each
+    lines = [box(x + 10, y, x + 890, y + 30) for x in (0, 1000) for y in range(0, 24000, 40)]
+    regions = [box(x, y - 10, x + 900, y + 600) for x in (0, 1000) for y in range(0, 24000, 600)]
+    assert sum(map(len, lines_in_regions(regions, lines))) == len(lines)
+    benchmark_compare({'seconds_per_call': best_of(lambda: lines_in_regions(regions, lines), 3)})
+
+def test_segment_mask(benchmark_compare):
+    # A4 page at 300 DPI with 100 existing regions
+    border = [[10, 10], [2470, 10], [2470, 3500], [10, 3500]]
+    regions = [[[x, y], [x + 200, y], [x + 200, y + 300], [x, y + 300]]
+               for x in range(100, 2400, 230) for y in range(100, 3400, 340)]
+    assert segment_mask((2480, 3508), [border], regions).size == (2480, 3508)
+    benchmark_compare({'seconds_per_call': best_of(lambda: segment_mask((2480, 3508), [border], regions), 3)})
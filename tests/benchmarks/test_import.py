@@ -0,0 +1,30 @@
+# pylint: disable=import-error
+
+import sys
+import json
+import subprocess
+
+import pytest
+
+CLIS = ['binarize', 'segment', 'recognize', 'server']
+
+# only to be imported when actually processing pages (or in the predictor processes)
+HEAVY_MODULES = ['torch', 'kraken', 'scipy', 'regex']
+
+def import_cli(name):
+    """Import the CLI module in a fresh interpreter, return import time and heavy modules loaded."""
+    script = (f"import sys, time, json; start = time.perf_counter(); "
+              f"import ocrd_kraken.cli.{name}; seconds = time.perf_counter() - start; "
+              f"print(json.dumps([seconds, [mod for mod in {HEAVY_MODULES!r} if mod in sys.modules]]))")
+    output = subprocess.run([sys.executable, '-c', script], check=True, capture_output=True, text=True).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+@pytest.mark.parametrize('name', CLIS)
+def test_lazy_imports(name):
+    _, modules = import_cli(name)
+    assert not modules, f"ocrd_kraken.cli.{name} imports {modules} at startup"
+
+@pytest.mark.benchmark
+@pytest.mark.parametrize('name', CLIS)
+def test_import_time(name, benchmark_compare):
+    benchmark_compare({'seconds': min(import_cli(name)[0] for _ in range(3))})
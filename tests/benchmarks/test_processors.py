@@ -0,0 +1,193 @@
+# pylint: disable=import-error
+
+import os
+import json
+import time
+import importlib
+
+import pytest
+from PIL import Image, ImageDraw, ImageFont
+
+from ocrd import Resolver, run_processor
+from ocrd_utils import MIMETYPE_PAGE, initLogging, pushd_popd, points_from_polygon, points_from_bbox
+from ocrd_models.ocrd_page import TextRegionType, TextLineType, CoordsType, BaselineType, to_xml
+from ocrd_modelfactory import page_from_image
+
+from ocrd_kraken.binarize import KrakenBinarize
+from ocrd_kraken.segment import KrakenSegment
+from ocrd_kraken.recognize import KrakenRecognize
+
+from .conftest import run_isolated
+
+pytestmark = pytest.mark.benchmark
+
+TEXT = ("It is the object of this little treatise to give an account of the "
+        "principles of enlightenment, which is man's emergence from his self-imposed "
+        "immaturity, and of the courage required to use one's own understanding. ")
+
+# name: (width, height, number of lines)
+SIZES = {
+    'small': (1240, 1754, 25),
+    'large': (2480, 3508, 80),
+}
+
+NPAGES = 3
+
+def make_page(ws, idx, width, height, nlines):
+    """Render a synthetic single-column page with GT line segmentation."""
+    margin = width // 10
+    pitch = (height - 2 * margin) // nlines
+    font = ImageFont.load_default(size=int(pitch * 0.6))
+    image = Image.new('L', (width, height), 255)
+    draw = ImageDraw.Draw(image)
+    lines = []
+    offset = 0
+    for idx_line in range(nlines):
+        top = margin + idx_line * pitch
+        text = (TEXT * 3)[offset:offset + 4 * (width - 2 * margin) // pitch]
+        offset = (offset + 37) % len(TEXT)
+        draw.text((margin, top), text, font=font, fill=0)
+        left, ymin, right, ymax = draw.textbbox((margin, top), text, font=font)
+        right = min(right, width - margin)
+        baseline = top + font.getmetrics()[0]
+        lines.append(TextLineType(
+            id=f'region1_line{idx_line + 1}',
+            Coords=CoordsType(points=points_from_bbox(left, ymin - 2, right, ymax + 2)),
+            Baseline=BaselineType(points=points_from_polygon([[left, baseline], [right, baseline]]))))
+    page_id = f'PHYS_{idx:04d}'
+    os.makedirs('OCR-D-IMG', exist_ok=True)
+    image.save(f'OCR-D-IMG/OCR-D-IMG_{idx:04d}.png')
+    image_file = ws.add_file('OCR-D-IMG', file_id=f'OCR-D-IMG_{idx:04d}', page_id=page_id,
+                             mimetype='image/png', local_filename=f'OCR-D-IMG/OCR-D-IMG_{idx:04d}.png')
+    pcgts = page_from_image(image_file)
+    region = TextRegionType(id='region1', Coords=CoordsType(points=points_from_bbox(
+        margin, margin, width - margin, height - margin)), TextLine=lines)
+    pcgts.get_Page().add_TextRegion(region)
+    ws.add_file('OCR-D-GT-SEG-LINE', file_id=f'OCR-D-GT-SEG-LINE_{idx:04d}', page_id=page_id,
+                mimetype=MIMETYPE_PAGE, local_filename=f'OCR-D-GT-SEG-LINE/OCR-D-GT-SEG-LINE_{idx:04d}.xml',
+                content=to_xml(pcgts))
+
+@pytest.fixture(params=list(SIZES))
+def workspace_synthetic(tmpdir, request):
+    with pushd_popd(tmpdir):
+        ws = Resolver().workspace_from_nothing(directory=str(tmpdir))
+        for idx in range(NPAGES):
+            make_page(ws, idx + 1, *SIZES[request.param])
+        ws.save_mets()
+        yield {'workspace': ws}
+
+@pytest.fixture(scope='session')
+def recognition_model(tmp_path_factory):
+    """
+    Save a recognition model with Kraken's default architecture, but random
+    weights (so no model needs to be downloaded; the output is garbage, but
+    takes as much computation as with a trained model).
+    """
+    import torch
+    from kraken.lib.vgsl import TorchVGSLModel
+    from kraken.lib.codec import PytorchCodec
+    torch.manual_seed(0)
+    alphabet = ''.join(sorted(set(TEXT)))
+    spec = ('[1,120,0,1 Cr3,13,32 Do0.1,2 Mp2,2 Cr3,13,32 Do0.1,2 Mp2,2 Cr3,9,64 Do0.1,2 Mp2,2 '
+            f'Cr3,9,64 Do0.1,2 S1(1x0)1,3 Lbx200 Do0.1,2 Lbx200 Do0.1,2 Lbx200 Do O1c{len(alphabet) + 1}]')
+    try:
+        nn = TorchVGSLModel(vgsl=spec)
+    except TypeError:
+        # Kraken<7
+        nn = TorchVGSLModel(spec)
+        nn.init_weights()
+    nn.add_codec(PytorchCodec(alphabet))
+    nn.model_type = 'recognition'
+    nn.seg_type = 'baselines'
+    nn.use_legacy_polygons = False
+    path = str(tmp_path_factory.mktemp('model') / 'default.mlmodel')
+    nn.save_model(path)
+    return path
+
+def process(processor_path, input_file_grp, output_file_grp, parameter, mets_path):
+    """Run the processor (in a fresh interpreter) on the workspace, return its wall time."""
+    module_name, class_name = processor_path.rsplit('.', 1)
+    processor = getattr(importlib.import_module(module_name), class_name)
+    initLogging()
+    workspace = Resolver().workspace_from_url(mets_path)
+    start = time.perf_counter()
+    run_processor(processor,
+                  input_file_grp=input_file_grp,
+                  output_file_grp=output_file_grp,
+                  parameter=parameter,
+                  workspace=workspace)
+    seconds = time.perf_counter() - start
+    workspace.save_mets()
+    return seconds
+
+def run_benchmark(processor, input_file_grp, output_file_grp, parameter, workspace, metrics_path):
+    os.environ['OCRD_KRAKEN_METRICS'] = metrics_path
+    try:
+        seconds, rss = run_isolated(process, f'{processor.__module__}.{processor.__name__}',
+                                    input_file_grp, output_file_grp, parameter,
+                                    workspace['workspace'].mets_target)
+    finally:
+        del os.environ['OCRD_KRAKEN_METRICS']
+    records = []
+    if os.path.exists(metrics_path):
+        with open(metrics_path, encoding='utf-8') as lines:
+            records = [json.loads(line) for line in lines]
+    npages = len(records) or NPAGES
+    nlines = sum(record['counts'].get('lines', 0) for record in records)
+    page_seconds = sum(record['total'] for record in records) or seconds
+    results = {'seconds': seconds,
+               'seconds_per_page': page_seconds / npages,
+               'peak_rss_mb': rss}
+    report = {'pages_per_second': npages / page_seconds}
+    if nlines:
+        report['lines_per_second'] = nlines / page_seconds
+    for record in records:
+        for stage, duration in record['stages'].items():
+            report[f'stage_{stage}'] = report.get(f'stage_{stage}', 0) + duration / npages
+    return results, report
+
+def binarize(workspace):
+    run_processor(KrakenBinarize,
+                  input_file_grp='OCR-D-GT-SEG-LINE',
+                  output_file_grp='OCR-D-GT-SEG-LINE-BIN',
+                  **workspace)
+    workspace['workspace'].save_mets()
+
+def test_binarize(workspace_synthetic, tmpdir, benchmark_compare):
+    benchmark_compare(*run_benchmark(KrakenBinarize, 'OCR-D-IMG', 'OCR-D-BIN', {},
+                                     workspace_synthetic, str(tmpdir.join('metrics.jsonl'))))
+
+def test_segment_blla(workspace_synthetic, tmpdir, benchmark_compare):
+    benchmark_compare(*run_benchmark(KrakenSegment, 'OCR-D-IMG', 'OCR-D-SEG',
+                                     {'maxcolseps': 0, 'use_legacy': False, 'device': 'cpu'},
+                                     workspace_synthetic, str(tmpdir.join('metrics.jsonl'))))
+
+def test_segment_legacy(workspace_synthetic, tmpdir, benchmark_compare):
+    binarize(workspace_synthetic)
+    benchmark_compare(*run_benchmark(KrakenSegment, 'OCR-D-GT-SEG-LINE-BIN', 'OCR-D-SEG',
+                                     {'maxcolseps': 0, 'use_legacy': True, 'overwrite_segments': True},
+                                     workspace_synthetic, str(tmpdir.join('metrics.jsonl'))))
+
+def test_recognize(workspace_synthetic, recognition_model, tmpdir, benchmark_compare):
+    binarize(workspace_synthetic)
+    benchmark_compare(*run_benchmark(KrakenRecognize, 'OCR-D-GT-SEG-LINE-BIN', 'OCR-D-OCR',
+                                     {'overwrite_text': True, 'device': 'cpu',
+                                      'model': recognition_model},
+                                     workspace_synthetic, str(tmpdir.join('metrics.jsonl'))))
+
+@pytest.mark.parametrize('workspace', [''], indirect=True)
+def test_recognize_asset(workspace_aufklaerung, tmpdir, benchmark_compare):
+    run_processor(KrakenBinarize,
+                  input_file_grp='OCR-D-GT-PAGE',
+                  output_file_grp='OCR-D-GT-PAGE-BIN',
+                  **workspace_aufklaerung)
+    workspace_aufklaerung['workspace'].save_mets()
+    benchmark_compare(*run_benchmark(KrakenRecognize, 'OCR-D-GT-PAGE-BIN', 'OCR-D-OCR',
+                                     {'overwrite_text': True, 'device': 'cpu'},
+                                     workspace_aufklaerung, str(tmpdir.join('metrics.jsonl'))))
+
+@pytest.mark.parametrize('workspace', [''], indirect=True)
+def test_segment_blla_asset(workspace_aufklaerung, tmpdir, benchmark_compare):
+    benchmark_compare(*run_benchmark(KrakenSegment, 'OCR-D-IMG', 'OCR-D-SEG',
+                                     {'maxcolseps': 0, 'use_legacy': False, 'device': 'cpu'},
+                                     workspace_aufklaerung, str(tmpdir.join('metrics.jsonl'))))
@@ -11,6 +11,23 @@ from .assets import assets
 
 CONFIGS = ['', 'pageparallel', 'metscache', 'pageparallel+metscache']
 
+def pytest_addoption(parser):
+    parser.addoption('--benchmark', action='store_true',
+                     help='run the benchmarks (in tests/benchmarks)')
+    parser.addoption('--benchmark-save', action='store_true',
+                     help='store benchmark results as new baselines')
+    parser.addoption('--benchmark-threshold', type=float, default=None,
+                     help='maximum relative regression of benchmark results against baselines '
+                     '(default: as stored with the baselines, or 0.25)')
+
+def pytest_collection_modifyitems(config, items):
+    if config.getoption('benchmark'):
+        return
+    skip = pytest.mark.skip(reason='benchmarks only run with --benchmark')
+    for item in items:
+        if 'benchmark' in item.keywords:
+            item.add_marker(skip)
+
 @pytest.fixture(params=CONFIGS)
 def workspace(tmpdir, pytestconfig, request):
     def _make_workspace(workspace_path):
@@ -0,0 +1,34 @@
+# pylint: disable=import-error
+
+from PIL import Image
+
+from ocrd_kraken.cache import LineCache, line_key
+
+
+def test_line_key():
+    image = Image.new('L', (100, 30), 255)
+    key = line_key('model', image, [[0, 20], [100, 20]])
+    assert key == line_key('model', image.copy(), [[0, 20], [100, 20]])
+    assert key != line_key('other', image, [[0, 20], [100, 20]])
+    assert key != line_key('model', image, [[0, 21], [100, 21]])
+    image.putpixel((50, 15), 0)
+    assert key != line_key('model', image, [[0, 20], [100, 20]])
+
+def test_line_cache(tmpdir):
+    cache = LineCache(str(tmpdir.join('lines.db')), size_mb=0.0005) # about 3 records
+    record = ('abc', [[[0, 0], [1, 0], [1, 10], [0, 10]]] * 3, [0.9, 0.8, 0.7])
+    cache.put({'a': record, 'b': record})
+    found = cache.get(['a', 'b', 'c'])
+    assert set(found) == {'a', 'b'}
+    assert tuple(found['a']) == record
+    assert found['a'].prediction == 'abc'
+    # touch a, so b gets evicted first
+    cache.get(['a'])
+    cache.put({'x0': record})
+    cache.put({'x1': record})
+    assert set(cache.get(['a', 'b', 'x0', 'x1'])) == {'a', 'x0', 'x1'}
+    cache.close()
+    # persistent
+    cache = LineCache(str(tmpdir.join('lines.db')))
+    assert cache.get(['x1'])
+    cache.close()
@@ -0,0 +1,117 @@
+# pylint: disable=import-error
+
+import os
+
+import torch
+from PIL import Image
+
+from ocrd_utils import getLogger
+
+from ocrd_kraken.common import (
+    KrakenPredictor, model_checksum, optimize_model, best_path, text_sample)
+from ocrd_kraken.recognize import KrakenRecognizePredictor
+from ocrd_kraken.segment import KrakenSegmentPredictor
+
+
+class RecurrentNet(torch.nn.Module):
+    """Minimal stand-in for a VGSL network (returning output and lengths)."""
+    def __init__(self):
+        super().__init__()
+        self.lstm = torch.nn.LSTM(8, 16, batch_first=True)
+        self.lin = torch.nn.Linear(16, 4)
+    def forward(self, inputs, seq_len=None):
+        o, _ = self.lstm(inputs)
+        return torch.softmax(self.lin(o), dim=2), seq_len
+
+class SizePredictor(KrakenPredictor):
+    """Predictor returning the size of each image (sharing one call across pages)."""
+    def setup(self):
+        pass
+    def batchable(self):
+        return True
+    def predict_batch(self, batch):
+        return [image.size for image, in batch]
+
+def test_optimize_model(tmpdir, monkeypatch):
+    monkeypatch.setenv('OCRD_KRAKEN_MODEL_CACHE', str(tmpdir.join('cache')))
+    torch.manual_seed(0)
+    net = RecurrentNet()
+    model_path = str(tmpdir.join('model.pt'))
+    torch.save(net.state_dict(), model_path)
+    logger = getLogger('ocrd.kraken.test')
+    sample = torch.rand(1, 50, 8)
+    optimized = optimize_model(net, model_path, 'quantize', sample, logger)
+    assert optimized is not net
+    cached = os.listdir(str(tmpdir.join('cache')))
+    assert cached == [f'{model_checksum(model_path)}-quantize-torch{torch.__version__}.pt']
+    # second run loads from cache
+    reloaded = optimize_model(net, model_path, 'quantize', sample, logger)
+    assert torch.equal(reloaded(sample)[0], optimized(sample)[0])
+    # invalid optimization falls back to the original
+    other_path = str(tmpdir.join('other.pt'))
+    torch.save({}, other_path)
+    assert optimize_model(net, other_path, 'quantize', sample, logger, tolerance=0) is net
+    # so does an optimization that decodes differently
+    assert optimize_model(net, other_path, 'quantize', sample, logger,
+                          labels=lambda outputs: outputs.tolist()) is net
+    assert len(os.listdir(str(tmpdir.join('cache')))) == 1
+
+def test_best_path():
+    outputs = torch.zeros(1, 4, 8)
+    for pos, label in enumerate([0, 2, 2, 0, 2, 3, 3, 1]):
+        outputs[0, label, pos] = 1
+    assert best_path(outputs) == [2, 2, 3, 1]
+    assert best_path(outputs.transpose(1, 2), axis=2) == [2, 2, 3, 1]
+
+def test_text_sample():
+    image = text_sample(48)
+    assert image.mode == 'L'
+    assert image.height == 48
+    assert image.width > 10 * image.height
+    assert image.getextrema() == (0, 255)
+    assert text_sample(256, 256, lines=4).size == (256, 256)
+
+def test_text_sample_bitmap_font(monkeypatch):
+    # Pillow < 10.1 cannot scale its default font
+    from PIL import ImageFont
+    load_default = ImageFont.load_default
+    def load_bitmap_default(**kwargs):
+        if kwargs:
+            raise TypeError("load_default() got an unexpected keyword argument 'size'")
+        return load_default()
+    monkeypatch.setattr(ImageFont, 'load_default', load_bitmap_default)
+    image = text_sample(48)
+    assert image.height == 48
+    assert image.width > 10 * image.height
+    assert image.getextrema() == (0, 255)
+    assert text_sample(256, 256, lines=4).size == (256, 256)
+
+def test_predictor_batchable(monkeypatch):
+    logger = getLogger('ocrd.kraken.test')
+    class Predictor(KrakenPredictor):
+        def predict(self, *inputs):
+            return inputs
+    # predicting one page after another gains nothing from waiting for more
+    assert not Predictor(logger, {}).batchable()
+    assert not KrakenSegmentPredictor(logger, {}).batchable()
+    monkeypatch.setenv('OCRD_KRAKEN_LINE_BATCH_SIZE', '0')
+    assert not KrakenRecognizePredictor(logger, {}).batchable()
+    monkeypatch.setenv('OCRD_KRAKEN_LINE_BATCH_SIZE', '16')
+    predictor = KrakenRecognizePredictor(logger, {})
+    assert predictor.batchable()
+    predictor.parameter['extra_models'] = ['other']
+    assert not predictor.batchable()
+
+def test_predictor_discarded(monkeypatch):
+    monkeypatch.setenv('OCRD_KRAKEN_SHARED_MEMORY', 'true')
+    monkeypatch.setenv('OCRD_KRAKEN_BATCH_SIZE', '2')
+    predictor = SizePredictor(getLogger('ocrd.kraken.test'), {})
+    task1 = predictor.submit('page1', Image.new('L', (30, 20)))
+    task2 = predictor.submit('page2', Image.new('L', (40, 20)))
+    # shared memory of the second task is gone before the batch gets predicted
+    predictor.discard(task2)
+    predictor.start()
+    try:
+        assert predictor.receive(task1) == (30, 20)
+    finally:
+        predictor.shutdown()
@@ -0,0 +1,47 @@
+# pylint: disable=import-error
+
+import numpy as np
+from shapely import make_valid
+from shapely.geometry import Polygon, box
+
+from ocrd_kraken.geometry import repair_polygon, make_valid_all, join_polygons, polygon_distances
+
+
+def test_repair_polygon():
+    square = box(0, 0, 100, 20)
+    assert repair_polygon(square) == (square, 'valid')
+    # small loop in the top edge
+    twisted = Polygon([(0, 0), (80, 0), (70, -6), (70, 4), (100, 0), (100, 20), (0, 20)])
+    assert not twisted.is_valid
+    polygon, strategy = repair_polygon(twisted)
+    assert strategy == 'make_valid'
+    assert polygon.is_valid and polygon.area >= 0.9 * square.area
+    # pinched line (two equally large halves)
+    pinched = Polygon([(0, 0), (100, 20), (200, 0), (200, 20), (100, 0), (0, 20)])
+    polygon, strategy = repair_polygon(pinched)
+    assert strategy == 'closing'
+    assert polygon.is_valid and polygon.area >= 0.9 * make_valid(pinched).area
+    # degenerate
+    line = Polygon([(0, 0), (50, 0), (100, 0)])
+    assert repair_polygon(line) == (line, 'none')
+
+def test_make_valid_all():
+    polygons = [box(0, 0, 10, 10), Polygon([(0, 0), (10, 10), (10, 0), (0, 10)]), box(5, 5, 20, 20)]
+    repaired = make_valid_all(polygons)
+    assert repaired[0] is polygons[0] and repaired[2] is polygons[2]
+    assert repaired[1].is_valid
+
+def test_join_polygons():
+    fragments = [box(i * 60, 5 * (i % 3), i * 60 + 50, 40 + 5 * (i % 3)) for i in range(30)]
+    joint = join_polygons(fragments)
+    assert joint.geom_type == 'Polygon' and joint.is_valid
+    assert all(joint.contains(fragment) for fragment in fragments)
+    # sparse (STRtree) graph has the same spanning tree as the dense one
+    from scipy.sparse.csgraph import minimum_spanning_tree
+    fragments = np.array(fragments, dtype=object)
+    dense = minimum_spanning_tree(polygon_distances(fragments, dense_max=len(fragments)))
+    sparse = minimum_spanning_tree(polygon_distances(fragments, dense_max=0))
+    assert np.isclose(dense.sum(), sparse.sum())
+    # two-polygon fast path
+    joint = join_polygons(fragments[:2])
+    assert joint.geom_type == 'Polygon' and joint.contains(fragments[0]) and joint.contains(fragments[1])
@@ -1,16 +1,35 @@
 # pylint: disable=import-error
 
 import os
+import gc
+import json
+
+import numpy as np
 
 from ocrd import run_processor
-from ocrd_utils import MIMETYPE_PAGE
+from ocrd_utils import (
+    MIMETYPE_PAGE,
+    bbox_from_polygon,
+    coordinates_for_segment,
+    scale_coordinates,
+    shift_coordinates,
+)
 from ocrd_models.constants import NAMESPACES
 from ocrd_modelfactory import page_from_file
 
-from ocrd_kraken.recognize import KrakenRecognize
+from ocrd_kraken.recognize import KrakenRecognize, bboxes_for_polygons, avoid_empty_bboxes
 from ocrd_kraken.binarize import KrakenBinarize
 
 
+def line_texts(ws, file_grp):
+    """Map the IDs of all lines in ``file_grp`` to their (first) text."""
+    texts = {}
+    for out_file in ws.find_files(file_grp=file_grp, mimetype=MIMETYPE_PAGE):
+        for line in page_from_file(out_file).get_Page().get_AllTextLines():
+            texts[out_file.pageId, line.id] = line.get_TextEquiv()[0].Unicode
+    assert texts, f"found no lines in {file_grp}"
+    return texts
+
 def test_recognize(workspace_aufklaerung):
     # some models (like default en) require binarized images
     run_processor(KrakenBinarize,
@@ -34,3 +53,310 @@ def test_recognize(workspace_aufklaerung):
     result0 = page_from_file(result0)
     text0 = result0.etree.xpath('//page:Glyph/page:TextEquiv/page:Unicode', namespaces=NAMESPACES)
     assert len(text0) > 0, "found no glyph text in output PAGE file"
+
+def test_recognize_incremental(workspace_aufklaerung):
+    run_processor(KrakenBinarize,
+                  input_file_grp="OCR-D-GT-PAGE",
+                  output_file_grp="OCR-D-GT-PAGE-BIN",
+                  **workspace_aufklaerung,
+    )
+    run_processor(KrakenRecognize,
+                  # GT lines all have text already:
+                  input_file_grp="OCR-D-GT-PAGE-BIN",
+                  output_file_grp="OCR-D-OCR-KRAKEN",
+                  parameter={'incremental': True},
+                  **workspace_aufklaerung,
+    )
+    ws = workspace_aufklaerung['workspace']
+    ws.save_mets()
+    result0 = next(ws.find_files(file_grp='OCR-D-OCR-KRAKEN', mimetype=MIMETYPE_PAGE), False)
+    assert result0, "found no output PAGE file"
+    result0 = page_from_file(result0)
+    for line in result0.get_Page().get_AllTextLines():
+        assert len(line.get_TextEquiv()) == 1, "incremental mode must keep existing line text as is"
+
+def test_recognize_incremental_rerun(workspace_aufklaerung):
+    run_processor(KrakenBinarize,
+                  input_file_grp="OCR-D-GT-PAGE",
+                  output_file_grp="OCR-D-GT-PAGE-BIN",
+                  **workspace_aufklaerung,
+    )
+    run_processor(KrakenRecognize,
+                  input_file_grp="OCR-D-GT-PAGE-BIN",
+                  output_file_grp="OCR-D-OCR-KRAKEN",
+                  parameter={'overwrite_text': True},
+                  **workspace_aufklaerung,
+    )
+    run_processor(KrakenRecognize,
+                  # every line has a confidence below 1, so gets recognized again:
+                  input_file_grp="OCR-D-OCR-KRAKEN",
+                  output_file_grp="OCR-D-OCR-KRAKEN2",
+                  parameter={'incremental': True, 'incremental_threshold': 1.0},
+                  **workspace_aufklaerung,
+    )
+    ws = workspace_aufklaerung['workspace']
+    ws.save_mets()
+    result0 = next(ws.find_files(file_grp='OCR-D-OCR-KRAKEN2', mimetype=MIMETYPE_PAGE), False)
+    assert result0, "found no output PAGE file"
+    result0 = page_from_file(result0)
+    ids = result0.etree.xpath('//@id')
+    assert len(ids) == len(set(ids)), "duplicate IDs in output PAGE file"
+    for line in result0.get_Page().get_AllTextLines():
+        assert len(line.get_TextEquiv()) == 1, "re-recognized lines must only keep the new text"
+        assert ' '.join(word.get_TextEquiv()[0].Unicode for word in line.get_Word()) == \
+            ' '.join(line.get_TextEquiv()[0].Unicode.split())
+
+def test_recognize_keep_words(workspace_aufklaerung):
+    run_processor(KrakenBinarize,
+                  input_file_grp="OCR-D-GT-PAGE",
+                  output_file_grp="OCR-D-GT-PAGE-BIN",
+                  **workspace_aufklaerung,
+    )
+    run_processor(KrakenRecognize,
+                  input_file_grp="OCR-D-GT-PAGE-BIN",
+                  output_file_grp="OCR-D-OCR-KRAKEN",
+                  parameter={'overwrite_text': True},
+                  **workspace_aufklaerung,
+    )
+    # without overwrite_text (and not incremental), existing Words are kept
+    run_processor(KrakenRecognize,
+                  input_file_grp="OCR-D-OCR-KRAKEN",
+                  output_file_grp="OCR-D-OCR-KRAKEN2",
+                  **workspace_aufklaerung,
+    )
+    ws = workspace_aufklaerung['workspace']
+    ws.save_mets()
+    def line_words(file_grp):
+        return {line.id: [word.get_TextEquiv()[0].Unicode for word in line.get_Word()]
+                for out_file in ws.find_files(file_grp=file_grp, mimetype=MIMETYPE_PAGE)
+                for line in page_from_file(out_file).get_Page().get_AllTextLines()}
+    words1 = line_words('OCR-D-OCR-KRAKEN')
+    words2 = line_words('OCR-D-OCR-KRAKEN2')
+    assert words1.keys() == words2.keys()
+    for line_id, words in words1.items():
+        assert words2[line_id][:len(words)] == words, "existing words must be kept"
+
+def test_recognize_fallback(workspace_aufklaerung):
+    run_processor(KrakenBinarize,
+                  input_file_grp="OCR-D-GT-PAGE",
+                  output_file_grp="OCR-D-GT-PAGE-BIN",
+                  **workspace_aufklaerung,
+    )
+    run_processor(KrakenRecognize,
+                  input_file_grp="OCR-D-GT-PAGE-BIN",
+                  output_file_grp="OCR-D-OCR-KRAKEN",
+                  # (every line goes to the fallback)
+                  parameter={'overwrite_text': True,
+                             'fallback_model': 'en_best.mlmodel',
+                             'fallback_threshold': 1.0},
+                  **workspace_aufklaerung,
+    )
+    ws = workspace_aufklaerung['workspace']
+    ws.save_mets()
+    result0 = next(ws.find_files(file_grp='OCR-D-OCR-KRAKEN', mimetype=MIMETYPE_PAGE), False)
+    assert result0, "found no output PAGE file"
+    result0 = page_from_file(result0)
+    text0 = result0.etree.xpath('//page:Glyph/page:TextEquiv/page:Unicode', namespaces=NAMESPACES)
+    assert len(text0) > 0, "found no glyph text in output PAGE file"
+
+def test_recognize_extra_models(workspace_aufklaerung):
+    run_processor(KrakenBinarize,
+                  input_file_grp="OCR-D-GT-PAGE",
+                  output_file_grp="OCR-D-GT-PAGE-BIN",
+                  **workspace_aufklaerung,
+    )
+    run_processor(KrakenRecognize,
+                  input_file_grp="OCR-D-GT-PAGE-BIN",
+                  output_file_grp="OCR-D-OCR-KRAKEN",
+                  parameter={'overwrite_text': True,
+                             'extra_models': ['en_best.mlmodel']},
+                  **workspace_aufklaerung,
+    )
+    ws = workspace_aufklaerung['workspace']
+    ws.save_mets()
+    result0 = next(ws.find_files(file_grp='OCR-D-OCR-KRAKEN', mimetype=MIMETYPE_PAGE), False)
+    assert result0, "found no output PAGE file"
+    result0 = page_from_file(result0)
+    for line in result0.get_Page().get_AllTextLines():
+        textequivs = line.get_TextEquiv()
+        assert [textequiv.index for textequiv in textequivs] == [1, 2]
+        # same model, same result
+        assert textequivs[0].Unicode == textequivs[1].Unicode
+
+def test_recognize_line_cache(workspace_aufklaerung, tmpdir, monkeypatch):
+    monkeypatch.setenv('OCRD_KRAKEN_LINE_CACHE', str(tmpdir.join('lines.sqlite')))
+    run_processor(KrakenBinarize,
+                  input_file_grp="OCR-D-GT-PAGE",
+                  output_file_grp="OCR-D-GT-PAGE-BIN",
+                  **workspace_aufklaerung,
+    )
+    counts = []
+    for run in (1, 2):
+        metrics_path = str(tmpdir.join(f'metrics{run}.jsonl'))
+        monkeypatch.setenv('OCRD_KRAKEN_METRICS', metrics_path)
+        run_processor(KrakenRecognize,
+                      input_file_grp="OCR-D-GT-PAGE-BIN",
+                      output_file_grp=f"OCR-D-OCR-KRAKEN{run}",
+                      parameter={'overwrite_text': True},
+                      **workspace_aufklaerung,
+        )
+        with open(metrics_path, encoding='utf-8') as records:
+            records = [json.loads(record)['counts'] for record in records]
+        counts.append({name: sum(record.get(name, 0) for record in records)
+                       for name in ('cache_hits', 'cache_misses')})
+    ws = workspace_aufklaerung['workspace']
+    ws.save_mets()
+    # the first run fills the cache, the second takes all results from it
+    assert counts[0]['cache_misses'] > 0
+    assert counts[1] == {'cache_hits': sum(counts[0].values()), 'cache_misses': 0}
+    assert line_texts(ws, "OCR-D-OCR-KRAKEN2") == line_texts(ws, "OCR-D-OCR-KRAKEN1")
+
+def test_recognize_extra_models_fallback(workspace_aufklaerung):
+    run_processor(KrakenBinarize,
+                  input_file_grp="OCR-D-GT-PAGE",
+                  output_file_grp="OCR-D-GT-PAGE-BIN",
+                  **workspace_aufklaerung,
+    )
+    # same model under another name, so the TextEquivs tell which one produced them
+    fallback_model = KrakenRecognize(None).resolve_resource('en_best.mlmodel')
+    run_processor(KrakenRecognize,
+                  input_file_grp="OCR-D-GT-PAGE-BIN",
+                  output_file_grp="OCR-D-OCR-KRAKEN",
+                  parameter={'overwrite_text': True,
+                             'extra_models': ['en_best.mlmodel'],
+                             'fallback_model': fallback_model,
+                             # re-recognize all lines without full confidence
+                             'fallback_threshold': 1.0},
+                  **workspace_aufklaerung,
+    )
+    ws = workspace_aufklaerung['workspace']
+    ws.save_mets()
+    result0 = next(ws.find_files(file_grp='OCR-D-OCR-KRAKEN', mimetype=MIMETYPE_PAGE), False)
+    assert result0, "found no output PAGE file"
+    result0 = page_from_file(result0)
+    comments = []
+    for line in result0.get_Page().get_AllTextLines():
+        textequivs = line.get_TextEquiv()
+        assert textequivs[0].comments in [f'model: {fallback_model}', 'model: en_best.mlmodel']
+        assert textequivs[1].comments == 'model: en_best.mlmodel'
+        comments.append(textequivs[0].comments)
+    assert f'model: {fallback_model}' in comments
+
+def test_recognize_line_batches(workspace_aufklaerung, monkeypatch):
+    run_processor(KrakenBinarize,
+                  input_file_grp="OCR-D-GT-PAGE",
+                  output_file_grp="OCR-D-GT-PAGE-BIN",
+                  **workspace_aufklaerung,
+    )
+    for batch_size in (0, 16):
+        monkeypatch.setenv('OCRD_KRAKEN_LINE_BATCH_SIZE', str(batch_size))
+        run_processor(KrakenRecognize,
+                      input_file_grp="OCR-D-GT-PAGE-BIN",
+                      output_file_grp=f"OCR-D-OCR-KRAKEN-BATCH{batch_size}",
+                      parameter={'overwrite_text': True},
+                      **workspace_aufklaerung,
+        )
+    ws = workspace_aufklaerung['workspace']
+    ws.save_mets()
+    # padding lines to the widest one in their batch must not change the results
+    assert line_texts(ws, "OCR-D-OCR-KRAKEN-BATCH16") == line_texts(ws, "OCR-D-OCR-KRAKEN-BATCH0")
+
+def test_recognize_processes(workspace_aufklaerung, monkeypatch):
+    # (keep several chunks of lines in flight, so both processes get some even without page parallelism)
+    monkeypatch.setenv('OCRD_KRAKEN_PIPELINE_LINES', '8')
+    run_processor(KrakenBinarize,
+                  input_file_grp="OCR-D-GT-PAGE",
+                  output_file_grp="OCR-D-GT-PAGE-BIN",
+                  **workspace_aufklaerung,
+    )
+    for processes in (1, 2):
+        run_processor(KrakenRecognize,
+                      input_file_grp="OCR-D-GT-PAGE-BIN",
+                      output_file_grp=f"OCR-D-OCR-KRAKEN-PROC{processes}",
+                      parameter={'overwrite_text': True, 'predictor_processes': processes},
+                      **workspace_aufklaerung,
+        )
+    ws = workspace_aufklaerung['workspace']
+    ws.save_mets()
+    # each predictor process has its own model instance, with the same results
+    assert line_texts(ws, "OCR-D-OCR-KRAKEN-PROC2") == line_texts(ws, "OCR-D-OCR-KRAKEN-PROC1")
+
+def test_recognize_metrics(workspace_aufklaerung, tmpdir, monkeypatch):
+    run_processor(KrakenBinarize,
+                  input_file_grp="OCR-D-GT-PAGE",
+                  output_file_grp="OCR-D-GT-PAGE-BIN",
+                  **workspace_aufklaerung,
+    )
+    for suffix in ('jsonl', 'prom'):
+        monkeypatch.setenv('OCRD_KRAKEN_METRICS', str(tmpdir.join(f'metrics.{suffix}')))
+        run_processor(KrakenRecognize,
+                      input_file_grp="OCR-D-GT-PAGE-BIN",
+                      output_file_grp=f"OCR-D-OCR-KRAKEN-{suffix.upper()}",
+                      parameter={'overwrite_text': True},
+                      **workspace_aufklaerung,
+        )
+    # (the Prometheus file gets written when the processor is shut down)
+    gc.collect()
+    ws = workspace_aufklaerung['workspace']
+    ws.save_mets()
+    page_ids = [out_file.pageId for out_file in ws.find_files(file_grp="OCR-D-OCR-KRAKEN-JSONL",
+                                                               mimetype=MIMETYPE_PAGE)]
+    # one JSON record per page
+    with open(str(tmpdir.join('metrics.jsonl')), encoding='utf-8') as records:
+        records = [json.loads(record) for record in records]
+    assert sorted(record['page_id'] for record in records) == sorted(page_ids)
+    for record in records:
+        assert record['processor'] == 'ocrd-kraken-recognize'
+        assert record['total'] >= sum(record['stages'].get(stage, 0) for stage in ('image', 'segmentation'))
+        assert {'image', 'segmentation', 'predict', 'page'} <= set(record['stages'])
+        assert record['gauges']['predictor_batch_size'] >= 1
+    assert sum(record['counts']['lines'] for record in records) == len(line_texts(ws, "OCR-D-OCR-KRAKEN-JSONL"))
+    # Prometheus metrics aggregated over all pages
+    samples = {}
+    with open(str(tmpdir.join('metrics.prom')), encoding='utf-8') as prom:
+        for line in prom:
+            if line.startswith('#'):
+                assert line.startswith(('# HELP ocrd_kraken_', '# TYPE ocrd_kraken_'))
+                continue
+            name, value = line.rsplit(' ', 1)
+            samples[name] = float(value)
+    assert samples['ocrd_kraken_pages_total{processor="ocrd-kraken-recognize"}'] == len(page_ids)
+    assert samples['ocrd_kraken_stage_seconds_count{processor="ocrd-kraken-recognize",stage="total"}'] == len(page_ids)
+    assert samples['ocrd_kraken_stage_seconds_sum{processor="ocrd-kraken-recognize",stage="predict"}'] > 0
+    assert samples['ocrd_kraken_items_total{processor="ocrd-kraken-recognize",item="lines"}'] == \
+        len(line_texts(ws, "OCR-D-OCR-KRAKEN-PROM"))
+    assert samples['ocrd_kraken_max{processor="ocrd-kraken-recognize",name="predictor_batch_size"}'] >= 1
+
+def test_bboxes_for_polygons():
+    # page to image: shift by (-100, -50), then zoom by 0.5
+    transform = scale_coordinates(shift_coordinates(np.eye(3), np.array([-100, -50])), (0.5, 0.5))
+    coords = {'transform': transform}
+    cuts = [[[10.2, 5.7], [20.4, 5.7], [20.4, 30.1], [10.2, 30.1]],
+            # zero width
+            [[20.4, 5.7], [20.4, 30.1]],
+            # a single point
+            [[25, 12]],
+            [[25.6, 4.9], [40.1, 6.2], [39.7, 31.5], [26.3, 29.8]]]
+    # glyph polygons span their own cut and the start of the next one
+    glyphs = [cut + cuts[min(idx + 1, len(cuts) - 1)] for idx, cut in enumerate(cuts)]
+    expected = []
+    for poly in cuts + glyphs:
+        # (as previously computed for each glyph on its own)
+        bbox = np.array(bbox_from_polygon(coordinates_for_segment(poly, None, coords)), dtype=int)
+        if np.prod(bbox[2:4] - bbox[0:2]) == 0:
+            bbox[2:4] += 1
+        expected.append(bbox.tolist())
+    bboxes = bboxes_for_polygons(cuts + glyphs, coords)
+    assert bboxes.shape == (2 * len(cuts), 4)
+    assert avoid_empty_bboxes(bboxes).tolist() == expected
+    # (the single point has an empty box before enlarging)
+    assert bboxes[2, 0] == bboxes[2, 2] and bboxes[2, 1] == bboxes[2, 3]
+    # the union of the boxes of two cuts is the box of both cuts' polygon
+    bboxes_cuts = bboxes[:len(cuts)]
+    succ = np.minimum(np.arange(1, len(cuts) + 1), len(cuts) - 1)
+    union = np.concatenate([np.minimum(bboxes_cuts[:, :2], bboxes_cuts[succ, :2]),
+                            np.maximum(bboxes_cuts[:, 2:], bboxes_cuts[succ, 2:])], axis=1)
+    assert avoid_empty_bboxes(union).tolist() == expected[len(cuts):]
+    # single box
+    assert avoid_empty_bboxes(bboxes[2]).tolist() == expected[2]
+    assert bboxes_for_polygons([], coords).shape == (0, 4)
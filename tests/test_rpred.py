@@ -0,0 +1,43 @@
+# pylint: disable=import-error
+
+import torch
+
+from ocrd_kraken.rpred import width_buckets, predict_lines
+
+
+def test_width_buckets():
+    widths = [100, 400, 110, 140, 160, 390, 120]
+    tensors = [torch.zeros(1, 48, width) for width in widths]
+    buckets = width_buckets(tensors, 3)
+    assert sorted(idx for bucket in buckets for idx in bucket) == list(range(len(widths)))
+    assert buckets == [[0, 2, 6], [3, 4], [5, 1]]
+    for bucket in buckets:
+        assert len(bucket) <= 3
+        assert max(widths[idx] for idx in bucket) <= 1.5 * min(widths[idx] for idx in bucket)
+    # different heights never share a batch
+    tensors = [torch.zeros(1, 48, 100), torch.zeros(1, 64, 100)]
+    assert width_buckets(tensors, 8) == [[0], [1]]
+
+def test_predict_lines():
+    from kraken.lib.vgsl import TorchVGSLModel
+    from kraken.lib.codec import PytorchCodec
+    from kraken.lib.models import TorchSeqRecognizer
+    torch.manual_seed(0)
+    spec = '[1,48,0,1 Cr3,3,16 Mp2,2 Cr3,3,16 S1(1x0)1,3 Lbx32 O1c10]'
+    try:
+        nn = TorchVGSLModel(vgsl=spec)
+    except TypeError:
+        # Kraken<7
+        nn = TorchVGSLModel(spec)
+        nn.init_weights()
+    nn.add_codec(PytorchCodec('abcdefghi'))
+    nn.eval()
+    net = TorchSeqRecognizer(nn, device='cpu')
+    tensors = [torch.rand(1, 48, width) for width in (100, 120, 130, 140)]
+    batched = predict_lines(net, tensors, batch_size=4)
+    # (single lines are not padded)
+    single = [predict_lines(net, [tensor], batch_size=1)[0] for tensor in tensors]
+    for (preds, olen), (preds1, olen1) in zip(batched, single):
+        assert olen == olen1
+        assert [pred[:3] for pred in preds] == [pred[:3] for pred in preds1]
+        assert all(abs(pred[3] - pred1[3]) < 1e-6 for pred, pred1 in zip(preds, preds1))
@@ -1,13 +1,36 @@
 # pylint: disable=import-error
 
 import os
+import json
+
+import numpy as np
+import pytest
+import shapely
+from PIL import Image
+from shapely.geometry import Polygon, LineString, box
 
 from ocrd import run_processor
-from ocrd_utils import MIMETYPE_PAGE
+from ocrd_utils import (
+    MIMETYPE_PAGE,
+    coordinates_for_segment,
+    coordinates_of_segment,
+    points_from_bbox,
+    polygon_from_points,
+    polygon_mask,
+)
 from ocrd_models.constants import NAMESPACES
+from ocrd_models.ocrd_page import TextRegionType, CoordsType
 from ocrd_modelfactory import page_from_file
 
-from ocrd_kraken.segment import KrakenSegment
+from ocrd_kraken.segment import (
+    KrakenSegment,
+    lines_in_regions,
+    downscale_image,
+    segment_mask,
+    region_groups,
+    assign_lines,
+    clip_to_region,
+)
 from ocrd_kraken.binarize import KrakenBinarize
 
 
@@ -46,6 +69,100 @@ def test_run_blla_regionlevel(workspace_aufklaerung_region):
     ws.save_mets()
     analyse_result(ws)
 
+def test_run_blla_regions(workspace_aufklaerung_region):
+    run_processor(KrakenSegment,
+                  input_file_grp="OCR-D-GT-SEG-REGION",
+                  output_file_grp="OCR-D-SEG-LINE-KRAKEN",
+                  page_id="phys_0005",
+                  parameter={'level-of-operation': 'region', 'overwrite_segments': True},
+                  **workspace_aufklaerung_region,
+    )
+    ws = workspace_aufklaerung_region['workspace']
+    ws.save_mets()
+    analyse_result(ws)
+    out_file = next(ws.find_files(file_grp="OCR-D-SEG-LINE-KRAKEN", mimetype=MIMETYPE_PAGE))
+    in_file = next(ws.find_files(file_grp="OCR-D-GT-SEG-REGION", page_id="phys_0005",
+                                 mimetype=MIMETYPE_PAGE))
+    page = page_from_file(out_file).get_Page()
+    # existing regions are kept, only lines get added
+    assert [region.id for region in page.get_AllRegions(classes=['Text'])] == \
+        [region.id for region in page_from_file(in_file).get_Page().get_AllRegions(classes=['Text'])]
+    ids = []
+    for region in page.get_AllRegions(classes=['Text']):
+        region_poly = Polygon(polygon_from_points(region.get_Coords().points)).buffer(30)
+        for line in region.get_TextLine():
+            assert line.id.startswith(region.id + '_line_')
+            line_poly = Polygon(polygon_from_points(line.get_Coords().points))
+            assert region_poly.contains(line_poly.centroid), \
+                f"line {line.id} assigned to region {region.id} it is not in"
+            ids.append(line.id)
+    assert len(ids) == len(set(ids)), "lines assigned to more than one region"
+
+def test_run_blla_tiled(workspace_aufklaerung, tmpdir, monkeypatch):
+    metrics_path = str(tmpdir.join('metrics.jsonl'))
+    monkeypatch.setenv('OCRD_KRAKEN_METRICS', metrics_path)
+    run_processor(KrakenSegment,
+                  input_file_grp="OCR-D-IMG",
+                  output_file_grp="OCR-D-SEG-LINE-KRAKEN",
+                  # (the smallest tiles for the default model's input height)
+                  parameter={'maxcolseps': 0, 'use_legacy': False, 'tile_size': 1800, 'tile_overlap': 256},
+                  **workspace_aufklaerung,
+    )
+    ws = workspace_aufklaerung['workspace']
+    ws.save_mets()
+    analyse_result(ws)
+    with open(metrics_path, encoding='utf-8') as records:
+        assert sum(json.loads(record)['counts'].get('tiles', 0) for record in records) > 1, \
+            "pages not segmented in tiles"
+    for out_file in ws.find_files(file_grp="OCR-D-SEG-LINE-KRAKEN", mimetype=MIMETYPE_PAGE):
+        lines = page_from_file(out_file).get_Page().get_AllTextLines()
+        assert len(set(line.id for line in lines)) == len(lines)
+        polys = [Polygon(polygon_from_points(line.get_Coords().points)) for line in lines]
+        # lines found in the overlap of two tiles must only be kept once
+        idx_lines, idx_others = shapely.STRtree(polys).query(polys, predicate='intersects')
+        for idx_line, idx_other in zip(idx_lines, idx_others):
+            if idx_line < idx_other:
+                overlap = polys[idx_line].intersection(polys[idx_other]).area
+                assert overlap < 0.5 * min(polys[idx_line].area, polys[idx_other].area), \
+                    f"lines {lines[idx_line].id} and {lines[idx_other].id} are duplicates"
+
+def test_run_blla_tiles_too_small(workspace_aufklaerung):
+    # blla would scale such tiles up to the model's input height again
+    with pytest.raises(Exception, match="tile_size"):
+        run_processor(KrakenSegment,
+                      input_file_grp="OCR-D-IMG",
+                      output_file_grp="OCR-D-SEG-LINE-KRAKEN",
+                      parameter={'use_legacy': False, 'tile_size': 512},
+                      **workspace_aufklaerung,
+        )
+
+def test_run_blla_target_dpi(workspace_aufklaerung, tmpdir, monkeypatch):
+    metrics_path = str(tmpdir.join('metrics.jsonl'))
+    monkeypatch.setenv('OCRD_KRAKEN_METRICS', metrics_path)
+    run_processor(KrakenSegment,
+                  input_file_grp="OCR-D-IMG",
+                  output_file_grp="OCR-D-SEG-LINE-KRAKEN",
+                  parameter={'maxcolseps': 0, 'use_legacy': False, 'target_dpi': 150},
+                  **workspace_aufklaerung,
+    )
+    ws = workspace_aufklaerung['workspace']
+    ws.save_mets()
+    analyse_result(ws)
+    with open(metrics_path, encoding='utf-8') as records:
+        assert all('downscale' in json.loads(record)['stages'] for record in records), \
+            "pages not downsampled"
+    for out_file in ws.find_files(file_grp="OCR-D-SEG-LINE-KRAKEN", mimetype=MIMETYPE_PAGE):
+        page = page_from_file(out_file).get_Page()
+        points = np.array([point
+                           for line in page.get_AllTextLines()
+                           for point in polygon_from_points(line.get_Coords().points)])
+        # coordinates are in full resolution page space: within the page,
+        # but not confined to the downsampled image's part (the top left quarter)
+        assert points.min() >= 0
+        assert points[:, 0].max() <= page.imageWidth and points[:, 1].max() <= page.imageHeight
+        assert points[:, 0].max() > 0.6 * page.imageWidth
+        assert points[:, 1].max() > 0.6 * page.imageHeight
+
 def test_run_legacy(workspace_aufklaerung):
     # legacy segmentation requires binarized images
     run_processor(KrakenBinarize,
@@ -63,3 +180,86 @@ def test_run_legacy(workspace_aufklaerung):
     ws = workspace_aufklaerung['workspace']
     ws.save_mets()
     analyse_result(ws)
+
+def test_lines_in_regions():
+    lines = [box(10, y, 90, y + 8) for y in range(0, 100, 10)]
+    regions = [box(0, -5, 100, 50), box(200, 0, 300, 100), box(0, 35, 100, 105)]
+    # overlapping regions both contain line 4, the middle one contains nothing
+    assert lines_in_regions(regions, lines) == [[0, 1, 2, 3, 4], [], [4, 5, 6, 7, 8, 9]]
+    assert lines_in_regions(regions, []) == [[], [], []]
+    assert lines_in_regions([], lines) == []
+
+def test_downscale_image():
+    coords = {'transform': np.array([[1, 0, -100], [0, 1, -50], [0, 0, 1]], dtype=float)}
+    for mode in ['L', '1']:
+        image = Image.new(mode, (1200, 800), 255)
+        scaled, scaled_coords = downscale_image(image, coords, 0.5)
+        assert scaled.size == (600, 400) and scaled.mode == mode
+        # original coordinates are unchanged
+        assert coords['transform'][0, 2] == -100
+        region = TextRegionType(id='r', Coords=CoordsType(points_from_bbox(300, 250, 900, 650)))
+        assert coordinates_of_segment(region, scaled, scaled_coords).tolist() == \
+            [[100, 100], [400, 100], [400, 300], [100, 300]]
+        assert coordinates_for_segment([[100, 100], [400, 300]], scaled, scaled_coords).tolist() == \
+            [[300, 250], [900, 650]]
+
+def test_segment_mask():
+    polygons = [[[10, 10], [90, 10], [90, 70], [10, 70]], [[5, 72], [50, 75], [95, 79], [30, 78]]]
+    holes = [[[20, 20], [40, 20], [40, 40], [20, 40]], [[60, 20], [80, 20], [80, 40], [60, 40]]]
+    mask = segment_mask((100, 80), polygons[:1], holes)
+    assert mask.mode == '1' and mask.size == (100, 80)
+    array = np.array(mask)
+    # outside and within holes (including their outlines)
+    assert array[5, 5] and array[30, 30] and array[30, 70] and array[20, 30]
+    # within polygon (including its outline)
+    assert not array[50, 50] and not array[30, 50] and not array[10, 50]
+    # same as masking with ocrd_utils.polygon_mask (one full-size mask per polygon)
+    image = Image.new('L', (100, 80))
+    for polys in (polygons[:1], polygons):
+        expected = Image.new('L', image.size, 255)
+        for poly in polys:
+            expected.paste(0, mask=polygon_mask(image, np.array(poly)))
+        for hole in holes:
+            expected.paste(255, mask=polygon_mask(image, np.array(hole)))
+        assert np.array_equal(np.array(segment_mask(image.size, polys, holes)),
+                              np.array(expected) > 0)
+
+def test_region_groups():
+    # two columns of three regions each, 10px apart vertically and 100px horizontally
+    regions = [box(x, y, x + 200, y + 90) for x in (0, 300) for y in (0, 100, 200)]
+    groups = region_groups(regions, 20)
+    assert sorted(idx for group in groups for idx in group) == list(range(6))
+    # neighbours (in the same column) must be in different groups
+    for group in groups:
+        for idx in group:
+            assert not any(other in group for other in (idx - 1, idx + 1) if idx // 3 == other // 3)
+    assert len(groups) == 2
+    assert region_groups(regions, 5) == [list(range(6))]
+    assert region_groups([], 20) == []
+
+def test_assign_lines():
+    regions = [box(0, 0, 100, 100), box(0, 110, 100, 200)]
+    lines = [box(10, 10, 90, 30),
+             # mostly in the second region
+             box(10, 95, 90, 130),
+             # outside of both, closer to the first
+             box(150, 20, 200, 40)]
+    assert assign_lines(regions, lines) == [[0, 2], [1]]
+    assert assign_lines(regions, []) == [[], []]
+    assert assign_lines([], lines) == []
+
+def test_clip_to_region():
+    # two regions of the same group, and a line found across both
+    regions = [box(0, 0, 100, 100), box(150, 0, 250, 100)]
+    assert region_groups(regions, 20) == [[0, 1]]
+    line = box(10, 40, 230, 60)
+    baseline = LineString([(10, 55), (230, 55)])
+    # assigned to the region with the larger overlap, but clipped to it
+    assert assign_lines(regions, [line]) == [[0], []]
+    assert clip_to_region(line, regions[0]).bounds == (10, 40, 100, 60)
+    assert clip_to_region(baseline, regions[0]).bounds == (10, 55, 100, 55)
+    # intersections falling apart keep their largest part
+    ushape = Polygon([(0, 0), (300, 0), (300, 100), (250, 100), (250, 20), (100, 20), (100, 100), (0, 100)])
+    assert clip_to_region(ushape, box(0, 30, 300, 60)).bounds == (0, 30, 100, 60)
+    # lines outside the region stay unchanged
+    assert clip_to_region(baseline, box(0, 0, 100, 10)) is baseline
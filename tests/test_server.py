@@ -0,0 +1,136 @@
+# pylint: disable=import-error
+
+import os
+import stat
+import time
+from threading import Thread
+from multiprocessing import AuthenticationError
+from multiprocessing.connection import Client
+
+from ocrd_utils import getLogger
+
+from ocrd_kraken.common import KrakenPredictor
+from ocrd_kraken.metrics import PageMetrics, set_current_metrics
+from ocrd_kraken.server import KrakenPredictorServer, KrakenPredictorClient, key_path
+
+
+class EchoPredictor(KrakenPredictor):
+    def setup(self):
+        pass
+    def predict(self, *inputs):
+        if not inputs:
+            return os.getpid()
+        if inputs[0] == 'fail':
+            raise ValueError(inputs[0])
+        if inputs[0] == 'stream':
+            return iter(range(inputs[1]))
+        return inputs
+
+def test_server(tmpdir):
+    socket_path = str(tmpdir.join('kraken.sock'))
+    server = KrakenPredictorServer(socket_path)
+    Thread(target=server.serve_forever, daemon=True).start()
+    while not os.path.exists(socket_path):
+        time.sleep(0.1)
+    # only the current user may connect
+    for path in (socket_path, key_path(socket_path)):
+        assert stat.S_IMODE(os.stat(path).st_mode) & 0o077 == 0
+    try:
+        Client(socket_path, family='AF_UNIX', authkey=b'guess')
+        assert False, "connection without the key accepted"
+    except AuthenticationError:
+        pass
+    logger = getLogger('ocrd.kraken.test')
+    client1 = KrakenPredictorClient(socket_path, EchoPredictor, logger, {'model': 'a'})
+    client1.start()
+    pid1 = client1("")
+    assert client1('page1', 'foo', 1) == ('foo', 1)
+    try:
+        client1('page2', 'fail')
+        assert False, "predictor failure not propagated"
+    except Exception as e:
+        assert isinstance(e.__cause__, Exception)
+    # streamed results
+    assert client1.receive(client1.submit('page3', 'stream', 70)) == list(range(70))
+    chunks = list(client1.stream(client1.submit('page4', 'stream', 70)))
+    assert [len(chunk) for chunk in chunks] == [32, 32, 6]
+    # a stream abandoned early must not leak into the next task's result
+    for _ in client1.stream(client1.submit('page5', 'stream', 70)):
+        break
+    assert client1('page6', 'bar', 2) == ('bar', 2)
+    # predictor timings measured in the server reach the client's metrics
+    metrics = PageMetrics()
+    set_current_metrics(metrics)
+    try:
+        client1('page7', 'foo', 1)
+    finally:
+        set_current_metrics(None)
+    assert {'predictor_reply', 'predictor_queue', 'predictor_model'} <= set(metrics.stages)
+    client1.shutdown()
+    # re-attach to the same predictor
+    client2 = KrakenPredictorClient(socket_path, EchoPredictor, logger, {'model': 'a'})
+    client2.start()
+    assert client2("") == pid1
+    # different parameters need another predictor
+    client3 = KrakenPredictorClient(socket_path, EchoPredictor, logger, {'model': 'b'})
+    client3.start()
+    assert client3("") != pid1
+    client2.shutdown()
+    client3.shutdown()
+    for predictor in server.predictors.values():
+        predictor.shutdown()
+
+class FlakyPredictor(EchoPredictor):
+    def setup(self):
+        # fail only on the first attempt
+        if not os.path.exists(self.parameter['marker']):
+            open(self.parameter['marker'], 'w').close()
+            raise RuntimeError("transient failure")
+
+def test_server_restart_failed(tmpdir):
+    socket_path = str(tmpdir.join('kraken.sock'))
+    server = KrakenPredictorServer(socket_path)
+    Thread(target=server.serve_forever, daemon=True).start()
+    while not os.path.exists(socket_path):
+        time.sleep(0.1)
+    logger = getLogger('ocrd.kraken.test')
+    parameter = {'marker': str(tmpdir.join('attempted'))}
+    client1 = KrakenPredictorClient(socket_path, FlakyPredictor, logger, parameter)
+    client1.start()
+    try:
+        client1("")
+        assert False, "setup failure not propagated"
+    except Exception:
+        pass
+    client1.shutdown()
+    # the next client gets a new predictor instead of the terminated one
+    client2 = KrakenPredictorClient(socket_path, FlakyPredictor, logger, parameter)
+    client2.start()
+    assert client2('page1', 'foo', 1) == ('foo', 1)
+    client2.shutdown()
+    for predictor in server.predictors.values():
+        predictor.shutdown()
+
+def test_server_pipelining(tmpdir):
+    socket_path = str(tmpdir.join('kraken.sock'))
+    server = KrakenPredictorServer(socket_path)
+    Thread(target=server.serve_forever, daemon=True).start()
+    while not os.path.exists(socket_path):
+        time.sleep(0.1)
+    logger = getLogger('ocrd.kraken.test')
+    client = KrakenPredictorClient(socket_path, EchoPredictor, logger, {'model': 'a'})
+    client.start()
+    # results much larger than the socket buffers
+    payload = b'x' * (16 << 20)
+    results = []
+    def pipeline():
+        tasks = [client.submit('page1', 1, payload), client.submit('page2', 2, payload)]
+        results.extend(client.receive(task) for task in tasks)
+    thread = Thread(target=pipeline, daemon=True)
+    thread.start()
+    thread.join(timeout=60)
+    assert not thread.is_alive(), "client and server deadlocked"
+    assert results == [(1, payload), (2, payload)]
+    client.shutdown()
+    for predictor in server.predictors.values():
+        predictor.shutdown()
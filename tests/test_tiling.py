@@ -0,0 +1,40 @@
+# pylint: disable=import-error
+
+from kraken.containers import Segmentation, BaselineLine, Region
+
+from ocrd_kraken.tiling import tile_ranges, tile_boxes, stitch_tiles
+
+
+def test_tile_boxes():
+    assert tile_ranges(500, 1000, 200) == [(0, 500)]
+    ranges = tile_ranges(2500, 1000, 200)
+    assert ranges[0][0] == 0 and ranges[-1][1] == 2500
+    assert all(end - start == 1000 for start, end in ranges)
+    assert all(prev[1] - next_[0] >= 200 for prev, next_ in zip(ranges, ranges[1:]))
+    assert tile_boxes(2500, 900, 1000, 200) == [(x0, 0, x1, 900) for x0, x1 in ranges]
+
+def test_stitch_tiles():
+    def segmentation(lines, regions):
+        return Segmentation(type='baselines', imagename=None, text_direction='horizontal-lr',
+                            script_detection=False, lines=lines, regions={'text': regions})
+    def line(id_, x0, x1, y):
+        return BaselineLine(id=id_, baseline=[[x0, y], [x1, y]],
+                            boundary=[[x0, y - 30], [x1, y - 30], [x1, y + 5], [x0, y + 5]],
+                            tags={'type': 'default'}, regions=['r' + id_[0]])
+    # two tiles side by side, overlapping in 800..1000
+    tiles = tile_boxes(1800, 1000, 1000, 200)
+    assert tiles == [(0, 0, 1000, 1000), (800, 0, 1800, 1000)]
+    left = segmentation([line('a1', 100, 1000, 100), line('a2', 100, 500, 200)],
+                        [Region(id='ra', boundary=[[50, 50], [1000, 50], [1000, 300], [50, 300]])])
+    # line 1 continues to the right, line 3 is only on the right
+    right = segmentation([line('b1', 0, 600, 100), line('b3', 300, 600, 400)],
+                         [Region(id='rb', boundary=[[0, 50], [700, 50], [700, 450], [0, 450]])])
+    res = stitch_tiles([left, right], tiles)
+    assert len(res.lines) == 3
+    assert len(res.regions['text']) == 1
+    merged = res.lines[0]
+    assert merged.baseline[0] == [100, 100] and merged.baseline[-1] == [1400, 100]
+    xs = [x for x, _ in merged.boundary]
+    assert min(xs) == 100 and max(xs) == 1400
+    assert [line.baseline[0] for line in res.lines[1:]] == [[100, 200], [1100, 400]]
+    assert all(line.regions == ['ra'] for line in res.lines)